@@ -0,0 +1,197 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Registry of dataset adapters. An adapter declares where a country
+    keeps its data: the site resolver, and per variable the file layout,
+    the column and the native time resolution. Every variable loads into
+    the same store.DailyStore, which is all the vectorised engines need.
+
+    Loading is lazy and projection-aware: load('ah', sites=['spb']) opens
+    only the spb file and parses only its humidity column. A new country
+    needs an Adapter and register(), and no copy of a driver file:
+
+        register(Adapter('sweden', sites=['sto'], resolver=get_swedish_resolver,
+                         variables={'ah': {'layout': 'site_files',
+                                           'pattern': 'data/sweden/%s.txt',
+                                           'column': 'Humidity'}}))
+        dataset.AdapterDataset('sweden').onsets(...)
+
+    Layouts:
+        site_files  a file per site, a column per variable (flu_dbase)
+        wide_csv    one file, a column per site, named as the site
+        records     one file, a line per (site, date, value)
+"""
+import datetime
+
+import numpy as np
+
+from calibration import ThresholdTable
+from events import get_morbidity_events, get_mortality_events
+from ingest import get_store_from_site_files, get_store_from_wide_csv
+import russia
+from store import DailyStore
+import usa
+
+RESOLUTIONS = ('daily', 'weekly')
+
+ADAPTERS = dict()
+
+
+class Adapter:
+    """
+    Declaration of a country: sites, resolver and variables
+    """
+
+    def __init__(self, name, sites, resolver, variables, excess=None, detect_onsets=None,
+                 get_events=None, get_threshold_table=None):
+        """
+        :param sites: list, site codes analysed by default
+        :param resolver: function () -> dict[code] = {'name': ..., 'acronym': ...}
+        :param variables: dict, variable -> {'layout': ..., 'resolution':
+            'daily' or 'weekly', and the keys of the layout}, 'ah' is required
+        :param excess: function (sites) -> excess data of detect_onsets
+        :param detect_onsets: function (excess, thresholds, winter) -> onsets
+        :param get_events: function (excess, thresholds, winter) -> events,
+            see events.get_events
+        :param get_threshold_table: function (excess, winter) -> calibration.ThresholdTable
+        """
+        for variable, spec in variables.items():
+            if spec['layout'] not in LAYOUTS:
+                raise ValueError('unknown layout %s of %s, use one of %s'
+                                 % (spec['layout'], variable, sorted(LAYOUTS)))
+            if spec.get('resolution', 'daily') not in RESOLUTIONS:
+                raise ValueError('unknown resolution %s of %s, use one of %s'
+                                 % (spec['resolution'], variable, RESOLUTIONS))
+        self.name = name
+        self.sites = list(sites)
+        self.variables = variables
+        self.excess = excess
+        self.detect_onsets = detect_onsets
+        self.get_events = get_events
+        self.get_threshold_table = get_threshold_table
+        self._resolver = resolver
+        self._resolved = None
+
+    def resolver(self):
+        if self._resolved is None:
+            self._resolved = self._resolver()
+        return self._resolved
+
+    def resolution(self, variable):
+        return self.variables[variable].get('resolution', 'daily')
+
+    def load(self, variable, sites=None, by='name', workers=None):
+        """
+        Read one variable of some sites, nothing else
+        :param sites: list of site codes, the adapter sites by default
+        :param by: str, store columns are site 'name's or 'code's
+        :return: store.DailyStore
+        """
+        spec = self.variables[variable]
+        sites = self.sites if sites is None else list(sites)
+        resolver = self.resolver()
+        columns = [resolver[site]['name'] if by == 'name' else site for site in sites]
+        return LAYOUTS[spec['layout']](spec, sites, columns, resolver, workers)
+
+
+def _load_site_files(spec, sites, columns, resolver, workers):
+    return get_store_from_site_files(
+        spec['pattern'], sites, spec['column'], dict(zip(sites, columns)),
+        spec.get('delimiter', ' '), workers)
+
+
+def _load_wide_csv(spec, sites, columns, resolver, workers):
+    store = get_store_from_wide_csv(spec['file'], spec.get('delimiter', ';'), workers,
+                                    names=[resolver[site]['name'] for site in sites])
+    return DailyStore(store.dates, columns, store.values)
+
+
+def _load_records(spec, sites, columns, resolver, workers):
+    """
+    spec keys: 'file', 'site_field', 'date_field', 'value_field' (indices of
+    whitespace separated fields), 'parse_site', 'parse_date' and 'scale'
+    """
+    column_of = {site: idx for idx, site in enumerate(sites)}
+    parse_site, parse_date = spec.get('parse_site', str), spec['parse_date']
+    records = []
+    with open(spec['file'], 'r') as file:
+        for line in file:
+            fields = line.split()
+            if not fields:
+                continue
+            site = parse_site(fields[spec['site_field']])
+            if site in column_of:  # Other sites are not parsed further
+                date = parse_date(fields[spec['date_field']])
+                if not (date.month == 2 and date.day == 29):  # omit leap year
+                    records.append((date.toordinal(), column_of[site],
+                                    float(fields[spec['value_field']]) * spec.get('scale', 1.)))
+
+    ordinals = np.unique([record[0] for record in records]).astype(int)
+    values = np.full((len(ordinals), len(sites)), np.nan)
+    for ordinal, column, value in records:
+        values[np.searchsorted(ordinals, ordinal), column] = value
+    return DailyStore([datetime.date.fromordinal(int(x)) for x in ordinals], columns, values)
+
+
+LAYOUTS = {
+    'site_files': _load_site_files,
+    'wide_csv': _load_wide_csv,
+    'records': _load_records,
+}
+
+
+def register(adapter):
+    """
+    :return: the adapter, so that a declaration is one statement
+    """
+    ADAPTERS[adapter.name] = adapter
+    return adapter
+
+
+def get_adapter(name):
+    if name not in ADAPTERS:
+        raise KeyError('no adapter %s, registered: %s' % (name, sorted(ADAPTERS)))
+    return ADAPTERS[name]
+
+
+def _get_russian_excess(cities):
+    morbidity = russia.get_daily_morbidity(cities)
+    return russia.get_relative_weekly_morbidity_excess(
+        russia.get_morbidity_excess(morbidity, russia.get_morbidity_mean(morbidity)),
+        russia.get_population(cities))
+
+
+FLU_DBASE = {
+    'ah': {'layout': 'site_files', 'pattern': russia.AH_FILE_PATTERN, 'column': 'Humidity'},
+    'temperature': {'layout': 'site_files', 'pattern': russia.AH_FILE_PATTERN,
+                    'column': 'Temperature'},
+    'incidence': {'layout': 'site_files', 'pattern': russia.AH_FILE_PATTERN,
+                  'column': 'Incidence'},
+    'is_epidemic': {'layout': 'site_files', 'pattern': russia.AH_FILE_PATTERN,
+                    'column': 'IsEpidemic'},
+}
+
+register(Adapter(
+    'usa', usa.CONTIGUOUS_STATES, lambda: usa.get_state_resolver(usa.STATE_CODES_FILE),
+    variables={
+        'ah': {'layout': 'wide_csv', 'file': usa.AH_CSV_FILE},
+        'excess': {'layout': 'records', 'resolution': 'weekly',
+                   'file': usa.MORTALITY_EXCESS_FILE, 'site_field': 0, 'date_field': 2,
+                   'value_field': -1, 'parse_site': int,
+                   'parse_date': lambda field: usa.get_date_from_week_index(int(field)),
+                   'scale': 1 / 7},
+    },
+    excess=lambda sites: usa.get_mortality_excess(usa.MORTALITY_EXCESS_FILE, sites),
+    detect_onsets=usa.get_onsets, get_events=get_mortality_events,
+    get_threshold_table=ThresholdTable.from_mortality_excess))
+
+register(Adapter(
+    'russia', russia.CITIES, russia.get_city_resolver, FLU_DBASE,
+    excess=_get_russian_excess, detect_onsets=russia.get_onsets_by_morbidity,
+    get_events=get_morbidity_events, get_threshold_table=ThresholdTable.from_morbidity_excess))
+
+register(Adapter(
+    'paris', russia.PARIS, russia.get_city_resolver, FLU_DBASE,
+    excess=_get_russian_excess, detect_onsets=russia.get_onsets_by_morbidity,
+    get_events=get_morbidity_events, get_threshold_table=ThresholdTable.from_morbidity_excess))
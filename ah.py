@@ -11,6 +11,8 @@ import matplotlib
 import matplotlib.dates as plt_dates
 import pylab as plt
 
+from render import ah_dev_spec, draw_ah_dev
+
 
 def get_ah_mean(ah):
     """
@@ -58,17 +60,13 @@ def get_ah_deviation(ah, ah_mean):
 
 
 def get_ah_mean_for_site(ah_mean, cite_name):
-    result = []
-
-    for date, info in sorted(
-            ah_mean.items(),
-            key=lambda x: int(x[0][0:2]) + 31*int(x[0][3:5])
-    ):
-        for site, value in info.items():
-            if site != cite_name:
-                continue
-            result.append(value)
-    return result
+    """
+    For many sites or repeated queries use store.DailyStore.profile
+    """
+    return [ah_mean[day_month][cite_name]
+            for day_month in sorted(ah_mean.keys(),
+                                    key=lambda x: int(x[0:2]) + 31*int(x[3:5]))
+            if cite_name in ah_mean[day_month]]
 
 
 def draw_ah_mean(ah_mean, sites, colors):
@@ -120,29 +118,8 @@ def plot_average_ah_dev(average_ah_dev, colors, date_shift_range,
     fig = plt.figure(figsize=(10, 6))
     matplotlib.rcParams.update({'font.size': 14})
 
-    fig.add_subplot(111)
-    if title:
-        plt.title(title)
-    plt.xlabel('Day Relative to Onset')
-    plt.ylabel('Absolute Humidity Anomaly (kg/kg)')
-
-    # Equal axis range
-    plt.ylim(limits)
-
-    # Enable scaling and 10^k formatting
-    xfmt = plt.ScalarFormatter(useMathText=True)
-    xfmt.set_powerlimits((0, 0))
-    plt.gca().yaxis.set_major_formatter(xfmt)
-
-    # Dashed line for AH' = 0
-    plt.plot((date_shift_range[0], date_shift_range[-1]), (0, 0), 'k--')
-
-    for threshold, average in average_ah_dev.items():
-        plt.plot(date_shift_range, average,
-                 colors.get(threshold, '') + '-', label=str(threshold))
-
-    if len(average_ah_dev.keys()) > 1:  # One threshold => omit a legend
-        plt.legend(loc='best', fancybox=True, shadow=True)
+    draw_ah_dev(fig, ah_dev_spec(average_ah_dev, colors, date_shift_range,
+                                 limits=limits, title=title))
 
     if save_to_file:
         os.makedirs(os.path.dirname('./' + save_to_file), exist_ok=True)
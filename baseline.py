@@ -0,0 +1,137 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Baseline climatologies that leave the analysed year out of its own
+    mean, unlike ah.get_ah_mean and russia.get_morbidity_mean:
+        'all'            all years, the current behaviour
+        'leave_one_out'  all years but the year itself
+        'trailing'       `window` years before the year
+        'centred'        window // 2 years on each side of the year,
+                         the year itself excluded
+    Sums and counts are kept by (year, day of year, site), and running sums
+    over years give every window in O(1), so the cost is linear in the data.
+    29.02 has its own day of year, as the 'dd.mm' keys of the dict means.
+"""
+import datetime
+
+import numpy as np
+
+from store import get_month_day, parse_date
+
+BASELINES = ('all', 'leave_one_out', 'trailing', 'centred')
+DAYS_IN_LEAP_YEAR = 366
+
+
+def _get_day_slot(month, day):
+    """Day of a leap year, 0..365"""
+    offsets = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])
+    return offsets[np.asarray(month) - 1] + np.asarray(day) - 1
+
+
+def get_year_grid(ordinals, values):
+    """
+    :param ordinals: array of date.toordinal()
+    :param values: array (date x site), NaN for gaps
+    :return: (array of years, sums and counts, arrays (year x 366 x site),
+        array of year rows, array of day slots) of every date
+    """
+    ordinals = np.asarray(ordinals, dtype=int)
+    values = np.asarray(values, dtype=float)
+    month, day = get_month_day(ordinals)
+    date_years = np.array([datetime.date.fromordinal(int(x)).year for x in ordinals], dtype=int)
+    years = np.arange(date_years.min(), date_years.max() + 1) if len(ordinals) \
+        else np.zeros(0, dtype=int)
+
+    year_rows, slots = date_years - (years[0] if len(years) else 0), _get_day_slot(month, day)
+    valid = ~np.isnan(values)
+    sums = np.zeros((len(years), DAYS_IN_LEAP_YEAR, values.shape[1]))
+    counts = np.zeros(sums.shape)
+    np.add.at(sums, (year_rows, slots), np.where(valid, values, 0.))
+    np.add.at(counts, (year_rows, slots), valid)
+    return years, sums, counts, year_rows, slots
+
+
+def get_baseline(sums, counts, mode='leave_one_out', window=None):
+    """
+    :param sums: array (year x 366 x site), see get_year_grid
+    :param mode: one of BASELINES
+    :param window: int, years of the trailing and centred baselines
+    :return: array (year x 366 x site), baseline mean of every year,
+        NaN where the window has no data
+    """
+    if mode not in BASELINES:
+        raise ValueError('unknown baseline %s, use one of %s' % (mode, BASELINES))
+    if mode in ('trailing', 'centred') and not window:
+        raise ValueError('%s baseline needs a window of years' % mode)
+
+    # Running sums over years, a zero row in front: cumulative[y] = sum of years < y
+    zero = np.zeros((1, ) + sums.shape[1:])
+    cumulative_sums = np.concatenate((zero, np.cumsum(sums, axis=0)))
+    cumulative_counts = np.concatenate((zero, np.cumsum(counts, axis=0)))
+
+    def window_sums(first, last):  # Years [first, last), clipped
+        first = np.clip(first, 0, len(sums))
+        last = np.clip(last, 0, len(sums))
+        return cumulative_sums[last] - cumulative_sums[first], \
+            cumulative_counts[last] - cumulative_counts[first]
+
+    year = np.arange(len(sums))
+    if mode == 'all':
+        total, count = window_sums(np.zeros_like(year), np.full_like(year, len(sums)))
+    elif mode == 'leave_one_out':
+        total, count = window_sums(np.zeros_like(year), np.full_like(year, len(sums)))
+        total, count = total - sums, count - counts
+    elif mode == 'trailing':
+        total, count = window_sums(year - window, year)
+    else:
+        before = window_sums(year - window // 2, year)
+        after = window_sums(year + 1, year + 1 + window // 2)
+        total, count = before[0] + after[0], before[1] + after[1]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return total / count
+
+
+def get_deviation(ordinals, values, mode='leave_one_out', window=None):
+    """
+    :param values: array (date x site)
+    :return: array (date x site), values minus their baseline
+    """
+    years, sums, counts, year_rows, slots = get_year_grid(ordinals, values)
+    baseline = get_baseline(sums, counts, mode, window)
+    return np.asarray(values, dtype=float) - baseline[year_rows, slots]
+
+
+def get_ah_deviation(ah, mode='leave_one_out', window=None):
+    """
+    Drop-in for ah.get_ah_deviation(ah, get_ah_mean(ah)); means are per site,
+    while get_ah_mean divides by the dates of all sites
+    :param ah: dict, data['dd.mm.year']['Site Name'] = absolute humidity
+    :return: dict, data['dd.mm.year']['Site Name'] = deviation from the baseline
+    """
+    dates = list(ah.keys())
+    sites = sorted(set(site for info in ah.values() for site in info))
+    site_index = {site: idx for idx, site in enumerate(sites)}
+    values = np.array([[float(ah[date][site]) if site in ah[date] else np.nan for site in sites]
+                       for date in dates]).reshape(len(dates), len(sites))
+    deviation = get_deviation([parse_date(date).toordinal() for date in dates], values,
+                              mode, window)
+    return {date: {site: float(deviation[row, site_index[site]]) for site in ah[date]}
+            for row, date in enumerate(dates)}
+
+
+def get_morbidity_excess(morbidity, mode='leave_one_out', window=None):
+    """
+    Drop-in for russia.get_morbidity_excess(morbidity, get_morbidity_mean(morbidity))
+    :param morbidity: dict, dict['City Code']['dd.mm.year'] = absolute morbidity
+    :return: dict, data['City Code']['dd.mm.year'] = deviation from the baseline
+    """
+    excess = dict()
+    for city, info in morbidity.items():
+        dates = list(info.keys())
+        deviation = get_deviation([parse_date(date).toordinal() for date in dates],
+                                  np.array([[float(info[date])] for date in dates]).reshape(-1, 1),
+                                  mode, window)
+        excess[city] = type(info)(zip(dates, deviation[:, 0].tolist()))
+    return excess
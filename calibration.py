@@ -0,0 +1,236 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Threshold calibration: the threshold giving a target number of onsets,
+    or of epidemics per winter, for every site or a group of sites.
+
+    An onset needs two consecutive weeks at or above the threshold, so a
+    winter has an onset iff the peak over its weeks of min(prev2, prev1)
+    is at or above it. These season scores are computed once and sorted,
+    then a count is a bisection (np.searchsorted) and a calibrated
+    threshold is an index into the table; get_onsets_by_morbidity is not
+    rerun per candidate.
+
+    Counts match the detectors exactly while a winter is at most half a
+    year long. In longer winters the cutoff of a second onset within
+    winter.days_count may drop an onset early in the next winter, so the
+    table keeps the eligible weeks and applies the cutoff sequentially,
+    as the detectors do, and a calibration scans the season scores.
+"""
+import datetime
+
+import numpy as np
+
+from onset import Winter
+from store import EPOCH_ORDINAL, get_month_day
+from stream import get_morbidity_detector, get_mortality_detector
+
+EXACT_DAYS = 183  # Longest winter whose seasons are a winter length apart
+
+
+def _get_month_days(ordinals):
+    month, day = get_month_day(ordinals)
+    return month * 100 + day
+
+
+def get_week_scores(ordinals, values, winter=Winter(), after=None, before=None):
+    """
+    :param ordinals: array of date.toordinal() of weeks, sorted
+    :param values: array of weekly excess
+    :param after: datetime.date, no onsets up to this date inclusive
+    :param before: datetime.date, no onsets from this date on
+    :return: (array of ordinals, array of season start years, array of
+        scores) of the weeks eligible for an onset
+    """
+    ordinals = np.asarray(ordinals, dtype=int)[2:]
+    values = np.asarray(values, dtype=float)
+    scores = np.fmin(values[:-2], values[1:-1]) if len(values) > 2 else np.zeros(0)
+
+    month_days = _get_month_days(ordinals)
+    start = winter.START.month * 100 + winter.START.day
+    end = winter.END.month * 100 + winter.END.day
+    eligible = (month_days >= start) | (month_days <= end)  # onset.Winter.is_winter
+    if after is not None:
+        eligible &= ordinals > after.toordinal()
+    if before is not None:
+        eligible &= ordinals < before.toordinal()
+
+    years = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[Y]') \
+        .astype(int) + 1970
+    seasons = np.where(month_days >= start, years, years - 1)
+    return ordinals[eligible], seasons[eligible], scores[eligible]
+
+
+def get_season_scores(ordinals, values, winter=Winter(), after=None, before=None):
+    """
+    :return: (array of season start years, array of season scores), seasons
+        with no week eligible for an onset are left out, see get_week_scores
+    """
+    _, seasons, scores = get_week_scores(ordinals, values, winter, after, before)
+    return _get_season_peaks(seasons, scores)
+
+
+def _get_season_peaks(seasons, scores):
+    if not len(seasons):
+        return np.zeros(0, dtype=int), np.zeros(0)
+
+    unique, inverse = np.unique(seasons, return_inverse=True)
+    peaks = np.full(len(unique), np.nan)
+    np.fmax.at(peaks, inverse, scores)
+    return unique, np.where(np.isnan(peaks), -np.inf, peaks)
+
+
+def count_onsets(ordinals, scores, threshold, cutoff):
+    """
+    Onsets of the eligible weeks at the threshold, with the detectors'
+    cutoff of a second onset within cutoff days
+    :param ordinals: array of eligible week ordinals, sorted, see get_week_scores
+    """
+    count, last = 0, None
+    for ordinal in ordinals[scores >= threshold]:
+        if last is None or ordinal - last >= cutoff:
+            count, last = count + 1, ordinal
+    return count
+
+
+class ThresholdTable:
+    """
+    scores: dict, site -> array of season scores, sorted ascending
+    seasons: dict, site -> number of winters with eligible weeks
+    weeks: dict, site -> (ordinals, scores) of eligible weeks, only for
+        winters longer than EXACT_DAYS, None otherwise
+    cutoff: int, days of the cutoff of a second onset, with weeks
+    """
+
+    def __init__(self, scores, seasons, weeks=None, cutoff=None):
+        self.sites = list(scores)
+        self.scores = {site: np.sort(scores[site]) for site in self.sites}
+        self.seasons = dict(seasons)
+        self.weeks = weeks
+        self.cutoff = cutoff
+
+    @classmethod
+    def from_weekly(cls, weekly, winter=Winter(), after=None, before=None):
+        """
+        :param weekly: dict, site -> (array of ordinals, array of values)
+        """
+        exact = winter.days_count > EXACT_DAYS
+        scores, seasons, weeks = dict(), dict(), dict()
+        for site, (ordinals, values) in weekly.items():
+            order = np.argsort(ordinals, kind='mergesort')
+            week_ordinals, years, week_scores = get_week_scores(
+                np.asarray(ordinals)[order], np.asarray(values, dtype=float)[order],
+                winter, after, before)
+            years, scores[site] = _get_season_peaks(years, week_scores)
+            seasons[site] = len(years)
+            weeks[site] = (week_ordinals, week_scores)
+        if exact:
+            return cls(scores, seasons, weeks, winter.days_count)
+        return cls(scores, seasons)
+
+    @classmethod
+    def from_morbidity_excess(cls, excess_data, winter=Winter()):
+        """
+        :param excess_data: dict, see russia.get_relative_weekly_morbidity_excess
+        """
+        detector = get_morbidity_detector([], winter)
+        return cls.from_weekly(
+            {city: ([datetime.datetime.strptime(date, '%d.%m.%Y').toordinal() for date in info],
+                    list(info.values()))
+             for city, info in excess_data.items()},
+            winter, detector.after, detector.before)
+
+    @classmethod
+    def from_mortality_excess(cls, excess_data, winter=Winter()):
+        """
+        :param excess_data: dict, see usa.get_mortality_excess
+        """
+        detector = get_mortality_detector([], winter)
+        return cls.from_weekly(
+            {state: ([week['date'].toordinal() for week in weeks],
+                     [week['excess'] for week in weeks])
+             for state, weeks in excess_data.items()},
+            winter, detector.after, detector.before)
+
+    def _group(self, sites):
+        sites = self.sites if sites is None else sites
+        return np.sort(np.concatenate([self.scores[site] for site in sites] + [np.zeros(0)]))
+
+    def _count(self, site, threshold):
+        if self.weeks is not None:
+            ordinals, scores = self.weeks[site]
+            return count_onsets(ordinals, scores, threshold, self.cutoff)
+        return len(self.scores[site]) - \
+            int(np.searchsorted(self.scores[site], threshold, side='left'))
+
+    def count(self, threshold, sites=None):
+        """
+        :return: dict, site -> number of onsets at the threshold
+        """
+        sites = self.sites if sites is None else sites
+        return {site: self._count(site, threshold) for site in sites}
+
+    def group_count(self, threshold, sites=None):
+        """
+        :return: int, number of onsets of all the sites at the threshold
+        """
+        if self.weeks is not None:
+            return sum(self.count(threshold, sites).values())
+        scores = self._group(sites)
+        return len(scores) - int(np.searchsorted(scores, threshold, side='left'))
+
+    def _select(self, scores, target, sites):
+        """
+        Highest threshold with at least target onsets of the sites, NaN if
+        none, inf for target <= 0 as no onsets are wanted
+        """
+        target = int(target)
+        if target <= 0:
+            return np.inf
+        if self.weeks is not None:
+            # The cutoff may drop onsets, a count is no longer an index of the scores
+            for threshold in np.unique(scores[scores > -np.inf])[::-1]:
+                if sum(self._count(site, threshold) for site in sites) >= target:
+                    return float(threshold)
+            return np.nan
+        if target > len(scores) or scores[-target] == -np.inf:
+            return np.nan
+        return float(scores[-target])
+
+    def calibrate(self, target, sites=None):
+        """
+        :param target: int, onsets wanted per site
+        :return: dict, site -> highest threshold with at least target onsets
+            (exactly target unless seasons tie), NaN if unreachable, inf
+            for target <= 0
+        """
+        sites = self.sites if sites is None else sites
+        return {site: self._select(self.scores[site], target, [site]) for site in sites}
+
+    def calibrate_group(self, target, sites=None):
+        """
+        :return: float, one threshold giving the group target onsets in
+            total, NaN if unreachable, inf for target <= 0
+        """
+        sites = self.sites if sites is None else sites
+        return self._select(self._group(sites), target, sites)
+
+    def calibrate_rate(self, rate, sites=None):
+        """
+        :param rate: float, epidemics per winter, e.g. 0.5 for every second one
+        :return: dict, site -> threshold, see calibrate, inf for rate 0
+        """
+        sites = self.sites if sites is None else sites
+        return {site: self._select(self.scores[site], np.ceil(rate * self.seasons[site] - 1e-9),
+                                   [site])
+                for site in sites}
+
+    def calibrate_group_rate(self, rate, sites=None):
+        """
+        :return: float, one threshold giving the group `rate` epidemics per
+            site and winter, see calibrate_group
+        """
+        sites = self.sites if sites is None else sites
+        seasons = sum(self.seasons[site] for site in sites)
+        return self._select(self._group(sites), np.ceil(rate * seasons - 1e-9), sites)
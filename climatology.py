@@ -0,0 +1,137 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Harmonic climatology: a few annual harmonics per site instead of the
+    365 per-day means of ah.get_ah_mean,
+        mean(t) = a0 + sum_k (a_k cos(2 pi k t) + b_k sin(2 pi k t)),
+    t in years since 01.01.1970. Time runs over real dates, so 29.02 needs
+    no special case. Only (2 k + 1) x site coefficients are stored and AH'
+    of any date range is evaluated on the fly.
+"""
+import datetime
+
+import numpy as np
+
+from store import EPOCH_ORDINAL, parse_date
+
+YEAR_LENGTH = 365.2425  # days, mean Gregorian year
+HARMONICS = 3
+
+
+def get_design_matrix(ordinals, harmonics=HARMONICS):
+    """
+    :param ordinals: array of date.toordinal()
+    :return: array (date x 2 * harmonics + 1): 1, cos, sin of every harmonic
+    """
+    t = (np.asarray(ordinals, dtype=float) - EPOCH_ORDINAL) / YEAR_LENGTH
+    phases = 2 * np.pi * t[:, None] * np.arange(1, harmonics + 1)[None, :]
+    return np.hstack((np.ones((len(t), 1)), np.cos(phases), np.sin(phases)))
+
+
+class HarmonicClimatology:
+    """
+    coefficients: array (2 * harmonics + 1 x site)
+    """
+
+    def __init__(self, coefficients, sites, harmonics=HARMONICS):
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.sites = list(sites)
+        self.site_index = {site: idx for idx, site in enumerate(self.sites)}
+        self.harmonics = harmonics
+
+    @classmethod
+    def fit(cls, ordinals, values, sites, harmonics=HARMONICS):
+        """
+        Least squares for all sites at once, NaN values are left out
+        :param values: array (date x site)
+        """
+        design = get_design_matrix(ordinals, harmonics)
+        values = np.asarray(values, dtype=float)
+        valid = ~np.isnan(values)
+
+        if valid.all():
+            coefficients = np.linalg.lstsq(design, values, rcond=None)[0]
+        else:
+            # Normal equations of every site with its own gaps: site x p x p
+            weights = valid.astype(float)
+            gram = np.einsum('ds,di,dj->sij', weights, design, design)
+            moments = np.einsum('ds,di->si', np.where(valid, values, 0.), design)
+            coefficients = np.linalg.solve(gram, moments[:, :, None])[:, :, 0].T
+        return cls(coefficients, sites, harmonics)
+
+    @classmethod
+    def from_store(cls, store, harmonics=HARMONICS):
+        """
+        :param store: store.DailyStore, e.g. of absolute humidity
+        """
+        return cls.fit(store.ordinals, store.values, store.sites, harmonics)
+
+    @classmethod
+    def from_ah(cls, ah, harmonics=HARMONICS):
+        """
+        :param ah: dict, dict['dd.mm.year']['Site Name'] = absolute humidity
+        """
+        dates = list(ah.keys())
+        sites = sorted(set(site for info in ah.values() for site in info))
+        values = np.array([[ah[date].get(site, np.nan) for site in sites] for date in dates],
+                          dtype=float)
+        return cls.fit([parse_date(date).toordinal() for date in dates], values, sites, harmonics)
+
+    def _columns(self, sites):
+        if sites is None:
+            return slice(None)
+        return [self.site_index[site] for site in sites]
+
+    def evaluate(self, ordinals, sites=None):
+        """
+        :param ordinals: array of date.toordinal(), 29.02 included
+        :return: array (date x site), climatological mean
+        """
+        return get_design_matrix(ordinals, self.harmonics) @ self.coefficients[:, self._columns(sites)]
+
+    def deviation(self, ordinals, values, sites=None):
+        """
+        :param values: array (date x site) of the sites
+        :return: array (date x site), values minus the climatology
+        """
+        return np.asarray(values, dtype=float) - self.evaluate(ordinals, sites)
+
+    def store_deviation(self, store, start=None, end=None, sites=None):
+        """
+        AH' of a date range of a store, what store.DailyStore.slice(anomaly=True)
+        returns with the per-day mean
+        :return: (dates, array (date x site))
+        """
+        sites = self.sites if sites is None else list(sites)
+        first, last = store.row_range(start, end)
+        values = store.values[first:last, store.columns(sites)]
+        return store.dates[first:last], self.deviation(store.ordinals[first:last], values, sites)
+
+    def get_ah_deviation(self, ah):
+        """
+        :param ah: dict, data['dd.mm.year']['Site Name'] = absolute humidity
+        :return: dict, what ah.get_ah_deviation returns with the harmonic mean
+        """
+        dates = list(ah.keys())
+        means = self.evaluate([parse_date(date).toordinal() for date in dates])
+        return {date: {site: float(humidity) - float(means[row, self.site_index[site]])
+                       for site, humidity in ah[date].items()}
+                for row, date in enumerate(dates)}
+
+    def profile(self, sites=None, year=1971):
+        """
+        :return: array (365 x site), climatology over a year without 29.02,
+            as store.DailyStore.profile
+        """
+        first = datetime.date(year, 1, 1).toordinal()
+        return self.evaluate(np.arange(first, first + 365), sites)
+
+    def save(self, filename):
+        np.savez(filename, coefficients=self.coefficients, sites=np.array(self.sites),
+                 harmonics=self.harmonics)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['coefficients'], data['sites'].tolist(), int(data['harmonics']))
@@ -0,0 +1,148 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Experiments as a DAG of stages (parse -> climatology -> anomalies ->
+    excess -> onsets -> samples -> tests -> plots).
+
+    A stage is a function call whose arguments may be other stages.
+    Stages with the same function and arguments are merged across
+    experiments, independent branches run concurrently on a thread pool
+    (stages share big in-memory arrays, so threads and not processes),
+    and an intermediate result is dropped once its last consumer is done.
+"""
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import os
+
+import numpy as np
+
+from metrics import timed
+
+
+class Stage:
+    """
+    Deferred func(*args, **kwargs), Stage arguments are dependencies
+    """
+
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.deps = [value for value in list(args) + list(kwargs.values())
+                     if isinstance(value, Stage)]
+        self.key = (func.__module__, func.__qualname__,
+                    _freeze(args), _freeze(sorted(kwargs.items())))
+
+    @property
+    def name(self):
+        return self.func.__qualname__
+
+    def __repr__(self):
+        return 'Stage(%s)' % self.name
+
+
+def _freeze(value):
+    """Hashable identity of an argument, equal for equal arguments"""
+    if isinstance(value, Stage):
+        return 'Stage', value.key
+    if isinstance(value, (str, int, float, bool, type(None))):
+        return value
+    if isinstance(value, np.ndarray):
+        return 'ndarray', value.shape, value.dtype.str, value.tobytes()
+    if isinstance(value, range):
+        return 'range', value.start, value.stop, value.step
+    if isinstance(value, dict):
+        return 'dict', tuple((_freeze(key), _freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return 'set', tuple(sorted(repr(_freeze(item)) for item in value))
+    if hasattr(value, '__dict__'):  # e.g. Winter with its START and END
+        return type(value).__qualname__, _freeze(sorted(vars(value).items()))
+    return type(value).__qualname__, repr(value)
+
+
+def get_plan(targets):
+    """
+    :param targets: list of Stage
+    :return: OrderedDict, key -> Stage, merged nodes in dependency order
+    """
+    nodes = OrderedDict()
+
+    def visit(stage):
+        if stage.key in nodes:
+            return
+        for dep in stage.deps:
+            visit(dep)
+        nodes[stage.key] = stage
+
+    for target in targets:
+        visit(target)
+    return nodes
+
+
+def run(targets, workers=None, verbose=True, progress=None):
+    """
+    :param targets: list of Stage, e.g. a plot or a test per experiment
+    :param workers: int, threads, None for the executor default
+    :param progress: metrics.Progress, its total and workers are set to
+        the stages and threads, advanced with the busy time of every stage
+    :return: list of target results, in order of targets
+    """
+    nodes = get_plan(targets)
+    if progress:
+        progress.total = len(nodes)
+        progress.workers = workers or min(32, (os.cpu_count() or 1) + 4)  # The executor default
+    target_keys = set(target.key for target in targets)
+
+    deps = {key: set(dep.key for dep in node.deps) for key, node in nodes.items()}
+    children = {key: [] for key in nodes}
+    for key, node_deps in deps.items():
+        for dep in node_deps:
+            children[dep].append(key)
+    waiting = {key: len(node_deps) for key, node_deps in deps.items()}
+    consumers = {key: len(children[key]) for key in nodes}
+
+    if verbose:
+        print(f'{len(nodes)} stages to run')
+    results = dict()
+
+    def resolve(value):
+        return results[value.key] if isinstance(value, Stage) else value
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = dict()
+
+        def submit(key):
+            node = nodes[key]
+            args = [resolve(value) for value in node.args]
+            kwargs = {name: resolve(value) for name, value in node.kwargs.items()}
+            futures[executor.submit(timed, node.func, *args, **kwargs)] = key
+
+        for key, count in waiting.items():
+            if count == 0:
+                submit(key)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                key = futures.pop(future)
+                results[key], seconds = future.result()
+                if progress:
+                    progress.advance(busy_seconds=seconds)
+                if verbose:
+                    print(f'Stage {nodes[key].name} done')
+
+                # Free intermediate results nobody needs anymore
+                for dep in deps[key]:
+                    consumers[dep] -= 1
+                    if consumers[dep] == 0 and dep not in target_keys:
+                        del results[dep]
+
+                for child in children[key]:
+                    waiting[child] -= 1
+                    if waiting[child] == 0:
+                        submit(child)
+
+    return [results[target.key] for target in targets]
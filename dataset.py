@@ -0,0 +1,353 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Datasets of the drivers (USA, Russia, Paris) as objects: the resolver,
+    AH, its mean and deviation, the AH store and the excess are computed on
+    first access and kept in memory. Onsets depend on thresholds and winter
+    and sit in a bounded LRU. Any result can be released explicitly.
+
+    >>> usa = USA()
+    >>> onsets = usa.onsets([0.02], get_winter(10, 3))
+    >>> get_average_ah_vs_onsets(usa.ah_dev, onsets, usa.sites, [0.02], ...)
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+from adapters import get_adapter
+from ah import get_ah_deviation, get_ah_mean
+import baseline
+from baseline import BASELINES
+from calibration import ThresholdTable
+from climatology import HarmonicClimatology
+from events import get_morbidity_events, get_mortality_events
+from onset import Winter
+from pyramid import Pyramid
+from seasonality import OnsetCube
+import russia
+import usa
+
+ONSETS_CACHE_SIZE = 16
+
+
+def lazy(method):
+    """
+    Read-only property computed once, until Dataset.release(name)
+    """
+    name = method.__name__
+
+    def getter(self):
+        if name not in self._cache:
+            self._cache[name] = method(self)
+        return self._cache[name]
+
+    getter.__doc__ = method.__doc__
+    return property(getter)
+
+
+class Dataset:
+    """
+    Subclasses define resolver, ah, ah_store, excess and _get_onsets
+    """
+    sites = []
+
+    def __init__(self, onsets_cache_size=ONSETS_CACHE_SIZE, baseline_mode='all', baseline_window=None):
+        """
+        :param baseline_mode: str, climatology of AH' (dict and store) and
+            morbidity excess, one of baseline.BASELINES, 'all' is the
+            all-years mean of the drivers
+        :param baseline_window: int, years of 'trailing' and 'centred' baselines
+        """
+        if baseline_mode not in BASELINES:
+            raise ValueError('unknown baseline %s, use one of %s' % (baseline_mode, BASELINES))
+        self.onsets_cache_size = onsets_cache_size
+        self.baseline_mode = baseline_mode
+        self.baseline_window = baseline_window
+        self._cache = dict()
+        self._onsets = OrderedDict()
+
+    @lazy
+    def ah_mean(self):
+        """dict['dd.mm']['Site Name'], see ah.get_ah_mean"""
+        return get_ah_mean(self.ah)
+
+    @lazy
+    def ah_dev(self):
+        """dict['dd.mm.year']['Site Name'], see ah.get_ah_deviation"""
+        if self.baseline_mode != 'all':
+            return baseline.get_ah_deviation(self.ah, self.baseline_mode, self.baseline_window)
+        return get_ah_deviation(self.ah, self.ah_mean)
+
+    def _with_baseline(self, store):
+        """
+        :param store: store.DailyStore, its AH' (dev) is replaced by the
+            deviation from the baseline, so store-based engines follow it
+        """
+        if self.baseline_mode != 'all':
+            store.dev = np.asfortranarray(baseline.get_deviation(
+                store.ordinals, store.values, self.baseline_mode, self.baseline_window))
+        return store
+
+    @lazy
+    def ah_climatology(self):
+        """climatology.HarmonicClimatology of absolute humidity"""
+        if self.baseline_mode != 'all':
+            raise ValueError('harmonic climatology is a baseline of its own, not %s'
+                             % self.baseline_mode)
+        return HarmonicClimatology.from_store(self.ah_store)
+
+    @lazy
+    def ah_pyramid(self):
+        """pyramid.Pyramid of absolute humidity"""
+        return Pyramid.from_store(self.ah_store)
+
+    @lazy
+    def ah_dev_pyramid(self):
+        """pyramid.Pyramid of AH'"""
+        return Pyramid.from_store(self.ah_store, anomaly=True)
+
+    def _get_onsets(self, thresholds, winter):
+        raise NotImplementedError
+
+    def onsets(self, thresholds, winter=None):
+        """
+        :param winter: onset.Winter, Winter() by default
+        :return: dict, dict[threshold][site] = list of onset dates
+        """
+        key = _get_onsets_key(thresholds, winter or Winter())
+        if key in self._onsets:
+            self._onsets.move_to_end(key)
+            return self._onsets[key]
+
+        onsets = self._get_onsets(list(thresholds), winter or Winter())
+        self._onsets[key] = onsets
+        while len(self._onsets) > self.onsets_cache_size:
+            self._onsets.popitem(last=False)  # Least recently used
+        return onsets
+
+    def events(self, thresholds, winter=None):
+        """
+        :return: (array of events.EVENT_DTYPE, list of sites): onset, peak,
+            end, duration and size of every epidemic
+        """
+        raise NotImplementedError
+
+    def threshold_table(self, winter=None):
+        """
+        :return: calibration.ThresholdTable of the excess, for thresholds
+            giving a number or rate of onsets
+        """
+        raise NotImplementedError
+
+    def onset_cube(self, thresholds, winter=None):
+        """
+        :return: seasonality.OnsetCube of the sites, from the cached onsets
+        """
+        return OnsetCube.from_onsets(self.onsets(thresholds, winter), thresholds, self.sites)
+
+    def cached(self):
+        """
+        :return: list of names of computed properties and onset keys
+        """
+        return list(self._cache) + [('onsets', ) + key for key in self._onsets]
+
+    def release(self, name=None, thresholds=None, winter=None):
+        """
+        Drop computed results, everything by default
+        :param name: str, property name such as 'ah_dev', or 'onsets' for
+            all onsets or only these of thresholds and winter
+        """
+        if name is None:
+            self._cache.clear()
+            self._onsets.clear()
+        elif name != 'onsets':
+            self._cache.pop(name, None)
+        elif thresholds is None:
+            self._onsets.clear()
+        else:
+            self._onsets.pop(_get_onsets_key(thresholds, winter or Winter()), None)
+
+
+def _get_onsets_key(thresholds, winter):
+    return tuple(thresholds), winter.START, winter.END
+
+
+class USA(Dataset):
+    sites = usa.CONTIGUOUS_STATES
+
+    def __init__(self, ah_csv_file=usa.AH_CSV_FILE, state_codes_file=usa.STATE_CODES_FILE,
+                 mortality_excess_file=usa.MORTALITY_EXCESS_FILE,
+                 onsets_cache_size=ONSETS_CACHE_SIZE, baseline_mode='all', baseline_window=None):
+        super().__init__(onsets_cache_size, baseline_mode, baseline_window)
+        self.ah_csv_file = ah_csv_file
+        self.state_codes_file = state_codes_file
+        self.mortality_excess_file = mortality_excess_file
+
+    @lazy
+    def resolver(self):
+        return usa.get_state_resolver(self.state_codes_file)
+
+    @lazy
+    def ah(self):
+        return usa.get_ah(self.ah_csv_file)
+
+    @lazy
+    def ah_store(self):
+        """store.DailyStore, columns are 'State Name'"""
+        return self._with_baseline(usa.get_ah_store(self.ah_csv_file))
+
+    @lazy
+    def excess(self):
+        """dict[state] = list of weekly {'population', 'date', 'excess'}"""
+        return usa.get_mortality_excess(self.mortality_excess_file)
+
+    def _get_onsets(self, thresholds, winter):
+        return usa.get_onsets(self.excess, thresholds, winter)
+
+    def events(self, thresholds, winter=None):
+        return get_mortality_events(self.excess, thresholds, winter or Winter())
+
+    def threshold_table(self, winter=None):
+        return ThresholdTable.from_mortality_excess(self.excess, winter or Winter())
+
+
+class Russia(Dataset):
+    sites = russia.CITIES
+
+    def __init__(self, cities=None, onsets_cache_size=ONSETS_CACHE_SIZE, baseline_mode='all',
+                 baseline_window=None):
+        super().__init__(onsets_cache_size, baseline_mode, baseline_window)
+        if cities is not None:
+            self.sites = list(cities)
+
+    @lazy
+    def resolver(self):
+        return russia.get_city_resolver()
+
+    @lazy
+    def ah(self):
+        return russia.get_ah(self.sites)
+
+    @lazy
+    def ah_store(self):
+        """store.DailyStore, columns are 'City Name'"""
+        return self._with_baseline(russia.get_ah_store(self.sites))
+
+    @lazy
+    def population(self):
+        return russia.get_population(self.sites)
+
+    @lazy
+    def morbidity(self):
+        return russia.get_daily_morbidity(self.sites)
+
+    @lazy
+    def morbidity_excess(self):
+        """Daily morbidity minus its baseline mean for that date"""
+        if self.baseline_mode != 'all':
+            return baseline.get_morbidity_excess(self.morbidity, self.baseline_mode,
+                                                 self.baseline_window)
+        return russia.get_morbidity_excess(
+            self.morbidity, russia.get_morbidity_mean(self.morbidity))
+
+    @lazy
+    def excess(self):
+        """Weekly morbidity excess per 100,000 people"""
+        return russia.get_relative_weekly_morbidity_excess(
+            self.morbidity_excess, self.population)
+
+    @lazy
+    def morbidity_pyramid(self):
+        """pyramid.Pyramid of daily morbidity"""
+        return Pyramid.from_series(self.morbidity)
+
+    @lazy
+    def morbidity_excess_pyramid(self):
+        """pyramid.Pyramid of daily morbidity excess"""
+        return Pyramid.from_series(self.morbidity_excess)
+
+    def _get_onsets(self, thresholds, winter):
+        return russia.get_onsets_by_morbidity(self.excess, thresholds, winter)
+
+    def events(self, thresholds, winter=None):
+        return get_morbidity_events(self.excess, thresholds, winter or Winter())
+
+    def threshold_table(self, winter=None):
+        return ThresholdTable.from_morbidity_excess(self.excess, winter or Winter())
+
+
+class Paris(Russia):
+    sites = russia.PARIS
+
+
+class AdapterDataset(Dataset):
+    """
+    Dataset of any registered adapters.Adapter, variables are loaded only
+    for its sites
+    """
+
+    def __init__(self, adapter, sites=None, onsets_cache_size=ONSETS_CACHE_SIZE, baseline_mode='all',
+                 baseline_window=None, workers=None):
+        """
+        :param adapter: str or adapters.Adapter
+        :param sites: list of site codes, the adapter sites by default
+        """
+        super().__init__(onsets_cache_size, baseline_mode, baseline_window)
+        self.adapter = get_adapter(adapter) if isinstance(adapter, str) else adapter
+        self.sites = self.adapter.sites if sites is None else list(sites)
+        self.workers = workers
+
+    def load(self, variable):
+        """
+        store.DailyStore of a variable of the sites, computed once until
+        release(('load', variable))
+        """
+        key = ('load', variable)  # Apart from the names of lazy properties
+        if key not in self._cache:
+            self._cache[key] = self.adapter.load(variable, self.sites, workers=self.workers)
+        return self._cache[key]
+
+    @lazy
+    def resolver(self):
+        return self.adapter.resolver()
+
+    @lazy
+    def ah_store(self):
+        """store.DailyStore, columns are 'Site Name'"""
+        return self._with_baseline(self.load('ah'))
+
+    @lazy
+    def ah(self):
+        """dict['dd.mm.year']['Site Name'], built from ah_store"""
+        store = self.ah_store
+        data = dict()
+        for row, date in enumerate(store.dates):
+            data[date.strftime('%d.%m.%Y')] = OrderedDict(
+                (site, store.values[row, column]) for column, site in enumerate(store.sites)
+                if not np.isnan(store.values[row, column]))
+        return data
+
+    @lazy
+    def excess(self):
+        return self.adapter.excess(self.sites)
+
+    def _get_onsets(self, thresholds, winter):
+        return self.adapter.detect_onsets(self.excess, thresholds, winter)
+
+    def events(self, thresholds, winter=None):
+        if self.adapter.get_events is None:
+            raise NotImplementedError('adapter %s has no events' % self.adapter.name)
+        return self.adapter.get_events(self.excess, thresholds, winter or Winter())
+
+    def threshold_table(self, winter=None):
+        if self.adapter.get_threshold_table is None:
+            raise NotImplementedError('adapter %s has no threshold table' % self.adapter.name)
+        return self.adapter.get_threshold_table(self.excess, winter or Winter())
+
+
+DATASETS = {
+    'usa': USA,
+    'russia': Russia,
+    'paris': Paris,
+}
@@ -0,0 +1,229 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Epidemic events: onset, peak, end, duration and cumulative excess of
+    every epidemic, in one vectorised pass over the weekly excess of all
+    the sites at once, instead of onset dates only.
+
+    An epidemic of a threshold is a run of consecutive weeks at or above
+    it. Its onset is the detectors' onset, a week after two weeks of the
+    run, under the same winter, date bounds and second-onset cutoff, so
+    onsets of the events equal these of russia.get_onsets_by_morbidity
+    and usa.get_onsets. Its peak, end, duration and size (the sum of the
+    excess) are these of the run; a run holding two onsets of a site is
+    cut before the two weeks of the later one, so no week is counted
+    twice. In the IsEpidemic mode a run is
+    the days flagged by the Influenza Institute, onsets are these of
+    russia.get_onsets_by_epidemiologists.
+
+    Dates are date.toordinal(), sites are positions in the list of sites
+    returned with the events.
+"""
+import datetime
+
+import numpy as np
+
+from ingest import read_site_files
+from onset import Winter
+from store import get_month_day
+from stream import get_morbidity_detector, get_mortality_detector
+
+EVENT_DTYPE = np.dtype([
+    ('threshold', np.float64),  # NaN in the IsEpidemic mode
+    ('site', np.int32),
+    ('onset', np.int64),
+    ('peak', np.int64),
+    ('peak_value', np.float64),
+    ('end', np.int64),  # last week (day in the IsEpidemic mode) of the run
+    ('duration', np.int32),  # days
+    ('size', np.float64),  # excess summed over the run
+])
+DAYS_IN_WEEK = 7
+
+
+def _flatten(series):
+    """
+    :param series: dict, site -> (ordinals, values)
+    :return: (list of sites, array of site positions, ordinals and values
+        of every record, sorted by site and date)
+    """
+    sites = list(series)
+    positions, ordinals, values = [], [], []
+    for position, site in enumerate(sites):
+        site_ordinals, site_values = series[site]
+        order = np.argsort(site_ordinals, kind='mergesort')
+        positions.append(np.full(len(order), position, dtype=np.int32))
+        ordinals.append(np.asarray(site_ordinals, dtype=np.int64)[order])
+        values.append(np.asarray(site_values, dtype=float)[order])
+    return sites, np.concatenate(positions + [np.zeros(0, dtype=np.int32)]), \
+        np.concatenate(ordinals + [np.zeros(0, dtype=np.int64)]), \
+        np.concatenate(values + [np.zeros(0)])
+
+
+def _get_runs(flags, sites):
+    """
+    :param flags: array of bool, records within epidemics
+    :return: (array, array), first and last record of the run of every
+        record, -1 out of runs; runs break between sites
+    """
+    size = len(flags)
+    new_site = np.ones(size, dtype=bool)
+    new_site[1:] = sites[1:] != sites[:-1]
+    starts = flags & (new_site | ~np.roll(flags, 1))
+    ends = flags & (np.roll(new_site, -1) | ~np.roll(flags, -1))
+    if size:
+        ends[-1] = flags[-1]
+
+    records = np.arange(size)
+    first = np.maximum.accumulate(np.where(starts, records, -1))
+    last = np.minimum.accumulate(np.where(ends, records, size)[::-1])[::-1]
+    return np.where(flags, first, -1), np.where(flags, last, -1)
+
+
+def _get_events(threshold, sites, ordinals, values, onsets, runs, run_first, run_last, step,
+                lead=0):
+    """
+    :param onsets: array of onset records, sorted
+    :param runs: array, a record of the run of every onset
+    :param run_first: array, first record of the run of every record, see _get_runs
+    :param lead: int, records of a run before its onset; a later onset of
+        the same run cuts it there, so no weeks are shared by two events
+    """
+    events = np.zeros(len(onsets), dtype=EVENT_DTYPE)
+    if not len(onsets):
+        return events
+    first, last = run_first[runs], run_last[runs]
+    shared = np.flatnonzero(first[1:] == first[:-1]) + 1
+    first[shared] = np.maximum(first[shared], onsets[shared] - lead)
+    last[shared - 1] = first[shared] - 1
+
+    # Events as [first, last] segments of reduceat, every other result is between them
+    bounds = np.stack((first, last + 1), axis=1).ravel()
+    peaks = np.maximum.reduceat(np.append(values, -np.inf), bounds)[::2]
+    sums = np.add.reduceat(np.append(values, 0.), bounds)[::2]
+    # First record of an event at its peak
+    lengths = last - first + 1
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    records = np.repeat(first - offsets, lengths) + np.arange(lengths.sum())
+    at_peak = values[records] == np.repeat(peaks, lengths)
+    peak_records = np.minimum.reduceat(np.where(at_peak, records, len(values)), offsets)
+
+    events['threshold'] = threshold
+    events['site'] = sites[onsets]
+    events['onset'] = ordinals[onsets]
+    events['peak'] = ordinals[peak_records]
+    events['peak_value'] = peaks
+    events['end'] = ordinals[last]
+    events['duration'] = ordinals[last] - ordinals[first] + step
+    events['size'] = sums
+    return events
+
+
+def get_events(series, thresholds, winter=Winter(), after=None, before=None,
+               step=DAYS_IN_WEEK):
+    """
+    Events of weekly excess
+    :param series: dict, site -> (array of week ordinals, array of excess)
+    :param after: datetime.date, no onsets up to this date inclusive
+    :param before: datetime.date, no onsets from this date on
+    :return: (array of EVENT_DTYPE sorted by threshold, site and onset, list of sites)
+    """
+    sites, positions, ordinals, values = _flatten(series)
+    size = len(values)
+
+    # Weeks eligible for an onset: two previous weeks of the site, in winter and bounds
+    month, day = get_month_day(ordinals)
+    month_day = month * 100 + day
+    eligible = (month_day >= winter.START.month * 100 + winter.START.day) | \
+               (month_day <= winter.END.month * 100 + winter.END.day)
+    if after is not None:
+        eligible &= ordinals > after.toordinal()
+    if before is not None:
+        eligible &= ordinals < before.toordinal()
+    has_history = np.zeros(size, dtype=bool)
+    has_history[2:] = (positions[2:] == positions[:-2])
+    eligible &= has_history
+    history = np.where(has_history, np.arange(size) - 1, 0)  # prev1 record
+
+    events = []
+    for threshold in thresholds:
+        above = values >= threshold
+        candidates = np.flatnonzero(eligible & above[history] & above[np.maximum(history - 1, 0)])
+
+        # Cutoff of a second onset within a winter length, sequential over candidates only
+        onsets, last_site, last_onset = [], -1, None
+        for record in candidates:
+            if positions[record] == last_site and \
+                    ordinals[record] - last_onset < winter.days_count:
+                continue
+            onsets.append(record)
+            last_site, last_onset = positions[record], ordinals[record]
+
+        onsets = np.array(onsets, dtype=int)
+        first, last = _get_runs(above, positions)
+        events.append(_get_events(threshold, positions, ordinals, values, onsets, onsets - 1,
+                                  first, last, step, lead=2))  # The run of the previous week
+    return np.concatenate(events + [np.zeros(0, dtype=EVENT_DTYPE)]), sites
+
+
+def get_morbidity_events(excess_data, thresholds, winter=Winter()):
+    """
+    :param excess_data: dict, see russia.get_relative_weekly_morbidity_excess
+    """
+    detector = get_morbidity_detector(thresholds, winter)
+    return get_events(
+        {city: ([datetime.datetime.strptime(date, '%d.%m.%Y').toordinal() for date in info],
+                list(info.values()))
+         for city, info in excess_data.items()},
+        thresholds, winter, detector.after, detector.before)
+
+
+def get_mortality_events(excess_data, thresholds, winter=Winter()):
+    """
+    :param excess_data: dict, see usa.get_mortality_excess
+    """
+    detector = get_mortality_detector(thresholds, winter)
+    return get_events(
+        {state: ([week['date'].toordinal() for week in weeks], [week['excess'] for week in weeks])
+         for state, weeks in excess_data.items()},
+        thresholds, winter, detector.after, detector.before)
+
+
+def get_epidemiologist_events(cities, file_pattern, value_name='Incidence'):
+    """
+    IsEpidemic mode: runs of flagged days of the Influenza Institute data,
+    the onset is the monday of the first day, as russia.get_onsets_by_epidemiologists
+    :param value_name: str, column of peaks and sizes
+    """
+    parsed = read_site_files(file_pattern, cities, ['IsEpidemic', value_name],
+                             skip_leap_days=False)
+    sites, positions, ordinals, values = _flatten(
+        {city: (city_ordinals, city_values[:, 1])
+         for city, (city_ordinals, city_values) in parsed.items()})
+    flags = np.concatenate([city_values[:, 0] == 1 for _, city_values in parsed.values()] +
+                           [np.zeros(0, dtype=bool)])
+
+    first, last = _get_runs(flags, positions)
+    starts = np.flatnonzero(flags & (first == np.arange(len(flags))))
+    events = _get_events(np.nan, positions, ordinals, values, starts, starts, first, last, 1)
+    events['onset'] -= (events['onset'] + 6) % DAYS_IN_WEEK  # Monday, date.weekday() == 0
+    return events, sites
+
+
+def get_onsets_from_events(events, sites, thresholds=None):
+    """
+    :param thresholds: list, thresholds of the events by default; all of
+        them for IsEpidemic events, as the dummy wrapper of the onsets
+    :return: dict, dict[threshold][site] = list of onset dates, what the
+        onset detectors return
+    """
+    if thresholds is None:
+        thresholds = sorted(set(events['threshold'][~np.isnan(events['threshold'])].tolist()))
+    onsets = dict()
+    for threshold in thresholds:
+        selected = events[(events['threshold'] == threshold) | np.isnan(events['threshold'])]
+        onsets[threshold] = {site: [datetime.date.fromordinal(int(x))
+                                    for x in selected['onset'][selected['site'] == position]]
+                             for position, site in enumerate(sites)}
+    return onsets
@@ -0,0 +1,224 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Lagged features for forecasting models: for every (site, day) the
+    previous `lags` days of AH', temperature, incidence etc., with onset
+    labels aligned to the day.
+
+    Windows are strided views of the store columns, so no (day x lag)
+    copy is made; only a batch being returned or written is materialised.
+    Days are store rows, so 29.02 is not a lag, as everywhere in store.py.
+
+    An export directory holds:
+        meta.json     variables, lags, thresholds, horizon and sites
+        features.npy  (row x variable x lag), lag 0 is the farthest day
+        labels.npy    (row x threshold), 1 if an onset is within horizon
+        index.npy     (row), site column of meta and date.toordinal()
+"""
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from numpy.lib.stride_tricks import as_strided
+
+from seasonality import SEASON_START, get_season_days
+from store import EPOCH_ORDINAL
+
+LAGS = 28
+BATCH_SIZE = 4096
+INDEX_DTYPE = np.dtype([('site', np.int32), ('ordinal', np.int64)])
+
+
+def get_lagged_view(series, lags):
+    """
+    :param series: 1-D array, e.g. a column of DailyStore.dev
+    :return: read-only view (len(series) - lags + 1 x lags), row i holds
+        series[i:i + lags], sharing memory with series
+    """
+    series = np.asarray(series)
+    windows = max(len(series) - lags + 1, 0)
+    return as_strided(series, shape=(windows, lags), strides=(series.strides[0], ) * 2,
+                      writeable=False)
+
+
+def get_season_mask(ordinals, winter=None, years=None):
+    """
+    :param winter: onset.Winter, days out of it are dropped
+    :param years: iterable, years of season starts (1986 is the winter 1986/1987)
+    :return: array of bool
+    """
+    ordinals = np.asarray(ordinals, dtype=int)
+    mask = np.ones(len(ordinals), dtype=bool)
+    season_days = get_season_days(ordinals)
+    if winter is not None:
+        days = season_days - (winter.START - SEASON_START).days
+        mask &= (days >= 0) & (days < winter.days_count)
+    if years is not None:
+        # Season day counts from 01.07, so the season began season_days earlier
+        starts = (ordinals - season_days - EPOCH_ORDINAL).astype('datetime64[D]') \
+            .astype('datetime64[Y]')
+        mask &= np.isin(starts.astype(int) + 1970, list(years))
+    return mask
+
+
+class LaggedFeatures:
+    """
+    Lagged windows of several stores over the date grid of the first one
+    """
+
+    def __init__(self, stores, sites, site_resolver, lags=LAGS, anomaly=('ah', ),
+                 onsets=None, thresholds=None, horizon=1):
+        """
+        :param stores: dict, variable -> store.DailyStore with columns by
+            'Site Name', e.g. {'ah': ah_store, 'incidence': incidence_store}
+        :param sites: list of site codes
+        :param anomaly: variables taken as deviations from the mean (DailyStore.dev)
+        :param onsets: dict, dict[threshold][site] = list of onset dates
+        :param horizon: int, a day is labelled if an onset is within
+            this day and the next horizon - 1 days
+        """
+        self.variables = list(stores)
+        self.sites = list(sites)
+        self.lags = lags
+        self.thresholds = list(thresholds if thresholds is not None else (onsets or []))
+        self.horizon = horizon
+
+        grid = stores[self.variables[0]]
+        self.ordinals = grid.ordinals
+        self._columns = {site: [] for site in self.sites}
+        self._views = {site: [] for site in self.sites}
+        for variable, store in stores.items():
+            data = store.dev if variable in anomaly else store.values
+            aligned = np.array_equal(store.ordinals, self.ordinals)
+            for site in self.sites:
+                column = data[:, store.site_index[site_resolver[site]['name']]]
+                if not aligned:  # A copy of the column on the grid dates, once
+                    column = _align(column, store.ordinals, self.ordinals)
+                self._columns[site].append(column)
+                self._views[site].append(get_lagged_view(column, lags))
+
+        self._labels = {site: self._get_labels(onsets, site) for site in self.sites}
+
+    def _get_labels(self, onsets, site):
+        """
+        :return: array of int8 (date x threshold), onsets within the
+            day and the next horizon - 1 days
+        """
+        size = len(self.ordinals)
+        labels = np.zeros((size, len(self.thresholds)), dtype=np.int8)
+        first = np.arange(size)
+        last = np.minimum(first + self.horizon, size)
+        for idx, threshold in enumerate(self.thresholds):
+            rows = np.searchsorted(self.ordinals, [date.toordinal() for date in onsets[threshold][site]])
+            counts = np.concatenate(([0], np.cumsum(np.bincount(rows[rows < size], minlength=size))))
+            labels[:, idx] = counts[last] - counts[first] > 0
+        return labels
+
+    def rows(self, site, winter=None, years=None):
+        """
+        :return: array of grid rows of the site with a full window of lags,
+            no variable has gaps in it
+        """
+        mask = get_season_mask(self.ordinals, winter, years)
+        mask[:self.lags] = False
+        gaps = np.concatenate(([0], np.cumsum(
+            np.sum([np.isnan(column) for column in self._columns[site]], axis=0))))
+        # Window of row r is view row r - lags, of days r - lags .. r - 1
+        windows = np.arange(len(self.ordinals)) - self.lags
+        within = windows >= 0
+        complete = np.zeros(len(self.ordinals), dtype=bool)
+        complete[within] = gaps[windows[within] + self.lags] - gaps[windows[within]] == 0
+        return np.flatnonzero(mask & complete)
+
+    def get(self, site, rows):
+        """
+        :param rows: array of grid rows, see rows()
+        :return: (features, array (row x variable x lag), labels, array (row x threshold))
+        """
+        windows = rows - self.lags  # The window of a day ends the day before
+        return np.stack([view[windows] for view in self._views[site]], axis=1), \
+            self._labels[site][rows]
+
+    def batches(self, sites=None, winter=None, years=None, batch_size=BATCH_SIZE):
+        """
+        Stream of training data, a batch never spans two sites
+        :return: generator of (features, labels, index), index of INDEX_DTYPE
+            with the position of the site in self.sites
+        """
+        for site in (self.sites if sites is None else sites):
+            rows = self.rows(site, winter, years)
+            for first in range(0, len(rows), batch_size):
+                batch = rows[first:first + batch_size]
+                features, labels = self.get(site, batch)
+                index = np.empty(len(batch), dtype=INDEX_DTYPE)
+                index['site'] = self.sites.index(site)
+                index['ordinal'] = self.ordinals[batch]
+                yield features, labels, index
+
+    def export(self, directory, sites=None, winter=None, years=None, dtype=np.float32,
+               batch_size=BATCH_SIZE):
+        """
+        Write features, labels and index as .npy memory maps, batch by batch
+        :return: int, number of rows written
+        """
+        sites = self.sites if sites is None else list(sites)
+        size = sum(len(self.rows(site, winter, years)) for site in sites)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            f.write(json.dumps({'variables': self.variables, 'lags': self.lags,
+                                'thresholds': self.thresholds, 'horizon': self.horizon,
+                                'sites': self.sites}))
+
+        features = open_memmap(os.path.join(directory, 'features.npy'), mode='w+', dtype=dtype,
+                               shape=(size, len(self.variables), self.lags))
+        labels = open_memmap(os.path.join(directory, 'labels.npy'), mode='w+', dtype=np.int8,
+                             shape=(size, len(self.thresholds)))
+        index = open_memmap(os.path.join(directory, 'index.npy'), mode='w+', dtype=INDEX_DTYPE,
+                            shape=(size, ))
+        written = 0
+        for batch_features, batch_labels, batch_index in self.batches(sites, winter, years,
+                                                                      batch_size):
+            end = written + len(batch_index)
+            features[written:end] = batch_features
+            labels[written:end] = batch_labels
+            index[written:end] = batch_index
+            written = end
+        for array in (features, labels, index):
+            array.flush()
+        del features, labels, index
+        return written
+
+
+def _align(column, ordinals, grid):
+    """
+    :return: array of column values on the grid ordinals, NaN where missing
+    """
+    aligned = np.full(len(grid), np.nan)
+    rows = np.searchsorted(ordinals, grid)
+    found = rows < len(ordinals)
+    found[found] = ordinals[rows[found]] == grid[found]
+    aligned[found] = column[rows[found]]
+    return aligned
+
+
+def load_features(directory):
+    """
+    :return: (meta dict, features, labels, index), read-only memory maps
+    """
+    with open(os.path.join(directory, 'meta.json'), 'r') as f:
+        meta = json.load(f)
+    return (meta, ) + tuple(np.load(os.path.join(directory, name), mmap_mode='r')
+                            for name in ('features.npy', 'labels.npy', 'index.npy'))
+
+
+def read_batches(directory, batch_size=BATCH_SIZE):
+    """
+    Stream an export from disk
+    :return: generator of (features, labels, index) memory-mapped slices
+    """
+    _, features, labels, index = load_features(directory)
+    for first in range(0, len(index), batch_size):
+        yield features[first:first + batch_size], labels[first:first + batch_size], \
+            index[first:first + batch_size]
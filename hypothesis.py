@@ -7,37 +7,65 @@ import os
 from pathlib import Path
 import random
 
+import numpy as np
+from scipy import stats
+
+from onset import get_onset_ordinals
+from seasonality import OnsetCube
+
 INTERVAL_LENGTH = 28  # days
 CONTROL_SAMPLE_SIZE = 10000
+CHECKPOINT_SIZE = 1000  # samples between writes of the control sample file
+SAMPLING_SCHEMES = ('uniform', 'stratified', 'latin_hypercube')
+DAYS_IN_WEEK = 7
 
 
-def generate_control_sample(onsets, threshold, ah_dev, winter, sites, site_resolver, years, filename):
-
+def generate_control_sample(onsets, threshold, ah_dev, winter, sites, site_resolver, years, filename,
+                            progress=None, population=None, scheme='uniform'):
+    """
+    :param progress: metrics.Progress, advanced on every sample
+    :param population: ControlPopulation of the same winter and years, if
+        given samples are drawn from its window means, ah_dev is not used
+    :param scheme: with a population, one of SAMPLING_SCHEMES: 'uniform'
+        as without it, 'stratified' by site and week of winter in proportion
+        to the onsets, or 'latin_hypercube' over site, year and day
+    """
+    if isinstance(population, ControlPool) and scheme != 'uniform':
+        raise ValueError('a ControlPool draws uniform samples only, not %s' % scheme)
     onset_count = sum(len(onsets[threshold][site]) for site in sites)  # n
     os.makedirs(os.path.dirname('./' + filename), exist_ok=True)
 
-    ah_samples = []
-    for iteration in range(CONTROL_SAMPLE_SIZE + 1):
-
-        # Print progress and add chunk to result
-        if iteration % 1000 == 0:
-            print(f'{int(100 * iteration / CONTROL_SAMPLE_SIZE)} %')
-            if Path(filename).is_file():
-                with open(filename, 'r') as f:
-                    saved = json.load(f)
-            else:
-                saved = []
-
-            print(f'{len(saved)} saved values, {len(ah_samples)} new added')
-            ah_samples += saved
-            with open(filename, 'w') as f:
-                f.write(json.dumps(ah_samples))
-            if ah_samples:
-                print(f'min {min(ah_samples)}, '
-                      f'avg {sum(ah_samples) / len(ah_samples)}, '
-                      f'max {max(ah_samples)}')
-            ah_samples = []
+    if Path(filename).is_file():
+        with open(filename, 'r') as f:
+            saved = json.load(f)
+    else:
+        saved = []
 
+    if population is not None:
+        if scheme == 'stratified':
+            weights = get_onset_week_weights(onsets, threshold, sites, winter)
+            ah_samples = population.stratified_sample(onset_count, weights, CONTROL_SAMPLE_SIZE,
+                                                      sites=sites)
+        elif scheme == 'latin_hypercube':
+            ah_samples = population.latin_hypercube_sample(onset_count, CONTROL_SAMPLE_SIZE,
+                                                           sites=sites)
+        elif scheme == 'uniform':
+            ah_samples = population.sample(onset_count, CONTROL_SAMPLE_SIZE, sites=sites)
+        else:
+            raise ValueError('unknown sampling scheme %s, use one of %s' % (scheme, SAMPLING_SCHEMES))
+        saved += ah_samples.tolist()
+        with open(filename, 'w') as f:
+            f.write(json.dumps(saved))
+        print(f'{len(saved)} saved values')
+        if progress:
+            progress.advance(CONTROL_SAMPLE_SIZE, ah_samples.tolist())
+            progress.finish()
+        return
+
+    # Progress and running min/mean/max are reported by the metrics thread,
+    # samples are written every CHECKPOINT_SIZE iterations to survive an interrupt
+    ah_samples = []
+    for iteration in range(1, CONTROL_SAMPLE_SIZE + 1):
         ah_dev_interval = []
         for i in range(onset_count):
             site = random.choice(sites)
@@ -55,6 +83,18 @@ def generate_control_sample(onsets, threshold, ah_dev, winter, sites, site_resol
 
         ah_sample = sum(ah_dev_interval) / len(ah_dev_interval)
         ah_samples.append(ah_sample)
+        if progress:
+            progress.advance(values=(ah_sample, ))
+
+        if iteration % CHECKPOINT_SIZE == 0 or iteration == CONTROL_SAMPLE_SIZE:
+            saved += ah_samples
+            with open(filename, 'w') as f:
+                f.write(json.dumps(saved))
+            ah_samples = []
+
+    print(f'{len(saved)} saved values')
+    if progress:
+        progress.finish()
 
 
 def generate_experimental_sample(onsets, threshold, ah_dev, winter, sites, site_resolver, filename):
@@ -81,3 +121,407 @@ def generate_experimental_sample(onsets, threshold, ah_dev, winter, sites, site_
           f'max {max(onset_average_ah_sample)}')
     with open(filename, 'w') as f:
         f.write(json.dumps(onset_average_ah_sample))
+
+
+def get_onset_prior_ah_dev(store, onsets, threshold, sites, site_resolver,
+                           interval_length=INTERVAL_LENGTH):
+    """
+    generate_experimental_sample without a file, for every onset at once
+    :param store: store.DailyStore of absolute humidity by site name
+    :return: (array of mean AH' over interval_length days up to the onset,
+        array of indices in sites)
+    """
+    onset_ordinals, site_idx = get_onset_ordinals(onsets, threshold, sites)
+    ordinals = onset_ordinals[:, None] - np.arange(interval_length)[None, :]
+
+    columns = np.array(store.columns(
+        [site_resolver[site]['name'] for site in sites]), dtype=int)
+    windows = store.dev[store.rows(ordinals), columns[site_idx][:, None]]
+    return windows.mean(axis=1), site_idx
+
+
+def get_welch_ttest(mean1, var1, n1, mean2, var2, n2):
+    """
+    Welch's t-test from sample summaries, element-wise over arrays
+    :param var1: sample variance (ddof=1)
+    :return: (t statistic, two-sided P-value)
+    """
+    se1, se2 = var1 / n1, var2 / n2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = (mean1 - mean2) / np.sqrt(se1 + se2)
+        df = (se1 + se2) ** 2 / (se1 ** 2 / (n1 - 1) + se2 ** 2 / (n2 - 1))
+    return t, 2 * stats.t.sf(np.abs(t), df)
+
+
+def get_student_ttest(mean1, var1, n1, mean2, var2, n2):
+    """
+    Student's t-test (equal variances) from sample summaries, element-wise
+    :return: (t statistic, two-sided P-value)
+    """
+    df = n1 + n2 - 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = ((n1 - 1) * var1 + (n2 - 1) * var2) / df
+        t = (mean1 - mean2) / np.sqrt(pooled * (1. / n1 + 1. / n2))
+    return t, 2 * stats.t.sf(np.abs(t), df)
+
+
+def get_sample_summaries(samples):
+    """
+    :param samples: list of samples of any sizes
+    :return: (array of means, array of variances (ddof=1), array of sizes)
+    """
+    sizes = np.array([len(sample) for sample in samples], dtype=int)
+    values = np.concatenate([np.asarray(sample, dtype=float) for sample in samples] + [np.zeros(0)])
+    group = np.repeat(np.arange(len(samples)), sizes)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(group, values, len(samples)) / sizes
+        var = np.bincount(group, (values - mean[group]) ** 2, len(samples)) / (sizes - 1)
+    return mean, var, sizes
+
+
+def adjust_p_values(p, method='holm'):
+    """
+    Multiple comparison correction, NaN P-values are left out
+    :param method: 'holm' (family-wise error) or 'bh' (Benjamini-Hochberg,
+        false discovery rate)
+    :return: array of adjusted P-values
+    """
+    p = np.asarray(p, dtype=float)
+    adjusted = np.full(p.shape, np.nan)
+    valid = np.flatnonzero(~np.isnan(p.ravel()))
+    order = valid[np.argsort(p.ravel()[valid], kind='mergesort')]
+    ranked = p.ravel()[order]
+    m = len(ranked)
+
+    if method == 'holm':
+        ranked = np.maximum.accumulate((m - np.arange(m)) * ranked)
+    elif method == 'bh':
+        ranked = np.minimum.accumulate((m / np.arange(m, 0, -1)) * ranked[::-1])[::-1]
+    else:
+        raise ValueError('unknown correction %s, use holm or bh' % method)
+    adjusted.ravel()[order] = np.minimum(ranked, 1.)
+    return adjusted
+
+
+def get_ttest_table(labels, control, experimental, equal_var=False, correction='holm',
+                    alpha=0.05):
+    """
+    Every configuration tested at once, as stats.ttest_ind(control, experimental)
+    :param labels: list, a label per configuration, e.g. a state or a threshold
+    :param control: list of control samples, or (means, variances, sizes)
+        of the samples from get_sample_summaries
+    :param experimental: list of experimental samples, or summaries
+    :param correction: 'holm', 'bh' or None
+    :return: list of dict, such as {
+            'label': 'Texas', 'control_size': 10000, 'experimental_size': 25,
+            'control_mean': ..., 'experimental_mean': ..., 't': ..., 'p': ...,
+            'p_adjusted': ..., 'significant': True
+        }, significant compares the adjusted P-value with alpha
+    """
+    mean1, var1, n1 = control if isinstance(control, tuple) else get_sample_summaries(control)
+    mean2, var2, n2 = experimental if isinstance(experimental, tuple) \
+        else get_sample_summaries(experimental)
+    test = get_student_ttest if equal_var else get_welch_ttest
+    t, p = test(*np.broadcast_arrays(mean1, var1, n1, mean2, var2, n2))
+    p_adjusted = adjust_p_values(p, correction) if correction else p
+
+    sizes1, sizes2 = np.broadcast_to(n1, len(labels)), np.broadcast_to(n2, len(labels))
+    means1, means2 = np.broadcast_to(mean1, len(labels)), np.broadcast_to(mean2, len(labels))
+    return [{
+        'label': label,
+        'control_size': int(sizes1[idx]),
+        'experimental_size': int(sizes2[idx]),
+        'control_mean': float(means1[idx]),
+        'experimental_mean': float(means2[idx]),
+        't': float(t[idx]),
+        'p': float(p[idx]),
+        'p_adjusted': float(p_adjusted[idx]),
+        'significant': bool(p_adjusted[idx] < alpha),
+    } for idx, label in enumerate(labels)]
+
+
+def draw_control_windows(store, winter, sites, site_resolver, years, count, rng):
+    """
+    Random (site, year, winter day) as in generate_control_sample
+    :return: (array of first rows, array of columns) of count windows
+    """
+    columns = np.array(store.columns(
+        [site_resolver[site]['name'] for site in sites]), dtype=int)
+    starts = np.array([datetime.date(year, winter.START.month, winter.START.day).toordinal()
+                       for year in years], dtype=int)
+
+    site_idx = rng.randint(0, len(sites), count)
+    year_idx = rng.randint(0, len(starts), count)
+    day_idx = rng.randint(0, winter.days_count, count)
+    return store.rows(starts[year_idx] + day_idx), columns[site_idx]
+
+
+def get_window_sensitivity(store, onsets, threshold, sites, site_resolver, winter, years,
+                           lengths=range(7, 61), offsets=range(0, 31),
+                           sample_size=CONTROL_SAMPLE_SIZE, seed=None):
+    """
+    Onset-prior vs control AH' for every window length and lag at once.
+    Windows are consecutive stored days (29.02 is absent), their means come
+    from cumulative sums, and one set of random control windows serves
+    every length.
+    :param lengths: window lengths, INTERVAL_LENGTH is the default analysis
+    :param offsets: days between the end of the onset-prior window and the onset
+    :param sample_size: control sample size, each item is a mean of n windows
+    :return: dict, such as {
+            'lengths': list, 'offsets': list, 'onset_count': n,
+            'difference': array (length x offset), onset minus control mean,
+            't': array (length x offset), 'p': array (length x offset),
+        }, t and p of Welch's test as in russia.hypothesis_test
+    """
+    rng = np.random.RandomState(seed)
+    lengths, offsets = list(lengths), list(offsets)
+
+    onset_ordinals, site_idx = get_onset_ordinals(onsets, threshold, sites)
+    n = len(onset_ordinals)
+    columns = np.array(store.columns(
+        [site_resolver[site]['name'] for site in sites]), dtype=int)[site_idx]
+
+    first_rows, control_columns = draw_control_windows(
+        store, winter, sites, site_resolver, years, n * sample_size, rng)
+
+    # length x offset x onset
+    end_rows = store.rows(onset_ordinals[None, :] - np.array(offsets)[:, None])
+    experimental = np.array([
+        store.window_means(end_rows - length + 1, columns[None, :], length)
+        for length in lengths])
+    # length x sample
+    control = np.array([
+        store.window_means(first_rows, control_columns, length)
+        .reshape(sample_size, n).mean(axis=1)
+        for length in lengths])
+
+    control_mean = control.mean(axis=1)[:, None]
+    control_var = control.var(axis=1, ddof=1)[:, None]
+    experimental_mean = experimental.mean(axis=2)
+    t, p = get_welch_ttest(control_mean, control_var, sample_size,
+                           experimental_mean, experimental.var(axis=2, ddof=1), n)
+    return {
+        'lengths': lengths,
+        'offsets': offsets,
+        'onset_count': n,
+        'difference': experimental_mean - control_mean,
+        't': t,
+        'p': p,
+    }
+
+
+class ControlPopulation:
+    """
+    Every control window of generate_control_sample enumerated once: the
+    mean AH' over interval_length days from each (site, year, winter day).
+    A control sample of any onset count n, for any subset of the sites,
+    is drawn by index sampling, or replaced by the exact moments of the
+    n-window mean.
+    """
+
+    def __init__(self, store, winter, sites, site_resolver, years,
+                 interval_length=INTERVAL_LENGTH):
+        """
+        :param store: store.DailyStore of absolute humidity by site name
+        """
+        self.sites = list(sites)
+        self.site_index = {site: idx for idx, site in enumerate(self.sites)}
+        self.years = list(years)
+
+        starts = np.array([datetime.date(year, winter.START.month, winter.START.day).toordinal()
+                           for year in self.years], dtype=int)
+        # year x day x j, 29.02 resolved to 28.02 as in generate_control_sample
+        rows = store.rows(starts[:, None, None] +
+                          np.arange(winter.days_count)[None, :, None] +
+                          np.arange(interval_length)[None, None, :])
+        columns = store.columns([site_resolver[site]['name'] for site in self.sites])
+
+        self.means = np.empty((len(self.sites), len(self.years), winter.days_count))
+        for idx, column in enumerate(columns):
+            self.means[idx] = store.dev[rows, column].mean(axis=2)
+
+    def windows(self, sites=None):
+        """
+        :return: array of window means of the sites, all sites by default
+        """
+        if sites is None:
+            return self.means.ravel()
+        return self.means[[self.site_index[site] for site in sites]].ravel()
+
+    def sample(self, n, size=CONTROL_SAMPLE_SIZE, rng=None, sites=None, chunk_size=1000):
+        """
+        :param n: windows per item, the onset count
+        :param rng: np.random.RandomState, the global one by default
+        :return: array of size means of n random windows, as generate_control_sample
+        """
+        rng = rng or np.random
+        windows = self.windows(sites)
+        return np.concatenate([
+            windows[rng.randint(0, len(windows), (min(chunk_size, size - first), n))].mean(axis=1)
+            for first in range(0, size, chunk_size)] + [np.zeros(0)])
+
+    def _cells(self, sites=None):
+        """Window means of the sites, (site x year x day)"""
+        return self.means if sites is None else self.means[[self.site_index[site] for site in sites]]
+
+    def stratified_sample(self, n, weights, size=CONTROL_SAMPLE_SIZE, rng=None, sites=None):
+        """
+        Every item has n windows split between strata (site x week of winter)
+        in proportion to weights, uniform within a stratum
+        :param weights: array (site x week), e.g. get_onset_week_weights
+        :return: array of size means of n windows, NaN for n == 0 as in sample
+        """
+        if n == 0:
+            return np.full(size, np.nan)
+        rng = rng or np.random
+        cells = self._cells(sites)
+        allocation = _allocate(n, weights)
+
+        totals = np.zeros(size)
+        for site_idx, week in zip(*np.nonzero(allocation)):
+            windows = cells[site_idx, :, week * DAYS_IN_WEEK:(week + 1) * DAYS_IN_WEEK].ravel()
+            count = allocation[site_idx, week]
+            totals += windows[rng.randint(0, len(windows), (size, count))].sum(axis=1)
+        return totals / n
+
+    def latin_hypercube_sample(self, n, size=CONTROL_SAMPLE_SIZE, rng=None, sites=None,
+                               chunk_size=1000):
+        """
+        As sample, but the n windows of an item are a Latin hypercube over
+        site, year and day: every dimension is cut into n equally likely
+        intervals and each interval is used once
+        :return: array of size means of n windows
+        """
+        rng = rng or np.random
+        cells = self._cells(sites)
+
+        means = []
+        for first in range(0, size, chunk_size):
+            count = min(chunk_size, size - first)
+            idx = [((rng.rand(count, n).argsort(axis=1) + rng.rand(count, n)) / n * length)
+                   .astype(int) for length in cells.shape]
+            means.append(cells[idx[0], idx[1], idx[2]].mean(axis=1))
+        return np.concatenate(means + [np.zeros(0)])
+
+    def null(self, n, sites=None):
+        """
+        Sampling distribution of the mean of n windows drawn with replacement
+        :return: (mean, variance)
+        """
+        windows = self.windows(sites)
+        return windows.mean(), windows.var() / n
+
+    def ttest(self, experimental_sample, sites=None, sample_size=CONTROL_SAMPLE_SIZE):
+        """
+        Welch's t-test of the experimental sample against the analytical
+        null, what a control sample of sample_size tends to
+        :return: (t statistic, two-sided P-value)
+        """
+        experimental_sample = np.asarray(experimental_sample)
+        n = len(experimental_sample)
+        mean, var = self.null(n, sites)
+        return get_welch_ttest(mean, var, sample_size,
+                               experimental_sample.mean(), experimental_sample.var(ddof=1), n)
+
+
+class ControlPool:
+    """
+    Common random numbers for a sweep over onset counts and site sets: one
+    matrix of uniform numbers (item x window) is shared by every
+    configuration. Item i of a configuration with n onsets is the mean of
+    the windows picked by the first n numbers of row i, so every sample is
+    distributed as ControlPopulation.sample while configurations stay
+    positively correlated and their differences less noisy. The windows of
+    a site set are picked once, their cumulative sums serve any n.
+    Can be passed as the population of generate_control_sample, with the
+    'uniform' scheme only.
+    """
+
+    def __init__(self, population, max_n, size=CONTROL_SAMPLE_SIZE, rng=None):
+        """
+        :param population: ControlPopulation
+        :param max_n: int, the largest onset count of the sweep
+        """
+        rng = rng or np.random
+        self.population = population
+        self.size = size
+        self.uniform = rng.rand(size, max_n)
+        self._cumsums = dict()
+
+    def sample(self, n, size=None, rng=None, sites=None):
+        """
+        :param size: int, up to the pool size, all items by default
+        :param rng: not used, the pool numbers are drawn already
+        :return: array of size means of n windows, NaN for n == 0
+        """
+        if n == 0:
+            return np.full(size or self.size, np.nan)  # As the mean of no windows
+        if n > self.uniform.shape[1]:
+            raise ValueError('%d windows requested, the pool has %d' % (n, self.uniform.shape[1]))
+        key = None if sites is None else tuple(sites)
+        if key not in self._cumsums:
+            windows = self.population.windows(sites)
+            self._cumsums[key] = np.cumsum(
+                windows[(self.uniform * len(windows)).astype(int)], axis=1)
+        return self._cumsums[key][:size or self.size, n - 1] / n
+
+    def release(self):
+        self._cumsums.clear()
+
+
+def get_onset_week_weights(onsets, threshold, sites, winter):
+    """
+    :return: array (site x week of winter), share of the onsets within
+        winter, as OnsetCube they are the only ones counted; all zeros
+        without such onsets
+    """
+    days = OnsetCube.from_onsets(onsets, [threshold], sites).get(winter=winter)[0]
+    counts = np.add.reduceat(days, np.arange(0, winter.days_count, DAYS_IN_WEEK), axis=1)
+    total = counts.sum()
+    return counts / total if total else counts.astype(float)
+
+
+def _allocate(n, weights):
+    """Proportional allocation of n to strata, largest remainders first"""
+    quota = n * np.asarray(weights, dtype=float)
+    allocation = np.floor(quota).astype(int)
+    remainder = (quota - allocation).ravel()
+    left = n - allocation.sum()
+    allocation.ravel()[np.argsort(-remainder, kind='mergesort')[:left]] += 1
+    return allocation
+
+
+def get_variance_reduction(population, n, weights=None, size=CONTROL_SAMPLE_SIZE, rng=None,
+                           sites=None):
+    """
+    Spread of the control sample items under every scheme
+    :param weights: array (site x week), stratified schemes are skipped if None
+    :return: dict, such as {
+            'variance': {'uniform': ..., 'latin_hypercube': ...,
+                         'matched': ..., 'stratified': ...},
+            'reduction': {scheme: uniform variance / scheme variance}
+        }, 'matched' draws windows at random from the onset-weighted strata,
+        the unstratified reference for 'stratified'; a reduction of k means
+        the same precision of the control mean with k times fewer items
+    """
+    rng = rng or np.random
+    samples = {
+        'uniform': population.sample(n, size, rng, sites),
+        'latin_hypercube': population.latin_hypercube_sample(n, size, rng, sites),
+    }
+    if weights is not None:
+        cells = population._cells(sites)
+        strata = np.flatnonzero(np.asarray(weights).ravel())
+        drawn = rng.choice(strata, (size, n), p=np.asarray(weights).ravel()[strata])
+        site_idx, week = np.unravel_index(drawn, np.shape(weights))
+        lengths = np.minimum(DAYS_IN_WEEK, cells.shape[2] - week * DAYS_IN_WEEK)  # Last week is shorter
+        days = week * DAYS_IN_WEEK + (rng.rand(size, n) * lengths).astype(int)
+        samples['matched'] = cells[site_idx, rng.randint(0, cells.shape[1], (size, n)), days] \
+            .mean(axis=1)
+        samples['stratified'] = population.stratified_sample(n, weights, size, rng, sites)
+
+    variance = {scheme: sample.var(ddof=1) for scheme, sample in samples.items()}
+    return {
+        'variance': variance,
+        'reduction': {scheme: variance['uniform'] / value for scheme, value in variance.items()},
+    }
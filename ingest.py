@@ -0,0 +1,173 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Parallel parsing of the data files into arrays.
+
+    Many site files (data/flu_dbase/*.txt) are parsed by a process pool,
+    one file per task. One wide file (stateAHmsk_oldFL.csv, a column per
+    state) is split into byte ranges aligned to lines, parsed in parallel
+    and joined in file order, so the result never depends on workers.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+from itertools import repeat
+import os
+
+import numpy as np
+
+from metrics import collect, timed
+from store import DailyStore
+
+MIN_CHUNK_SIZE = 1 << 20  # bytes
+
+
+def parse_date_field(field):
+    """
+    :param field: str, 'dd.mm.year' or 'yearmmdd'
+    :return: int, date.toordinal()
+    """
+    if '.' in field:
+        return datetime.date(int(field[6:10]), int(field[3:5]), int(field[0:2])).toordinal()
+    return datetime.date(int(field[0:4]), int(field[4:6]), int(field[6:8])).toordinal()
+
+
+def _is_leap_day(field):
+    return field.startswith('29.02') or field.endswith('0229')
+
+
+def read_header(filename, delimiter):
+    with open(filename, 'rb') as f:
+        header = f.readline()
+        return header.decode('utf8').strip('\r\n').split(delimiter), f.tell()
+
+
+def _map(func, tasks, workers, progress=None):
+    """
+    :param progress: metrics.Progress, advanced with the busy time of every task
+    """
+    if workers == 1 or len(tasks) <= 1:
+        return collect((timed(func, *task) for task in tasks), progress)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return collect(executor.map(timed, repeat(func), *zip(*tasks)), progress,
+                       min(workers or os.cpu_count() or 1, len(tasks)))
+
+
+def parse_chunk(filename, start, end, delimiter, date_column, columns,
+                 skip_leap_days=True):
+    """
+    Parse lines whose first byte is in [start, end)
+    :return: (array of date ordinals, array (line x column))
+    """
+    ordinals, rows = [], []
+    with open(filename, 'rb') as f:
+        f.seek(start - 1)
+        f.readline()  # Rest of the line that belongs to the previous chunk
+        position = f.tell()
+
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+
+            fields = line.decode('utf8').strip('\r\n').split(delimiter)
+            if len(fields) < 2:
+                continue
+            if skip_leap_days and _is_leap_day(fields[date_column]):
+                continue  # omit leap year
+
+            ordinals.append(parse_date_field(fields[date_column]))
+            rows.append([float(fields[column]) for column in columns])
+
+    return np.array(ordinals, dtype=int), \
+        np.array(rows, dtype=float).reshape(len(rows), len(columns))
+
+
+def read_wide_csv(filename, delimiter=';', date_name='Date', workers=None,
+                  chunk_size=None, names=None, progress=None):
+    """
+    :param filename: str, csv with a date column and a value column per site
+    :param workers: int, processes, None for CPU count
+    :param chunk_size: int, bytes per task, by default the file is split
+        evenly between workers
+    :param names: list of str, columns to parse, all by default
+    :param progress: metrics.Progress, advanced with every chunk
+    :return: (array of date ordinals, list of column names, array (date x column))
+    """
+    header, data_start = read_header(filename, delimiter)
+    date_column = header.index(date_name)
+    if names is None:
+        columns = [idx for idx, name in enumerate(header) if idx != date_column]
+    else:
+        columns = [header.index(name) for name in names]
+
+    size = os.path.getsize(filename)
+    if chunk_size is None:
+        chunk_size = max(MIN_CHUNK_SIZE, (size - data_start) // (workers or os.cpu_count() or 1) + 1)
+    bounds = list(range(data_start, size, chunk_size)) + [size]
+
+    tasks = [(filename, start, end, delimiter, date_column, columns)
+             for start, end in zip(bounds[:-1], bounds[1:])]
+    chunks = _map(parse_chunk, tasks, workers, progress)
+
+    ordinals = np.concatenate([chunk[0] for chunk in chunks] + [np.zeros(0, dtype=int)])
+    values = np.concatenate([chunk[1] for chunk in chunks] + [np.zeros((0, len(columns)))])
+    return ordinals, [header[idx] for idx in columns], values
+
+
+def _parse_site_file(filename, delimiter, date_name, names, skip_leap_days):
+    header, data_start = read_header(filename, delimiter)
+    return parse_chunk(filename, data_start, os.path.getsize(filename), delimiter,
+                        header.index(date_name), [header.index(name) for name in names],
+                        skip_leap_days)
+
+
+def read_site_files(file_pattern, sites, names, delimiter=' ', date_name='Date',
+                    workers=None, skip_leap_days=True, progress=None):
+    """
+    :param file_pattern: str, such as 'data/flu_dbase/%s.txt'
+    :param sites: list of str, such as ['spb', 'msk']
+    :param names: list of str, columns to read, such as ['Humidity']
+    :return: OrderedDict, dict['spb'] = (array of date ordinals,
+        array (date x name))
+    """
+    tasks = [(file_pattern % site, delimiter, date_name, list(names), skip_leap_days)
+             for site in sites]
+    return OrderedDict(zip(sites, _map(_parse_site_file, tasks, workers, progress)))
+
+
+def get_store_from_wide_csv(filename, delimiter=';', workers=None, names=None, progress=None):
+    """
+    :param names: list of str, columns to read, all by default
+    :param progress: metrics.Progress, advanced with every chunk
+    :return: store.DailyStore, what usa.get_ah parses into a dict
+    """
+    ordinals, sites, values = read_wide_csv(filename, delimiter, workers=workers, names=names,
+                                            progress=progress)
+    order = np.argsort(ordinals, kind='mergesort')
+    return DailyStore([datetime.date.fromordinal(int(x)) for x in ordinals[order]],
+                      sites, values[order])
+
+
+def get_store_from_site_files(file_pattern, sites, name, site_names=None,
+                              delimiter=' ', workers=None, progress=None):
+    """
+    One column of many site files joined by date, NaN where a site has no data
+    :param site_names: dict, site -> column name in the store, e.g.
+        {'spb': 'Saint Petersburg'}, by default site itself
+    :param progress: metrics.Progress, advanced with every site file
+    :return: store.DailyStore
+    """
+    parsed = read_site_files(file_pattern, sites, [name], delimiter, workers=workers,
+                             progress=progress)
+
+    ordinals = np.unique(np.concatenate([x[0] for x in parsed.values()]))
+    values = np.full((len(ordinals), len(sites)), np.nan)
+    for column, (site_ordinals, site_values) in enumerate(parsed.values()):
+        values[np.searchsorted(ordinals, site_ordinals), column] = site_values[:, 0]
+
+    columns = [site_names[site] if site_names else site for site in sites]
+    return DailyStore([datetime.date.fromordinal(int(x)) for x in ordinals],
+                      columns, values)
@@ -0,0 +1,194 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Progress of long-running sweeps: done/total, samples per second, ETA,
+    worker utilisation of parallel runs and running min/mean/max of the
+    sampled values, written by a timer thread to a file in the Prometheus
+    text format (node exporter textfile collector) or as JSON lines. The
+    sampling loop only updates counters.
+"""
+import json
+import os
+import threading
+import time
+
+FORMATS = ('prometheus', 'jsonl')
+
+
+class Progress:
+    """
+    Counters of one job, see MetricsExporter.job
+    """
+
+    def __init__(self, name, total, workers=1):
+        self.name = name
+        self.total = total
+        self.workers = workers
+        self.done = 0
+        self.busy_seconds = 0.
+        self.count = 0
+        self.sum = 0.
+        self.min = None
+        self.max = None
+        self.started = time.time()
+        self.finished = None
+
+    def advance(self, count=1, values=(), busy_seconds=0.):
+        """
+        :param values: iterable of sampled values, for min/mean/max
+        :param busy_seconds: worker time spent on these items, for utilisation
+            of parallel runs
+        """
+        self.done += count
+        self.busy_seconds += busy_seconds
+        for value in values:
+            self.count += 1
+            self.sum += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    def finish(self):
+        self.finished = time.time()
+
+    def snapshot(self):
+        """
+        :return: dict, such as {'job': 'control.30', 'done': 2000, 'total': 10000,
+            'elapsed': 4.1, 'rate': 487.8, 'eta': 16.4, 'utilisation': 0.93,
+            'min': -4e-4, 'mean': 1e-5, 'max': 5e-4}
+        """
+        done = self.done
+        elapsed = (self.finished or time.time()) - self.started
+        rate = done / elapsed if elapsed > 0 else 0.
+        eta = (self.total - done) / rate if rate > 0 and self.total else None
+        utilisation = self.busy_seconds / (elapsed * self.workers) \
+            if self.busy_seconds and elapsed > 0 else None
+        return {
+            'job': self.name,
+            'done': done,
+            'total': self.total,
+            'elapsed': elapsed,
+            'rate': rate,
+            'eta': 0. if self.finished else eta,
+            'utilisation': utilisation,
+            'min': self.min,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+        }
+
+
+def timed(func, *args, **kwargs):
+    """
+    func(*args, **kwargs) in a worker, picklable for process pools
+    :return: (result, seconds spent in func), for Progress.advance
+    """
+    started = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - started
+
+
+def collect(timed_results, progress=None, workers=1):
+    """
+    :param timed_results: iterable of timed() results, in order of tasks
+    :param progress: Progress, advanced with the busy time of every task
+    :param workers: int, workers the tasks run on
+    :return: list of results
+    """
+    if progress:
+        progress.workers = workers
+    results = []
+    for result, seconds in timed_results:
+        if progress:
+            progress.advance(busy_seconds=seconds)
+        results.append(result)
+    return results
+
+
+class MetricsExporter:
+    """
+    Writes snapshots of all jobs every `interval` seconds from a daemon
+    thread; use as a context manager or call start()/stop()
+    """
+
+    def __init__(self, filename, fmt='prometheus', interval=5.):
+        if fmt not in FORMATS:
+            raise ValueError('unknown metrics format %s, use one of %s' % (fmt, FORMATS))
+        self.filename = filename
+        self.fmt = fmt
+        self.interval = interval
+        self.jobs = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def job(self, name, total, workers=1):
+        """
+        :return: Progress, to advance from the sampling loop
+        """
+        progress = Progress(name, total, workers)
+        self.jobs.append(progress)
+        return progress
+
+    def start(self):
+        os.makedirs(os.path.dirname('./' + self.filename), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread:
+            self._thread.join()
+        self.write()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def write(self):
+        snapshots = [job.snapshot() for job in list(self.jobs)]
+        if self.fmt == 'jsonl':
+            now = time.time()
+            with open(self.filename, 'a') as f:
+                for snapshot in snapshots:
+                    f.write(json.dumps(dict(snapshot, time=now)) + '\n')
+            return
+
+        # Replace the file at once, the collector must never see a partial one
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(format_prometheus(snapshots))
+        os.replace(temporary, self.filename)
+
+
+def format_prometheus(snapshots):
+    """
+    :param snapshots: list of Progress.snapshot()
+    :return: str, Prometheus text exposition format
+    """
+    metrics = [
+        ('ysc_job_done', 'done', 'Items processed'),
+        ('ysc_job_total', 'total', 'Items to process'),
+        ('ysc_job_elapsed_seconds', 'elapsed', 'Seconds since the job start'),
+        ('ysc_job_rate', 'rate', 'Items per second'),
+        ('ysc_job_eta_seconds', 'eta', 'Estimated seconds left'),
+        ('ysc_job_utilisation', 'utilisation', 'Busy share of worker time'),
+        ('ysc_job_sample_min', 'min', 'Smallest sampled value'),
+        ('ysc_job_sample_mean', 'mean', 'Mean of sampled values'),
+        ('ysc_job_sample_max', 'max', 'Largest sampled value'),
+    ]
+    lines = []
+    for metric, key, description in metrics:
+        lines.append('# HELP %s %s' % (metric, description))
+        lines.append('# TYPE %s gauge' % metric)
+        for snapshot in snapshots:
+            if snapshot[key] is not None:
+                lines.append('%s{job="%s"} %s' % (metric, snapshot['job'], repr(float(snapshot[key]))))
+    return '\n'.join(lines) + '\n'
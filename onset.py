@@ -3,11 +3,17 @@
 # Nikita Seleznev, 2017
 
 import datetime
+import hashlib
+import json
 import os
 
 import matplotlib.pyplot as plt
 import numpy as np
 
+from render import draw_onset_distribution, onset_distribution_spec
+from seasonality import OnsetCube
+from store import get_month_day
+
 
 class Winter:
     START = datetime.date(1971, 12, 1)
@@ -43,30 +49,20 @@ class Winter:
         # return date.month in [12, 1, 2]
 
 
+def get_onset_count_by_week(onsets, sites, winter=Winter()):
+    """
+    :param onsets: dict, dict[site] = list of datetime.date
+    :return: list of int, number of onsets per week of winter
+    """
+    return OnsetCube.from_onsets({None: onsets}, [None], sites).weekly(winter=winter).tolist()
+
+
 def draw_onset_distribution_by_week(onsets, sites, winter=Winter(),
                                     title=None, save_to_file=None):
-    onset_dates = [0 for _ in range(winter.days_count // 7 + 1)]
-    for site in sites:
-        for date in onsets[site]:
-            try:
-                onset_dates[winter.get_day_index(date) // 7] += 1
-            except ValueError:
-                print(date)
-                pass
+    onset_dates = get_onset_count_by_week(onsets, sites, winter)
 
     fig = plt.figure()
-    if title:
-        plt.title(title)
-    ax = fig.add_subplot(111)
-
-    plt.xlabel('Week of winter')
-    plt.ylabel('Number of epidemics')
-    plt.plot(onset_dates)  # , "x")
-
-    ax.text(0.65, 0.9, 'Overall epidemics: ' + str(sum(onset_dates)),
-            transform=ax.transAxes,
-            style='italic',
-            bbox={'facecolor': 'red', 'alpha': 0.5, 'pad': 10})
+    draw_onset_distribution(fig, onset_distribution_spec(onset_dates, title=title))
 
     if save_to_file:
         os.makedirs(os.path.dirname('./' + save_to_file), exist_ok=True)
@@ -109,3 +105,140 @@ def get_average_ah_vs_onsets(ah_dev, onsets, sites, thresholds,
         average_ah_dev[threshold] = np.average(relative_ah_devs, axis=0)
 
     return average_ah_dev
+
+
+def get_onset_ordinals(onsets, threshold, sites):
+    """
+    Flatten onsets of some sites
+    :return: (array of date.toordinal(), array of indices in sites)
+    """
+    ordinals, site_idx = [], []
+    for idx, site in enumerate(sites):
+        for date in onsets[threshold][site]:
+            ordinals.append(date.toordinal())
+            site_idx.append(idx)
+    return np.array(ordinals, dtype=int), np.array(site_idx, dtype=int)
+
+
+def _get_aligned_ah_dev(store, onset_ordinals, columns, date_shift_range):
+    ordinals = onset_ordinals[:, None] + np.array(date_shift_range, dtype=int)[None, :]
+
+    month, day = get_month_day(ordinals)
+    ordinals += (month == 2) & (day == 29) | (month >= 3) & (month <= 5)  # Same shift as above
+
+    return store.dev[store.rows(ordinals), columns[:, None]]
+
+
+def _get_columns(store, sites, site_resolver):
+    return np.array(store.columns(
+        [site_resolver[site]['name'] for site in sites]), dtype=int)
+
+
+def get_onset_aligned_ah_dev(store, onsets, threshold, sites,
+                             date_shift_range, site_resolver):
+    """
+    What get_average_ah_vs_onsets averages, for every onset at once
+    :param store: store.DailyStore of absolute humidity by site name
+    :return: (array (onset x shift) of AH', array of indices in sites)
+    """
+    onset_ordinals, site_idx = get_onset_ordinals(onsets, threshold, sites)
+    columns = _get_columns(store, sites, site_resolver)
+    return _get_aligned_ah_dev(store, onset_ordinals, columns[site_idx],
+                               date_shift_range), site_idx
+
+
+def get_average_ah_dev_tensor(store, onsets, thresholds, sites,
+                              date_shift_range, site_resolver):
+    """
+    get_average_ah_vs_onsets for every site separately, in one pass
+    :return: (array (threshold x site x shift) of average AH', NaN if a site
+        has no onsets, array (threshold x site) of onset counts)
+    """
+    parts = [get_onset_ordinals(onsets, threshold, sites) for threshold in thresholds]
+    onset_ordinals = np.concatenate([ordinals for ordinals, _ in parts] + [[]]).astype(int)
+    site_idx = np.concatenate([idx for _, idx in parts] + [[]]).astype(int)
+    threshold_idx = np.repeat(np.arange(len(thresholds)), [len(idx) for _, idx in parts])
+
+    columns = _get_columns(store, sites, site_resolver)
+    curves = _get_aligned_ah_dev(store, onset_ordinals, columns[site_idx], date_shift_range)
+
+    sums = np.zeros((len(thresholds), len(sites), len(date_shift_range)))
+    np.add.at(sums, (threshold_idx, site_idx), curves)
+    counts = np.zeros((len(thresholds), len(sites)), dtype=int)
+    np.add.at(counts, (threshold_idx, site_idx), 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts[:, :, None], counts
+
+
+def _get_store_digest(store):
+    """md5 of the dates, sites and AH' of a store.DailyStore"""
+    digest = hashlib.md5(json.dumps([str(site) for site in store.sites]).encode('utf8'))
+    digest.update(np.ascontiguousarray(store.ordinals, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(store.dev).tobytes())
+    return digest.hexdigest()
+
+
+def _get_onsets_digest(onsets, thresholds, sites):
+    """md5 of the onset dates of the thresholds and sites"""
+    dates = [[[date.toordinal() for date in onsets[threshold][site]] for site in sites]
+             for threshold in thresholds]
+    return hashlib.md5(json.dumps(dates).encode('utf8')).hexdigest()
+
+
+def rank_sites_by_ah_dip(store, onsets, thresholds, sites, date_shift_range,
+                         site_resolver, anomaly_peaks=range(-28, 0),
+                         deep_level=-0.0003, min_onsets=1, filename=None, winter=None):
+    """
+    Rank sites by the lowest average AH' before onsets over all thresholds
+    :param anomaly_peaks: range of days relative to onset to look for a dip
+    :param deep_level: float, sites dipping below it are marked 'deep'
+    :param min_onsets: int, ignore thresholds with fewer onsets for a site
+    :param filename: str, json cache, reused while the parameters, the
+        store and the onset dates match
+    :param winter: Winter of the onsets, recorded in the cache key
+    :return: list of dicts, sorted by depth, such as {
+            'site': 42, 'depth': -0.0004, 'day': -12, 'threshold': 0.02,
+            'onset_count': 11, 'deep': True
+        }, depth is None if no threshold has min_onsets onsets
+    """
+    params = {'thresholds': list(thresholds), 'sites': list(sites),
+              'anomaly_peaks': list(anomaly_peaks), 'deep_level': deep_level,
+              'min_onsets': min_onsets, 'date_shift_range': list(date_shift_range),
+              'winter': [winter.START.isoformat(), winter.END.isoformat()] if winter else None,
+              'store': _get_store_digest(store),
+              'onsets': _get_onsets_digest(onsets, thresholds, sites)}
+    if filename and os.path.isfile(filename):
+        with open(filename, 'r') as f:
+            saved = json.load(f)
+        if saved['params'] == params:
+            return saved['ranking']
+
+    averages, counts = get_average_ah_dev_tensor(
+        store, onsets, thresholds, sites, date_shift_range, site_resolver)
+
+    idxs = np.array(anomaly_peaks, dtype=int) - date_shift_range[0]
+    window = np.where(counts[:, :, None] >= min_onsets, averages[:, :, idxs], np.inf)
+    dip_idx = window.argmin(axis=2)  # threshold x site
+    dips = window.min(axis=2)
+    best = dips.argmin(axis=0)  # site
+
+    ranking = []
+    for site_idx, site in enumerate(sites):
+        threshold_idx = best[site_idx]
+        depth = float(dips[threshold_idx, site_idx])
+        found = np.isfinite(depth)
+        ranking.append({
+            'site': site,
+            'depth': depth if found else None,
+            'day': int(anomaly_peaks[dip_idx[threshold_idx, site_idx]]) if found else None,
+            'threshold': thresholds[threshold_idx] if found else None,
+            'onset_count': int(counts[threshold_idx, site_idx]),
+            'deep': bool(found and depth < deep_level),
+        })
+    ranking.sort(key=lambda x: float('inf') if x['depth'] is None else x['depth'])
+
+    if filename:
+        os.makedirs(os.path.dirname('./' + filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(json.dumps({'params': params, 'ranking': ranking}))
+    return ranking
@@ -0,0 +1,194 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Out-of-core mode for county-level or gridded humidity: 10^4..10^5
+    daily series kept in .npy files on disk and processed by chunks of
+    sites, so peak memory depends on the budget and not on the site count.
+
+    A store directory holds:
+        meta.json     sites and dtype
+        ordinals.npy  date.toordinal() of every row, sorted, without 29.02
+        values.npy    (date x site), column-major, float32 or float64
+        mean.npy      (365 x site) all-time mean, after compute_anomalies
+        dev.npy       (date x site) AH', after compute_anomalies
+"""
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+from hypothesis import INTERVAL_LENGTH, get_onset_prior_ah_dev
+from ingest import MIN_CHUNK_SIZE, parse_chunk, read_header
+from onset import get_onset_aligned_ah_dev
+from store import DAYS_IN_YEAR, DateIndex, get_day_of_year_mean
+
+DEFAULT_MEMORY_BUDGET = 256 << 20  # bytes
+WORKING_COPIES = 4  # float64 chunk, NaN mask, anomaly and a written buffer
+
+
+class MemmapStore(DateIndex):
+    """
+    DailyStore on disk: same indexes, values/mean/dev are memory maps
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(self._path('meta.json'), 'r') as f:
+            meta = json.load(f)
+        ordinals = np.load(self._path('ordinals.npy'))
+        self._build_index([datetime.date.fromordinal(int(x)) for x in ordinals],
+                          meta['sites'])
+        self.dtype = np.dtype(meta['dtype'])
+
+        self.values = np.load(self._path('values.npy'), mmap_mode='r')
+        self.mean, self.dev = None, None
+        if os.path.isfile(self._path('dev.npy')):
+            self.mean = np.load(self._path('mean.npy'), mmap_mode='r')
+            self.dev = np.load(self._path('dev.npy'), mmap_mode='r')
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _create(directory, ordinals, sites, dtype):
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'ordinals.npy'), np.asarray(ordinals, dtype=int))
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            f.write(json.dumps({'sites': list(sites), 'dtype': np.dtype(dtype).name}))
+        return open_memmap(os.path.join(directory, 'values.npy'), mode='w+', dtype=dtype,
+                           shape=(len(ordinals), len(sites)), fortran_order=True)
+
+    @classmethod
+    def from_arrays(cls, directory, dates, sites, values, dtype=np.float64):
+        """
+        :param dates: list of datetime.date, sorted, without 29.02
+        :param values: array-like (date x site)
+        """
+        stored = cls._create(directory, [date.toordinal() for date in dates], sites, dtype)
+        stored[:] = values
+        stored.flush()
+        del stored
+        return cls(directory)
+
+    @classmethod
+    def from_wide_csv(cls, filename, directory, dtype=np.float32, delimiter=';',
+                      date_name='Date', workers=None, chunk_size=MIN_CHUNK_SIZE * 16,
+                      memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Parse a wide csv (a column per site) by byte-range chunks, `workers`
+        chunks at a time, spill rows to disk and transpose them by site chunks
+        """
+        header, data_start = read_header(filename, delimiter)
+        date_column = header.index(date_name)
+        columns = [idx for idx, name in enumerate(header) if idx != date_column]
+        sites = [header[idx] for idx in columns]
+
+        size = os.path.getsize(filename)
+        bounds = list(range(data_start, size, chunk_size)) + [size]
+        tasks = [(filename, start, end, delimiter, date_column, columns)
+                 for start, end in zip(bounds[:-1], bounds[1:])]
+
+        os.makedirs(directory, exist_ok=True)
+        spill = os.path.join(directory, 'rows.tmp')
+        ordinals = []
+        with open(spill, 'wb') as f, ProcessPoolExecutor(max_workers=workers) as executor:
+            batch = workers or os.cpu_count() or 1
+            for first in range(0, len(tasks), batch):
+                for chunk_ordinals, chunk_values in executor.map(
+                        parse_chunk, *zip(*tasks[first:first + batch])):
+                    ordinals.append(chunk_ordinals)
+                    f.write(chunk_values.astype(dtype).tobytes())
+
+        ordinals = np.concatenate(ordinals + [np.zeros(0, dtype=int)])
+        order = np.argsort(ordinals, kind='mergesort')
+        rows = np.memmap(spill, dtype=dtype, mode='r', shape=(len(ordinals), len(sites)))
+
+        stored = cls._create(directory, ordinals[order], sites, dtype)
+        width = _get_chunk_width(len(ordinals), memory_budget)
+        for first in range(0, len(sites), width):
+            stored[:, first:first + width] = rows[order, first:first + width]
+        stored.flush()
+        del stored, rows
+        os.remove(spill)
+        return cls(directory)
+
+    def site_chunks(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        :return: list of slices of columns, each fits the memory budget
+        """
+        width = _get_chunk_width(len(self.dates), memory_budget)
+        return [slice(first, min(first + width, len(self.sites)))
+                for first in range(0, len(self.sites), width)]
+
+    def compute_anomalies(self, memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Write the climatology (mean.npy) and AH' (dev.npy) chunk by chunk
+        """
+        mean = open_memmap(self._path('mean.npy'), mode='w+', dtype=self.dtype,
+                           shape=(DAYS_IN_YEAR, len(self.sites)), fortran_order=True)
+        dev = open_memmap(self._path('dev.npy'), mode='w+', dtype=self.dtype,
+                          shape=self.values.shape, fortran_order=True)
+
+        for chunk in self.site_chunks(memory_budget):
+            values = np.asarray(self.values[:, chunk], dtype=float)
+            chunk_mean = get_day_of_year_mean(values, self.day_of_year)
+            mean[:, chunk] = chunk_mean
+            dev[:, chunk] = values - chunk_mean[self.day_of_year]
+            dev.flush()
+
+        mean.flush()
+        del mean, dev
+        self.mean = np.load(self._path('mean.npy'), mmap_mode='r')
+        self.dev = np.load(self._path('dev.npy'), mmap_mode='r')
+
+    def onset_aggregates(self, onsets, thresholds, sites, site_resolver,
+                         date_shift_range, interval_length=INTERVAL_LENGTH,
+                         memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Onset-aligned AH' sums and onset-prior samples, chunk by chunk of sites
+        :return: dict, dict[threshold] = {
+                'sums': array (site x shift), sum of AH' over onsets,
+                'counts': array, onsets per site,
+                'samples': array, onset-prior AH' of every onset,
+                'sample_sites': array, indices in sites of the samples
+            }, sums / counts[:, None] is onset.get_average_ah_vs_onsets per site
+        """
+        if self.dev is None:
+            raise ValueError('no AH\' in %s, call compute_anomalies first' % self.directory)
+        sites = list(sites)
+        width = _get_chunk_width(len(self.dates), memory_budget)
+        result = dict()
+
+        for threshold in thresholds:
+            sums = np.zeros((len(sites), len(date_shift_range)))
+            counts = np.zeros(len(sites), dtype=int)
+            samples, sample_sites = [], []
+
+            for first in range(0, len(sites), width):
+                chunk = sites[first:first + width]
+                curves, site_idx = get_onset_aligned_ah_dev(
+                    self, onsets, threshold, chunk, date_shift_range, site_resolver)
+                np.add.at(sums, first + site_idx, curves)
+                counts += np.bincount(first + site_idx, minlength=len(sites))
+
+                chunk_samples, site_idx = get_onset_prior_ah_dev(
+                    self, onsets, threshold, chunk, site_resolver, interval_length)
+                samples.append(chunk_samples)
+                sample_sites.append(first + site_idx)
+
+            result[threshold] = {
+                'sums': sums,
+                'counts': counts,
+                'samples': np.concatenate(samples + [np.zeros(0)]),
+                'sample_sites': np.concatenate(sample_sites + [np.zeros(0, dtype=int)]),
+            }
+        return result
+
+
+def _get_chunk_width(rows, memory_budget):
+    """Sites per chunk, so that WORKING_COPIES float64 columns fit the budget"""
+    return max(1, int(memory_budget // (rows * 8 * WORKING_COPIES)))
@@ -0,0 +1,219 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Multi-resolution aggregates of daily series per site:
+        day -> week (Monday-anchored) -> month -> season (July to June,
+        the winter of Winter.START.year)
+    Every bucket keeps sum, count, min and max of the valid (non-NaN)
+    values. Weeks and months are reduced from days and seasons from months.
+    Appending new days updates every level in place of a rebuild: buckets
+    after the last one are appended to arrays grown by doubling, only the
+    last bucket is combined, and days before it merge all the buckets.
+
+    Week buckets aggregate all days of a week; get_relative_weekly_morbidity_excess
+    keeps the value of the last day of a week instead.
+"""
+import datetime
+
+import numpy as np
+
+from store import EPOCH_ORDINAL, parse_date
+
+LEVELS = ('day', 'week', 'month', 'season')
+STATS = ('sum', 'count', 'min', 'max', 'mean')
+
+
+def get_bucket_keys(ordinals, level):
+    """
+    :param ordinals: array of date.toordinal()
+    :return: array of bucket keys: the ordinal of the day or of the Monday,
+        months since 01.1970 or the year the season starts
+    """
+    ordinals = np.asarray(ordinals, dtype=int)
+    if level == 'day':
+        return ordinals
+    if level == 'week':
+        return ordinals - (ordinals - 1) % 7  # Ordinal 1 is a Monday
+    months = (ordinals - EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]').astype(int)
+    if level == 'month':
+        return months
+    if level == 'season':
+        return _get_season_of_month(months)
+    raise ValueError('unknown level %s, use one of %s' % (level, LEVELS))
+
+
+def _get_season_of_month(months):
+    return months // 12 + 1970 - (months % 12 < 6)
+
+
+def _reduce(keys, sums, counts, mins, maxs):
+    """
+    Aggregate rows with equal keys, keys are sorted
+    :return: (unique keys, sums, counts, mins, maxs)
+    """
+    if not len(keys):
+        return keys, sums, counts, mins, maxs
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    return keys[starts], np.add.reduceat(sums, starts), np.add.reduceat(counts, starts), \
+        np.fmin.reduceat(mins, starts), np.fmax.reduceat(maxs, starts)
+
+
+class Pyramid:
+    """
+    levels: dict, level -> {'keys': array, 'sum', 'count', 'min', 'max':
+        array (bucket x site)}
+    """
+
+    def __init__(self, ordinals, sites, values):
+        """
+        :param ordinals: array of date.toordinal(), any order, 29.02 included
+        :param values: array (date x site), NaN for gaps
+        """
+        self.sites = list(sites)
+        self.site_index = {site: idx for idx, site in enumerate(self.sites)}
+        empty = np.zeros((0, len(self.sites)))
+        self.levels = dict()
+        self._buffers = dict()  # level -> arrays of self.levels[level] and spare rows
+        for level in LEVELS:
+            self._set(level, {'keys': np.zeros(0, dtype=int), 'sum': empty, 'count': empty,
+                              'min': empty, 'max': empty}, 0)
+        self.update(ordinals, values)
+
+    @classmethod
+    def from_store(cls, store, anomaly=False):
+        """
+        :param store: store.DailyStore, e.g. of absolute humidity
+        :param anomaly: bool, aggregate AH' instead of AH
+        """
+        return cls(store.ordinals, store.sites, store.dev if anomaly else store.values)
+
+    @classmethod
+    def from_series(cls, series):
+        """
+        :param series: dict, dict['Site']['dd.mm.year'] = value, such as
+            russia.get_daily_morbidity or get_morbidity_excess
+        """
+        sites = list(series.keys())
+        ordinals = sorted(set(parse_date(date_str).toordinal()
+                              for info in series.values() for date_str in info))
+        row_of = {ordinal: row for row, ordinal in enumerate(ordinals)}
+        values = np.full((len(ordinals), len(sites)), np.nan)
+        for column, info in enumerate(series.values()):
+            for date_str, value in info.items():
+                values[row_of[parse_date(date_str).toordinal()], column] = value
+        return cls(ordinals, sites, values)
+
+    def update(self, ordinals, values):
+        """
+        Add days that are not in the pyramid yet, every level is merged
+        with the aggregates of the new days only
+        :param ordinals: array of date.toordinal()
+        :param values: array (date x site)
+        """
+        ordinals = np.asarray(ordinals, dtype=int)
+        values = np.asarray(values, dtype=float).reshape(len(ordinals), len(self.sites))
+        known = self.levels['day']['keys']
+        if len(np.unique(ordinals)) != len(ordinals) or len(known) and len(ordinals) and \
+                ordinals.min() <= known[-1] and np.isin(ordinals, known).any():
+            raise ValueError('days are already in the pyramid, values can only be added')
+
+        order = np.argsort(ordinals, kind='mergesort')
+        ordinals, values = ordinals[order], values[order]
+        valid = ~np.isnan(values)
+        days = (ordinals, np.where(valid, values, 0.), valid.astype(float), values, values)
+
+        weeks = _reduce(get_bucket_keys(days[0], 'week'), *days[1:])
+        months = _reduce(get_bucket_keys(days[0], 'month'), *days[1:])
+        seasons = _reduce(_get_season_of_month(months[0]), *months[1:])
+
+        for level, update in zip(LEVELS, (days, weeks, months, seasons)):
+            self._merge(level, *update)
+
+    def _set(self, level, buffers, size):
+        self._buffers[level] = buffers
+        self.levels[level] = {stat: array[:size] for stat, array in buffers.items()}
+
+    def _merge(self, level, keys, sums, counts, mins, maxs):
+        old = self.levels[level]
+        size = len(old['keys'])
+        if not len(keys):
+            return
+        if not size or keys[0] >= old['keys'][-1]:
+            self._append(level, keys, sums, counts, mins, maxs)
+            return
+
+        merged = np.union1d(old['keys'], keys)
+        old_idx = np.searchsorted(merged, old['keys'])
+        new_idx = np.searchsorted(merged, keys)
+
+        result = {'keys': merged}
+        for stat, values, combine in (('sum', sums, np.add), ('count', counts, np.add),
+                                      ('min', mins, np.fmin), ('max', maxs, np.fmax)):
+            array = np.full((len(merged), len(self.sites)), 0. if stat in ('sum', 'count') else np.nan)
+            array[old_idx] = old[stat]
+            array[new_idx] = combine(array[new_idx], values)
+            result[stat] = array
+        self._set(level, result, len(merged))
+
+    def _append(self, level, keys, sums, counts, mins, maxs):
+        """
+        Merge buckets from the last one on, keys are sorted
+        """
+        old = self.levels[level]
+        size = len(old['keys'])
+        if size and keys[0] == old['keys'][-1]:  # Days of the last bucket
+            old['sum'][-1] += sums[0]
+            old['count'][-1] += counts[0]
+            old['min'][-1] = np.fmin(old['min'][-1], mins[0])
+            old['max'][-1] = np.fmax(old['max'][-1], maxs[0])
+            keys, sums, counts, mins, maxs = keys[1:], sums[1:], counts[1:], mins[1:], maxs[1:]
+
+        buffers = self._buffers[level]
+        if size + len(keys) > len(buffers['keys']):
+            capacity = max(2 * len(buffers['keys']), size + len(keys))
+            grown = dict()
+            for stat, array in buffers.items():
+                grown[stat] = np.empty((capacity, ) + array.shape[1:], dtype=array.dtype)
+                grown[stat][:size] = array[:size]
+            buffers = grown
+        for stat, values in (('keys', keys), ('sum', sums), ('count', counts), ('min', mins),
+                             ('max', maxs)):
+            buffers[stat][size:size + len(keys)] = values
+        self._set(level, buffers, size + len(keys))
+
+    def get(self, level, stat='mean', sites=None, start=None, end=None):
+        """
+        :param stat: one of STATS
+        :param sites: list of str, all sites by default
+        :param start: datetime.date, first bucket that holds this day
+        :param end: datetime.date, last bucket that holds this day
+        :return: (array of bucket keys, array (bucket x site))
+        """
+        if stat not in STATS:
+            raise ValueError('unknown stat %s, use one of %s' % (stat, STATS))
+        buckets = self.levels[level]
+        keys = buckets['keys']
+        first = 0 if start is None else \
+            int(np.searchsorted(keys, get_bucket_keys([start.toordinal()], level)[0]))
+        last = len(keys) if end is None else \
+            int(np.searchsorted(keys, get_bucket_keys([end.toordinal()], level)[0], side='right'))
+        columns = slice(None) if sites is None else [self.site_index[site] for site in sites]
+
+        if stat == 'mean':
+            with np.errstate(invalid='ignore', divide='ignore'):
+                values = buckets['sum'][first:last] / buckets['count'][first:last]
+        else:
+            values = buckets[stat][first:last]
+        return keys[first:last], values[:, columns]
+
+    @staticmethod
+    def bucket_dates(keys, level):
+        """
+        :return: list of datetime.date, the first day of every bucket
+        """
+        if level in ('day', 'week'):
+            return [datetime.date.fromordinal(int(key)) for key in keys]
+        if level == 'month':
+            return [datetime.date(1970 + int(key) // 12, int(key) % 12 + 1, 1) for key in keys]
+        return [datetime.date(int(key), 7, 1) for key in keys]
@@ -0,0 +1,145 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Regions (groups of sites) from a config file, and region-level
+    onset-aligned AH' curves and onset-prior AH' samples.
+
+    Per-site sums are computed once; a batch of regions is then a sparse
+    (region x site) membership matrix product, so overlapping regions and
+    hundreds of alternative regionalisations cost almost nothing.
+"""
+from collections import OrderedDict
+import json
+import random
+
+import numpy as np
+from scipy import sparse
+
+from hypothesis import INTERVAL_LENGTH, get_onset_prior_ah_dev
+from onset import get_onset_aligned_ah_dev
+
+
+def load_regions(filename):
+    """
+    :param filename: str, json file such as
+        {"sw": {"title": "Southwest States", "sites": [3, 6, 29, 32, 45]}}
+    :return: OrderedDict, dict['sw'] = {'title': str, 'sites': list}
+    """
+    with open(filename, 'r') as f:
+        regions = json.load(f, object_pairs_hook=OrderedDict)
+    for name, region in regions.items():
+        region.setdefault('title', name)
+    return regions
+
+
+def get_random_partition(sites, count, seed=None, prefix='random'):
+    """
+    :return: OrderedDict of count regions covering all the sites
+    """
+    shuffled = list(sites)
+    random.Random(seed).shuffle(shuffled)
+    return OrderedDict(
+        ('%s%d' % (prefix, idx), {'title': 'Random region %d' % idx,
+                                  'sites': sorted(shuffled[idx::count])})
+        for idx in range(count))
+
+
+class RegionEngine:
+    """
+    Region aggregates of AH' around onsets, cached per region
+    """
+
+    def __init__(self, store, onsets, thresholds, sites, site_resolver,
+                 date_shift_range, interval_length=INTERVAL_LENGTH):
+        """
+        :param store: store.DailyStore of absolute humidity by site name
+        :param sites: list, every site any region may contain
+        """
+        self.sites = list(sites)
+        self.site_index = {site: idx for idx, site in enumerate(self.sites)}
+        self.thresholds = list(thresholds)
+        self.date_shift_range = date_shift_range
+
+        self._counts = dict()   # threshold: array, onsets per site
+        self._sums = dict()     # threshold: array (site x shift), sum of AH' curves
+        self._samples = dict()  # threshold: array, onset-prior AH' per onset
+        self._owners = dict()   # threshold: sparse (site x onset) indicator
+        for threshold in self.thresholds:
+            curves, site_idx = get_onset_aligned_ah_dev(
+                store, onsets, threshold, self.sites,
+                date_shift_range, site_resolver)
+            sums = np.zeros((len(self.sites), len(date_shift_range)))
+            np.add.at(sums, site_idx, curves)
+            self._sums[threshold] = sums
+            self._counts[threshold] = np.bincount(site_idx, minlength=len(self.sites))
+
+            samples, site_idx = get_onset_prior_ah_dev(
+                store, onsets, threshold, self.sites, site_resolver,
+                interval_length)
+            self._samples[threshold] = samples
+            self._owners[threshold] = sparse.csr_matrix(
+                (np.ones(len(site_idx)), (site_idx, np.arange(len(site_idx)))),
+                shape=(len(self.sites), len(site_idx)))
+
+        self._cache = dict()  # (name, sites): result
+
+    def membership(self, regions):
+        """
+        :param regions: OrderedDict, see load_regions
+        :return: sparse (region x site) 0/1 matrix
+        """
+        rows, columns = [], []
+        for row, region in enumerate(regions.values()):
+            for site in set(region['sites']):
+                rows.append(row)
+                columns.append(self.site_index[site])
+        return sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, columns)),
+            shape=(len(regions), len(self.sites)))
+
+    def aggregate(self, regions):
+        """
+        :param regions: OrderedDict, see load_regions
+        :return: OrderedDict, dict['sw'] = {
+                'average_ah_dev': {threshold: array over date_shift_range},
+                'samples': {threshold: array of onset-prior AH'},
+                'onset_count': {threshold: int},
+            }, average_ah_dev as in onset.get_average_ah_vs_onsets
+        """
+        keys = OrderedDict((name, (name, tuple(sorted(set(region['sites'])))))
+                           for name, region in regions.items())
+        missing = OrderedDict((name, region) for name, region in regions.items()
+                              if keys[name] not in self._cache)
+
+        if missing:
+            membership = self.membership(missing)
+            results = [{'average_ah_dev': dict(), 'samples': dict(), 'onset_count': dict()}
+                       for _ in missing]
+
+            for threshold in self.thresholds:
+                counts = membership.dot(self._counts[threshold])
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    averages = membership.dot(self._sums[threshold]) / counts[:, None]
+                region_onsets = membership.dot(self._owners[threshold]).tocsr()
+                region_onsets.sort_indices()
+
+                for row, result in enumerate(results):
+                    onset_idx = region_onsets.indices[
+                        region_onsets.indptr[row]:region_onsets.indptr[row + 1]]
+                    result['average_ah_dev'][threshold] = averages[row]
+                    result['samples'][threshold] = self._samples[threshold][onset_idx]
+                    result['onset_count'][threshold] = int(counts[row])
+
+            for name, result in zip(missing, results):
+                self._cache[keys[name]] = result
+
+        return OrderedDict((name, self._cache[keys[name]]) for name in regions)
+
+    def release(self, regions=None):
+        """Drop cached results of some regions, or of all of them"""
+        if regions is None:
+            self._cache.clear()
+            return
+        for key in [key for key in self._cache if key[0] in regions]:
+            del self._cache[key]
@@ -0,0 +1,196 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Batch rendering of the figures from ah.py and onset.py.
+
+    A plot is described by a spec, a plain picklable dict with a 'kind'
+    ('ah_dev', 'ah_mean' or 'onset_distribution'), the data to draw and
+    'save_to_file'. Specs are rendered on a process pool without pyplot:
+    every worker keeps one Agg figure per kind and clears it between plots,
+    so neither the figure manager nor global rcParams are touched.
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import datetime
+from itertools import repeat
+import os
+
+import matplotlib
+import matplotlib.dates as plt_dates
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from matplotlib.ticker import ScalarFormatter
+
+from metrics import collect, timed
+
+FIGURE_SIZES = {'ah_dev': (10, 6), 'ah_mean': (10, 6), 'onset_distribution': None}
+FONT_SIZES = {'ah_dev': 14, 'ah_mean': 14, 'onset_distribution': None}
+
+_templates = dict()  # kind: Figure, one per worker process
+
+
+def ah_dev_spec(average_ah_dev, colors, date_shift_range,
+                limits=(-7e-4, 5e-4), title=None, save_to_file=None):
+    """
+    Same arguments as ah.plot_average_ah_dev
+    :return: dict, plot spec
+    """
+    return {
+        'kind': 'ah_dev',
+        'curves': {threshold: list(average)
+                   for threshold, average in average_ah_dev.items()},
+        'colors': dict(colors),
+        'x': list(date_shift_range),
+        'limits': tuple(limits),
+        'title': title,
+        'save_to_file': save_to_file,
+    }
+
+
+def ah_mean_spec(ah_mean, sites, colors, title=None, save_to_file=None):
+    """
+    Same arguments as ah.draw_ah_mean
+    :return: dict, plot spec
+    """
+    from ah import get_ah_mean_for_site
+
+    return {
+        'kind': 'ah_mean',
+        'curves': OrderedDict(
+            (site, get_ah_mean_for_site(ah_mean, site)) for site in sites),
+        'colors': dict(colors),
+        'title': title,
+        'save_to_file': save_to_file,
+    }
+
+
+def onset_distribution_spec(onset_dates, title=None, save_to_file=None):
+    """
+    :param onset_dates: list of int, number of onsets per week of winter,
+        see onset.get_onset_count_by_week
+    :return: dict, plot spec
+    """
+    return {
+        'kind': 'onset_distribution',
+        'counts': list(onset_dates),
+        'title': title,
+        'save_to_file': save_to_file,
+    }
+
+
+def draw_ah_dev(fig, spec):
+    ax = fig.add_subplot(111)
+    if spec['title']:
+        ax.set_title(spec['title'])
+    ax.set_xlabel('Day Relative to Onset')
+    ax.set_ylabel('Absolute Humidity Anomaly (kg/kg)')
+
+    # Equal axis range
+    ax.set_ylim(spec['limits'])
+
+    # Enable scaling and 10^k formatting
+    xfmt = ScalarFormatter(useMathText=True)
+    xfmt.set_powerlimits((0, 0))
+    ax.yaxis.set_major_formatter(xfmt)
+
+    # Dashed line for AH' = 0
+    x = spec['x']
+    ax.plot((x[0], x[-1]), (0, 0), 'k--')
+
+    for threshold, average in spec['curves'].items():
+        ax.plot(x, average,
+                spec['colors'].get(threshold, '') + '-', label=str(threshold))
+
+    if len(spec['curves']) > 1:  # One threshold => omit a legend
+        ax.legend(loc='best', fancybox=True, shadow=True)
+
+
+def draw_ah_mean(fig, spec):
+    ax = fig.add_subplot(111)
+    if spec['title']:
+        ax.set_title(spec['title'])
+
+    date_first = datetime.datetime(1970, 1, 1)
+    date_range = [date_first + datetime.timedelta(days=day)
+                  for day in range(365)]
+
+    # DATES on Ox
+    for site, values in spec['curves'].items():
+        ax.plot(date_range, values, spec['colors'].get(site, 'k') + '-',
+                label=site, linewidth=2.0)
+
+    ax.xaxis.set_major_formatter(plt_dates.DateFormatter('%d.%m'))
+    ax.legend(loc='best', fancybox=True, shadow=True)
+    ax.grid()
+
+
+def draw_onset_distribution(fig, spec):
+    ax = fig.add_subplot(111)
+    if spec['title']:
+        ax.set_title(spec['title'])
+
+    ax.set_xlabel('Week of winter')
+    ax.set_ylabel('Number of epidemics')
+    ax.plot(spec['counts'])
+
+    ax.text(0.65, 0.9, 'Overall epidemics: ' + str(sum(spec['counts'])),
+            transform=ax.transAxes,
+            style='italic',
+            bbox={'facecolor': 'red', 'alpha': 0.5, 'pad': 10})
+
+
+DRAWERS = {
+    'ah_dev': draw_ah_dev,
+    'ah_mean': draw_ah_mean,
+    'onset_distribution': draw_onset_distribution,
+}
+
+
+def _get_template(kind):
+    """Agg figure reused for every spec of that kind in this process"""
+    if kind not in _templates:
+        fig = Figure(figsize=FIGURE_SIZES[kind])
+        FigureCanvasAgg(fig)
+        _templates[kind] = fig
+    return _templates[kind]
+
+
+def render_figure(spec):
+    """
+    Draw a spec on the template figure and save it
+    :return: str, path of the saved file
+    """
+    filename = spec['save_to_file']
+    if not filename:
+        raise ValueError('spec of kind %s has no save_to_file' % spec['kind'])
+    os.makedirs(os.path.dirname('./' + filename), exist_ok=True)
+
+    fig = _get_template(spec['kind'])
+    fig.clf()
+
+    rc = dict()
+    if FONT_SIZES[spec['kind']]:
+        rc['font.size'] = FONT_SIZES[spec['kind']]
+    with matplotlib.rc_context(rc):
+        DRAWERS[spec['kind']](fig, spec)
+        fig.savefig(filename, bbox_inches='tight')
+    return filename
+
+
+def render_figures(specs, workers=None, chunksize=4, progress=None):
+    """
+    Render many plot specs, e.g. a figure per state and winter window
+    :param specs: list of dicts, see *_spec functions above
+    :param workers: int, size of the process pool, None for CPU count,
+        1 to render in the current process
+    :param progress: metrics.Progress, advanced with the busy time of every figure
+    :return: list of str, saved filenames in order of specs
+    """
+    specs = list(specs)
+    if workers == 1 or len(specs) <= 1:
+        return collect((timed(render_figure, spec) for spec in specs), progress)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return collect(executor.map(timed, repeat(render_figure), specs, chunksize=chunksize),
+                       progress, min(workers or os.cpu_count() or 1, len(specs)))
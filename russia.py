@@ -6,14 +6,26 @@ import copy
 import csv
 import datetime
 import json
+import os
 import time
 from collections import OrderedDict
 
+import numpy as np
 from scipy import stats
 
 from ah import get_ah_mean, get_ah_deviation, plot_average_ah_dev, draw_ah_mean
-from hypothesis import generate_control_sample, generate_experimental_sample
+from hypothesis import CONTROL_SAMPLE_SIZE, ControlPool, ControlPopulation, generate_control_sample, \
+    generate_experimental_sample, get_onset_prior_ah_dev, get_ttest_table, get_window_sensitivity
+from calibration import ThresholdTable
+from features import LaggedFeatures
+from ingest import get_store_from_site_files, read_site_files
+from metrics import MetricsExporter
 from onset import get_average_ah_vs_onsets, Winter, draw_onset_distribution_by_week
+from render import onset_distribution_spec, render_figures
+from seasonality import OnsetCube
+from store import DailyStore
+from stream import MorbidityStream, detect, follow_site_file, get_morbidity_detector, read_socket
+from xcorr import get_ah_excess_cross_correlation
 
 AH_FILE_PATTERN = 'data/flu_dbase/%s.txt'
 POPULATION_CSV_PATTERN = 'data/population/%s.csv'
@@ -81,25 +93,36 @@ def get_ah(cities):
     return data
 
 
-def get_daily_morbidity(cities):
+def get_ah_store(cities, workers=None):
     """
+    get_ah parsed in parallel into a columnar store
+    :return: store.DailyStore, columns are 'City Name'
+    """
+    city_resolver = get_city_resolver()
+    return get_store_from_site_files(
+        AH_FILE_PATTERN, cities, 'Humidity',
+        {city: city_resolver[city]['name'] for city in cities}, workers=workers)
+
+
+def get_daily_morbidity(cities, workers=None):
+    """
+    :param workers: int, processes to parse the city files, None for CPU count
     :return: dict, dict['City Code']['dd.mm.year'] = absolute morbidity
     """
     data = dict()
-    for city_code in cities:
+    parsed = read_site_files(AH_FILE_PATTERN, cities, ['Incidence'],
+                             workers=workers, skip_leap_days=False)
+    for city_code, (ordinals, values) in parsed.items():
         data[city_code] = OrderedDict()
 
-        with open(AH_FILE_PATTERN % city_code, 'r') as csv_file:
-            for row in csv.DictReader(csv_file, delimiter=' '):
-                morbidity = int(row['Incidence'])
+        for ordinal, (morbidity, ) in zip(ordinals, values):
+            date = datetime.date.fromordinal(int(ordinal))
+            date_str = '%02d.%02d.%04d' % (date.day, date.month, date.year)
 
-                date = datetime.datetime.strptime(row['Date'], "%Y%m%d").date()
-                date_str = '%02d.%02d.%04d' % (date.day, date.month, date.year)
-
-                if date_str not in data[city_code]:
-                    data[city_code][date_str] = morbidity
-                else:
-                    data[city_code][date_str] += morbidity
+            if date_str not in data[city_code]:
+                data[city_code][date_str] = int(morbidity)
+            else:
+                data[city_code][date_str] += int(morbidity)
     return data
 
 
@@ -442,6 +465,36 @@ def onset_distribution():
         save_to_file=filename)
 
 
+def onset_distributions(thresholds=range(0, 101, 10)):
+    """
+    Onset distribution of every city and of all of them, for every
+    threshold, sliced from one seasonality cube (October — March)
+    """
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, 10, 1)
+    winter.END = datetime.date(winter.END.year, 3, 31)
+
+    population = get_population(CITIES)
+    morbidity = get_daily_morbidity(CITIES)
+    excess_data = get_relative_weekly_morbidity_excess(
+        get_morbidity_excess(morbidity, get_morbidity_mean(morbidity)), population)
+    cube = OnsetCube.from_onsets(
+        get_onsets_by_morbidity(excess_data, thresholds, winter=winter), thresholds, CITIES)
+
+    city_resolver = get_city_resolver()
+    subsets = [('russia', 'Russia', CITIES)] + \
+              [(city, city_resolver[city]['name'], [city]) for city in CITIES]
+    return render_figures([
+        onset_distribution_spec(
+            cube.weekly([threshold], cities, winter).tolist(),
+            title='Epidemic number distribution in %s, threshold %d' % (title, threshold),
+            save_to_file=f'results/onsets/{name}'
+                         f'_winter{winter.START.month}-{winter.END.month}'
+                         f'_threshold{threshold}.png')
+        for name, title, cities in subsets
+        for threshold in thresholds])
+
+
 def onset_distribution_paris():
     # Params
     THRESHOLDS = [5]
@@ -476,10 +529,19 @@ def onset_distribution_paris():
         save_to_file=filename)
 
 
-def hypothesis_test():
+def hypothesis_test(enumerated=False, scheme='uniform', common=False):
     """
     Parameters
+    :param enumerated: bool, draw control samples from an enumerated
+        hypothesis.ControlPopulation instead of day-by-day lookups
+    :param scheme: str, control sampling of an enumerated population, one
+        of hypothesis.SAMPLING_SCHEMES
+    :param common: bool, with enumerated, derive the control samples of all
+        thresholds from one hypothesis.ControlPool of random windows, uniform
+        scheme only
     """
+    if common and scheme != 'uniform':
+        raise ValueError('common random numbers support the uniform scheme only, not %s' % scheme)
     # THRESHOLDS = [5, 10, 15]
     THRESHOLDS = [5, 10, 15, 20, 25, 28, 30, 35, 40, 43, 44, 45, 50]
     # CITIES = ['spb']
@@ -508,27 +570,44 @@ def hypothesis_test():
     onsets = get_onsets_by_morbidity(excess_data, THRESHOLDS, winter)
     years = range(1986, 2015)
 
-    for threshold in THRESHOLDS:
-        generate_control_sample(
-            onsets, threshold, ah_dev, winter, CITIES, city_resolver, years,
-            filename=f'results/stats/russia/ah_sample.{threshold}.json')
-        generate_experimental_sample(
-            onsets, threshold, ah_dev, winter, CITIES, city_resolver,
-            filename=f'results/stats/russia/epidemic_sample.{threshold}.json')
+    # Cities cover different years, so the store climatology is not get_ah_mean:
+    # with a population both samples are AH' of the store
+    store = get_ah_store(CITIES) if enumerated else None
+    population = ControlPopulation(store, winter, CITIES, city_resolver, years) \
+        if enumerated else None
+    if enumerated and common:
+        population = ControlPool(population, max(
+            sum(len(onsets[threshold][city]) for city in CITIES) for threshold in THRESHOLDS))
+
+    with MetricsExporter('results/metrics/russia_hypothesis.prom') as metrics:
+        for threshold in THRESHOLDS:
+            generate_control_sample(
+                onsets, threshold, ah_dev, winter, CITIES, city_resolver, years,
+                filename=f'results/stats/russia/ah_sample.{threshold}.json',
+                progress=metrics.job(f'russia_control_{threshold}', CONTROL_SAMPLE_SIZE),
+                population=population, scheme=scheme)
+            filename = f'results/stats/russia/epidemic_sample.{threshold}.json'
+            if enumerated:
+                sample, _ = get_onset_prior_ah_dev(store, onsets, threshold, CITIES, city_resolver)
+                with open(filename, 'w') as f:
+                    f.write(json.dumps(sample.tolist()))
+            else:
+                generate_experimental_sample(
+                    onsets, threshold, ah_dev, winter, CITIES, city_resolver, filename=filename)
 
+    control, experimental = [], []
     for threshold in THRESHOLDS:
-        print(f'threshold {threshold}')
         with open(f'results/stats/russia/ah_sample.{threshold}.json', 'r') as f:
-            ah_sample = json.load(f)
+            control.append(json.load(f))
         with open(f'results/stats/russia/epidemic_sample.{threshold}.json', 'r') as f:
-            epidemic_sample = json.load(f)
-
-        print(f"AH' sample size = {len(ah_sample)}")
-        print(f"Epidemic sample size = {len(epidemic_sample)}")
-        # t, prob = stats.ttest_ind(ah_sample, epidemic_sample)
-        # print(f"Equal variance (Student's t-test): P-value = {prob}")
-        t, prob = stats.ttest_ind(ah_sample, epidemic_sample, equal_var=False)
-        print(f"Not equal variance (Welch’s t-test): P-value = {prob}")
+            experimental.append(json.load(f))
+
+    for row in get_ttest_table(THRESHOLDS, control, experimental, equal_var=False, correction='holm'):
+        print(f"threshold {row['label']}")
+        print(f"AH' sample size = {row['control_size']}")
+        print(f"Epidemic sample size = {row['experimental_size']}")
+        print(f"Not equal variance (Welch’s t-test): P-value = {row['p']}, "
+              f"Holm-adjusted {row['p_adjusted']}")
         print()
 
 
@@ -565,19 +644,23 @@ def hypothesis_test_paris():
         generate_experimental_sample(onsets, threshold, ah_dev, winter, PARIS, city_resolver,
                                      filename=f'results/stats/paris/epidemic_sample.{threshold}.json')
 
+    control, experimental = [], []
     for threshold in THRESHOLDS:
-        print(f'threshold {threshold}')
         with open(f'results/stats/paris/ah_sample.{threshold}.json', 'r') as f:
-            ah_sample = json.load(f)
+            control.append(json.load(f))
         with open(f'results/stats/paris/epidemic_sample.{threshold}.json', 'r') as f:
-            epidemic_sample = json.load(f)
-
-        print(f"AH' sample size = {len(ah_sample)}")
-        print(f"Epidemic sample size = {len(epidemic_sample)}")
-        t, prob = stats.ttest_ind(ah_sample, epidemic_sample)
-        print(f"Equal variance (Student's t-test): P-value = {prob}")
-        t, prob = stats.ttest_ind(ah_sample, epidemic_sample, equal_var=False)
-        print(f"Not equal variance (Welch’s t-test): P-value = {prob}")
+            experimental.append(json.load(f))
+
+    student = get_ttest_table(THRESHOLDS, control, experimental, equal_var=True, correction='holm')
+    welch = get_ttest_table(THRESHOLDS, control, experimental, equal_var=False, correction='holm')
+    for student_row, welch_row in zip(student, welch):
+        print(f"threshold {student_row['label']}")
+        print(f"AH' sample size = {student_row['control_size']}")
+        print(f"Epidemic sample size = {student_row['experimental_size']}")
+        print(f"Equal variance (Student's t-test): P-value = {student_row['p']}, "
+              f"Holm-adjusted {student_row['p_adjusted']}")
+        print(f"Not equal variance (Welch’s t-test): P-value = {welch_row['p']}, "
+              f"Holm-adjusted {welch_row['p_adjusted']}")
         print()
 
 
@@ -616,6 +699,149 @@ def hypothesis_test_epidemiologists():
     print()
 
 
+def window_sensitivity():
+    """
+    Hypothesis test P-value for every pre-onset window length and lag
+    """
+    THRESHOLDS = [30, 35, 40, 45]
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, 11, 1)
+    winter.END = datetime.date(winter.END.year, 3, 31)
+
+    city_resolver = get_city_resolver()
+    population = get_population(CITIES)
+    store = get_ah_store(CITIES)
+
+    morbidity = get_daily_morbidity(CITIES)
+    morbidity_mean = get_morbidity_mean(morbidity)
+    morbidity_excess = get_morbidity_excess(
+        morbidity, morbidity_mean)
+    excess_data = get_relative_weekly_morbidity_excess(
+        morbidity_excess, population)
+
+    onsets = get_onsets_by_morbidity(excess_data, THRESHOLDS, winter)
+    years = range(1986, 2015)
+
+    for threshold in THRESHOLDS:
+        grid = get_window_sensitivity(
+            store, onsets, threshold, CITIES, city_resolver, winter, years,
+            lengths=range(7, 61), offsets=range(0, 31))
+
+        filename = f'results/stats/russia/window_sensitivity.{threshold}.json'
+        os.makedirs(os.path.dirname('./' + filename), exist_ok=True)
+        with open(filename, 'w') as f:
+            f.write(json.dumps({key: value.tolist() if hasattr(value, 'tolist') else value
+                                for key, value in grid.items()}))
+
+        best = np.unravel_index(np.nanargmin(grid['p']), grid['p'].shape)
+        print(f'threshold {threshold}: {grid["onset_count"]} onsets, '
+              f'min P-value {grid["p"][best]} for {grid["lengths"][best[0]]} days '
+              f'ending {grid["offsets"][best[1]]} days before onset')
+
+
+def ah_morbidity_cross_correlation():
+    """
+    Lead/lag of morbidity excess after AH' without onset thresholds
+    """
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, 10, 1)
+    winter.END = datetime.date(winter.END.year, 4, 30)
+
+    city_resolver = get_city_resolver()
+    ah_store = get_ah_store(CITIES)
+
+    morbidity = get_daily_morbidity(CITIES)
+    morbidity_mean = get_morbidity_mean(morbidity)
+    excess_store = DailyStore.from_series(
+        get_morbidity_excess(morbidity, morbidity_mean))
+    years = range(1986, 2015)
+
+    for whiten in (False, True):
+        result = get_ah_excess_cross_correlation(
+            ah_store, excess_store, CITIES, city_resolver, winter, years,
+            max_lag=60, whiten=whiten)
+        lag = result['lags'][np.argmin(result['mean'])]
+        print(f'{len(result["pairs"])} city-seasons, pre-whitening {whiten}: '
+              f'the most negative correlation {min(result["mean"])} '
+              f'when AH\' leads morbidity excess by {lag} days')
+
+
+def calibrate_thresholds(targets=(5, 10, 15, 20), rates=(0.25, 0.5)):
+    """
+    Thresholds giving `targets` onsets or `rates` epidemics per winter in
+    every city, instead of hand-tuned THRESHOLDS (October — March)
+    """
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, 10, 1)
+    winter.END = datetime.date(winter.END.year, 3, 31)
+
+    morbidity = get_daily_morbidity(CITIES + PARIS)
+    excess_data = get_relative_weekly_morbidity_excess(
+        get_morbidity_excess(morbidity, get_morbidity_mean(morbidity)),
+        get_population(CITIES + PARIS))
+    table = ThresholdTable.from_morbidity_excess(excess_data, winter)
+
+    for target in targets:
+        print(f'{target} onsets: {table.calibrate(target)}, '
+              f'Russia in total: {table.calibrate_group(target * len(CITIES), CITIES)}')
+    for rate in rates:
+        print(f'{rate} epidemics per winter: {table.calibrate_rate(rate)}, '
+              f'Russia: {table.calibrate_group_rate(rate, CITIES)}')
+    return table
+
+
+def export_features(directory='results/features/russia', lags=28, thresholds=(30, 50)):
+    """
+    Previous `lags` days of AH', temperature and incidence for every city
+    and winter day, labelled by onsets within the next week
+    """
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, 10, 1)
+    winter.END = datetime.date(winter.END.year, 3, 31)
+
+    city_resolver = get_city_resolver()
+    names = {city: city_resolver[city]['name'] for city in CITIES}
+    stores = {name: get_store_from_site_files(AH_FILE_PATTERN, CITIES, column, names)
+              for name, column in (('ah', 'Humidity'), ('temperature', 'Temperature'),
+                                   ('incidence', 'Incidence'))}
+
+    population = get_population(CITIES)
+    morbidity = get_daily_morbidity(CITIES)
+    excess_data = get_relative_weekly_morbidity_excess(
+        get_morbidity_excess(morbidity, get_morbidity_mean(morbidity)), population)
+    onsets = get_onsets_by_morbidity(excess_data, list(thresholds), winter=winter)
+
+    features = LaggedFeatures(stores, CITIES, city_resolver, lags, onsets=onsets,
+                              thresholds=thresholds, horizon=7)
+    written = features.export(directory, winter=winter)
+    print(f'{written} rows of {lags} lags written to {directory}')
+    return written
+
+
+def live_onsets(address='results/feed.sock'):
+    """
+    Onsets of a live feed ('site yyyymmdd incidence' lines sent to a Unix
+    socket), with the all-time mean morbidity of the stored history
+    """
+    THRESHOLDS = [30, 35, 40, 45]
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, 11, 1)
+    winter.END = datetime.date(winter.END.year, 3, 31)
+
+    morbidity = get_daily_morbidity(CITIES)
+    stream = MorbidityStream(get_morbidity_detector(THRESHOLDS, winter),
+                             get_morbidity_mean(morbidity), get_population(CITIES))
+
+    # Catch up with the stored history, then listen
+    history = [row for city in CITIES
+               for row in follow_site_file(city, AH_FILE_PATTERN % city, follow=False)]
+    for event in detect(stream, history):
+        print(f"{event['site']}: onset {event['date']} (threshold {event['threshold']})")
+    print(f'Listening on {address}')
+    for event in detect(stream, read_socket(address)):
+        print(f"{event['site']}: onset {event['date']} (threshold {event['threshold']})")
+
+
 if __name__ == '__main__':
     t0 = time.time()
     # test_parser()
@@ -624,8 +850,14 @@ if __name__ == '__main__':
     # main()
     # onset_distribution_epidemiologists()
     # onset_distribution()
+    # onset_distributions()
     # onset_distribution_paris()
     hypothesis_test()
     # hypothesis_test_paris()
     # hypothesis_test_epidemiologists()
+    # window_sensitivity()
+    # ah_morbidity_cross_correlation()
+    # live_onsets()
+    # export_features()
+    # calibrate_thresholds()
     print('Time elapsed: %.2f sec' % (time.time() - t0))
@@ -0,0 +1,131 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Onset seasonality cube: onset counts by (threshold, site, day of
+    season), built once from the output of an onset engine. The season
+    runs 01.07.1971 to 30.06.1972, the reference years of onset.Winter,
+    so 29.02 has its own day. Days rather than weeks are kept, as the
+    weeks of a distribution count from the first day of the queried winter.
+
+    Distributions of any site subset, threshold range and winter window
+    are slices and sums of the cube:
+
+    >>> cube = OnsetCube.from_onsets(onsets, THRESHOLDS, CONTIGUOUS_STATES)
+    >>> regions = load_regions(REGIONS_FILE)
+    >>> cube.weekly(sites=regions['sw']['sites'], thresholds=[0.01], winter=get_winter(10, 3))
+"""
+import datetime
+
+import numpy as np
+
+from store import get_month_day
+
+SEASON_START = datetime.date(1971, 7, 1)
+SEASON_LENGTH = 366  # days, 29.02.1972 included
+DAYS_IN_WEEK = 7
+
+
+def get_season_days(ordinals):
+    """
+    :param ordinals: array of date.toordinal(), of any year
+    :return: array of int, day of season of every date, 0..365
+    """
+    month, day = get_month_day(np.asarray(ordinals, dtype=int))
+    offsets = np.cumsum([0, 31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30])  # from January
+    day_of_year = offsets[month - 1] + day - 1  # leap year
+    july = offsets[6]
+    return np.where(month > 6, day_of_year - july,
+                    day_of_year + (SEASON_LENGTH - july))
+
+
+class OnsetCube:
+    """
+    counts: array of int (threshold x site x day of season)
+    """
+
+    def __init__(self, counts, thresholds, sites):
+        self.counts = np.asarray(counts, dtype=int)
+        self.thresholds = list(thresholds)
+        self.sites = list(sites)
+        self.threshold_index = {threshold: idx for idx, threshold in enumerate(self.thresholds)}
+        self.site_index = {site: idx for idx, site in enumerate(self.sites)}
+
+    @classmethod
+    def from_onsets(cls, onsets, thresholds=None, sites=None):
+        """
+        :param onsets: dict, dict[threshold][site] = list of datetime.date,
+            output of usa.get_onsets, russia.get_onsets_by_morbidity etc.
+        :param thresholds: list, all of onsets by default
+        :param sites: list, all sites of the first threshold by default
+        """
+        thresholds = sorted(onsets) if thresholds is None else list(thresholds)
+        if sites is None:
+            sites = list(onsets[thresholds[0]]) if thresholds else []
+
+        threshold_rows, site_rows, ordinals = [], [], []
+        for row, threshold in enumerate(thresholds):
+            for column, site in enumerate(sites):
+                dates = onsets[threshold].get(site, [])
+                threshold_rows.extend([row] * len(dates))
+                site_rows.extend([column] * len(dates))
+                ordinals.extend(date.toordinal() for date in dates)
+
+        counts = np.zeros((len(thresholds), len(sites), SEASON_LENGTH), dtype=int)
+        if ordinals:
+            np.add.at(counts, (np.array(threshold_rows), np.array(site_rows),
+                               get_season_days(ordinals)), 1)
+        return cls(counts, thresholds, sites)
+
+    def _rows(self, thresholds, low, high):
+        rows = range(len(self.thresholds)) if thresholds is None \
+            else [self.threshold_index[threshold] for threshold in thresholds]
+        return [row for row in rows
+                if (low is None or self.thresholds[row] >= low) and
+                (high is None or self.thresholds[row] <= high)]
+
+    def _columns(self, sites):
+        if sites is None:
+            return list(range(len(self.sites)))
+        return [self.site_index[site] for site in sites]
+
+    def get(self, thresholds=None, sites=None, winter=None, low=None, high=None):
+        """
+        :param thresholds: list, all by default
+        :param low: float, lowest threshold of the range, inclusive
+        :param high: float, highest threshold of the range, inclusive
+        :param winter: onset.Winter, the whole season by default
+        :return: array (threshold x site x day of winter), onset counts
+        """
+        counts = self.counts[np.ix_(self._rows(thresholds, low, high), self._columns(sites))]
+        if winter is None:
+            return counts
+        # Day of winter of every day of season, as Winter.get_day_index
+        days = np.arange(SEASON_LENGTH) - (winter.START - SEASON_START).days
+        within = (days >= 0) & (days < winter.days_count)
+        result = np.zeros(counts.shape[:2] + (winter.days_count, ), dtype=int)
+        result[:, :, days[within]] = counts[:, :, within]
+        return result
+
+    def weekly(self, thresholds=None, sites=None, winter=None, low=None, high=None):
+        """
+        Onsets summed over thresholds and sites, by week of winter
+        :return: array of int, what onset.get_onset_count_by_week returns
+            for a single threshold
+        """
+        days = self.get(thresholds, sites, winter, low, high).sum(axis=(0, 1))
+        weeks = np.zeros(len(days) // DAYS_IN_WEEK + 1, dtype=int)
+        np.add.at(weeks, np.arange(len(days)) // DAYS_IN_WEEK, days)
+        return weeks
+
+    def by_threshold(self, sites=None, winter=None):
+        """
+        :return: dict, dict[threshold] = array of onset counts by week of winter
+        """
+        return {threshold: self.weekly([threshold], sites, winter) for threshold in self.thresholds}
+
+    def total(self, thresholds=None, sites=None, winter=None, low=None, high=None):
+        """
+        :return: int, number of onsets within winter
+        """
+        return int(self.get(thresholds, sites, winter, low, high).sum())
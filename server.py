@@ -0,0 +1,298 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Long-lived analysis daemon: the datasets are parsed once and their
+    derived arrays stay warm between queries.
+
+    A query is a JSON object, answered with a JSON object:
+        {"query": "onsets", "dataset": "russia", "thresholds": [30],
+         "winter": [11, 3]}
+    Queries: ping, onsets, curves (onset-aligned AH'), ttest (onset-prior
+    AH' v. the analytical control null) and figure (curves rendered to a
+    file within results/server). Results are cached per request.
+
+    Transports: a Unix domain socket with a query per line, or localhost
+    HTTP with a query per POST body.
+
+        $ python3 server.py results/ysc.sock
+        $ echo '{"query": "onsets", "dataset": "russia", "thresholds": [30]}' | \
+            nc -U results/ysc.sock
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+
+import numpy as np
+
+from dataset import DATASETS
+from hypothesis import INTERVAL_LENGTH, ControlPopulation, get_onset_prior_ah_dev
+from onset import Winter, get_average_ah_dev_tensor
+from render import ah_dev_spec, render_figure
+from usa import DATE_SHIFT_RANGE, get_winter
+
+CACHE_SIZE = 1024
+WORKERS = 8
+COLORS = 'bgrcmyk'
+FIGURE_DIRECTORY = 'results/server'
+YEARS = {'usa': (1972, 2002), 'russia': (1986, 2015), 'paris': (1986, 2015)}  # range() of drivers
+
+
+class Analyst:
+    """
+    Answers queries over warm datasets, thread-safe
+    """
+
+    def __init__(self, datasets=('russia', ), cache_size=CACHE_SIZE):
+        self.datasets = {name: DATASETS[name]() for name in datasets}
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._locks = {name: threading.RLock() for name in self.datasets}
+        self._render_lock = threading.Lock()  # Template figures are shared
+        self._populations = dict()
+        self.queries = {
+            'ping': self.ping,
+            'onsets': self.onsets,
+            'curves': self.curves,
+            'ttest': self.ttest,
+            'figure': self.figure,
+        }
+
+    def warm(self):
+        """Parse the data and compute what every query needs"""
+        for name, dataset in self.datasets.items():
+            with self._locks[name]:
+                dataset.resolver, dataset.ah_store, dataset.excess
+                dataset.onsets([0], Winter())
+
+    def handle(self, request):
+        """
+        :param request: dict, a query
+        :return: dict, {'result': ...} or {'error': str}, with 'elapsed' seconds
+        """
+        started = time.time()
+        key = json.dumps(request, sort_keys=True)
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return dict(self._cache[key], cached=True, elapsed=time.time() - started)
+
+        try:
+            query = self.queries[request.get('query')]
+            response = {'result': query(request)}
+        except Exception as e:
+            return {'error': '%s: %s' % (type(e).__name__, e), 'elapsed': time.time() - started}
+
+        with self._cache_lock:
+            self._cache[key] = response
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return dict(response, cached=False, elapsed=time.time() - started)
+
+    def _get(self, request):
+        """
+        :return: (dataset, its lock, thresholds, winter, sites) of a request
+        """
+        name = request.get('dataset', 'russia')
+        dataset = self.datasets[name]
+        winter = get_winter(*request['winter']) if 'winter' in request else Winter()
+        sites = request.get('sites', dataset.sites)
+        return dataset, self._locks[name], request.get('thresholds', []), winter, sites
+
+    def ping(self, request):
+        return sorted(self.datasets)
+
+    def onsets(self, request):
+        dataset, lock, thresholds, winter, sites = self._get(request)
+        with lock:
+            onsets = dataset.onsets(thresholds, winter)
+        return {str(threshold): {str(site): [date.isoformat() for date in onsets[threshold][site]]
+                                 for site in sites}
+                for threshold in thresholds}
+
+    def _get_curves(self, request):
+        dataset, lock, thresholds, winter, sites = self._get(request)
+        with lock:
+            onsets = dataset.onsets(thresholds, winter)
+        averages, counts = get_average_ah_dev_tensor(
+            dataset.ah_store, onsets, thresholds, sites, DATE_SHIFT_RANGE, dataset.resolver)
+        # Average over onsets of all the sites, as get_average_ah_vs_onsets
+        sums = np.nan_to_num(averages * counts[:, :, None]).sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            curves = sums / counts.sum(axis=1)[:, None]
+        return thresholds, curves, counts.sum(axis=1)
+
+    def curves(self, request):
+        thresholds, curves, counts = self._get_curves(request)
+        return {
+            'shifts': list(DATE_SHIFT_RANGE),
+            'curves': {str(threshold): [None if np.isnan(x) else x for x in curve.tolist()]
+                       for threshold, curve in zip(thresholds, curves)},  # null without onsets
+            'onset_counts': {str(threshold): int(count) for threshold, count in zip(thresholds, counts)},
+        }
+
+    def ttest(self, request):
+        """
+        Welch's t-test of onset-prior AH' of every threshold v. the
+        analytical null of the control windows, t and p are null with
+        fewer than two onsets
+        """
+        dataset, lock, thresholds, winter, sites = self._get(request)
+        name = request.get('dataset', 'russia')
+        years = range(*request.get('years', YEARS[name]))
+        interval_length = request.get('interval_length', INTERVAL_LENGTH)
+
+        key = (name, winter.START, winter.END, years.start, years.stop, interval_length)
+        with lock:
+            onsets = dataset.onsets(thresholds, winter)
+            if key not in self._populations:
+                self._populations[key] = ControlPopulation(
+                    dataset.ah_store, winter, dataset.sites, dataset.resolver, years,
+                    interval_length)
+        population = self._populations[key]
+
+        result = dict()
+        for threshold in thresholds:
+            sample, _ = get_onset_prior_ah_dev(dataset.ah_store, onsets, threshold, sites,
+                                               dataset.resolver, interval_length)
+            if len(sample) < 2:  # No variance, and JSON has no NaN
+                result[str(threshold)] = {'onset_count': len(sample), 't': None, 'p': None}
+                continue
+            t, p = population.ttest(sample, sites)
+            result[str(threshold)] = {'onset_count': len(sample), 't': float(t), 'p': float(p)}
+        return result
+
+    def figure(self, request):
+        thresholds, curves, _ = self._get_curves(request)
+        digest = hashlib.md5(json.dumps(request, sort_keys=True).encode('utf8')).hexdigest()
+        spec = ah_dev_spec(
+            dict(zip(thresholds, curves)),
+            {threshold: COLORS[idx % len(COLORS)] for idx, threshold in enumerate(thresholds)},
+            DATE_SHIFT_RANGE, limits=request.get('limits', (-7e-4, 5e-4)),
+            title=request.get('title'),
+            save_to_file=_get_figure_path(request.get('save_to_file', '%s.png' % digest)))
+        with self._render_lock:
+            return render_figure(spec)
+
+
+def _get_figure_path(filename):
+    """
+    :param filename: str, of a client, relative to FIGURE_DIRECTORY
+    :return: str, the path within FIGURE_DIRECTORY
+    """
+    root = os.path.realpath(FIGURE_DIRECTORY)
+    path = os.path.realpath(os.path.join(root, filename))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise ValueError('figures are saved within %s only' % FIGURE_DIRECTORY)
+    return os.path.relpath(path)
+
+
+class PoolMixIn:
+    """
+    socketserver mix-in: requests are served by a fixed pool of threads
+    """
+    workers = WORKERS
+
+    def process_request(self, request, client_address):
+        if not hasattr(self, '_executor'):
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        if hasattr(self, '_executor'):
+            self._executor.shutdown()
+
+
+class UnixServer(PoolMixIn, socketserver.UnixStreamServer):
+    pass
+
+
+class HttpServer(PoolMixIn, HTTPServer):
+    pass
+
+
+class LineHandler(socketserver.StreamRequestHandler):
+    """A JSON query per line, a JSON answer per line"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                response = self.server.analyst.handle(json.loads(line.decode('utf8')))
+            except ValueError as e:
+                response = {'error': 'bad request: %s' % e}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    """A JSON query per POST body"""
+
+    def do_POST(self):
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            response = self.server.analyst.handle(json.loads(body.decode('utf8')))
+            status = 400 if 'error' in response else 200
+        except ValueError as e:
+            response, status = {'error': 'bad request: %s' % e}, 400
+
+        payload = json.dumps(response).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(address, analyst=None, workers=WORKERS):
+    """
+    :param address: str, a Unix socket path, or (host, port) for HTTP
+    :param analyst: Analyst, by default the Russian dataset, warmed up
+    """
+    if analyst is None:
+        analyst = Analyst()
+        analyst.warm()
+
+    if isinstance(address, str):
+        os.makedirs(os.path.dirname('./' + address), exist_ok=True)
+        if os.path.exists(address):
+            os.remove(address)
+        server = UnixServer(address, LineHandler)
+    else:
+        server = HttpServer(address, HttpHandler)
+    server.workers = workers
+    server.analyst = analyst
+    print(f'Serving on {address}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and ':' in sys.argv[1]:
+        host, port = sys.argv[1].rsplit(':', 1)
+        serve((host, int(port)))
+    else:
+        serve(sys.argv[1] if len(sys.argv) > 1 else 'results/ysc.sock')
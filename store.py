@@ -0,0 +1,254 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Columnar store of daily series (absolute humidity, AH', incidence)
+    with precomputed indexes, so a query costs O(result) and not a scan
+    over the whole data['dd.mm.year']['Site Name'] dict.
+"""
+from collections import OrderedDict
+import datetime
+
+import numpy as np
+
+DAYS_IN_YEAR = 365  # 29.02 is omitted everywhere
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+AGGREGATES = {'mean': np.nanmean, 'min': np.nanmin, 'max': np.nanmax}
+
+
+def parse_date(date_str):
+    """'dd.mm.year' -> datetime.date"""
+    return datetime.date(int(date_str[6:10]), int(date_str[3:5]), int(date_str[0:2]))
+
+
+def get_day_of_year(date):
+    """
+    :return: int, 0..364, index of the day in a year without 29.02
+        (29.02 shares the index of 28.02)
+    """
+    if date.month == 2 and date.day == 29:
+        date = date - datetime.timedelta(days=1)
+    return (datetime.date(1971, date.month, date.day) - datetime.date(1971, 1, 1)).days
+
+
+def get_month_day(ordinals):
+    """
+    :param ordinals: array of date.toordinal()
+    :return: (array, array), month and day of every date
+    """
+    days = (np.asarray(ordinals) - EPOCH_ORDINAL).astype('datetime64[D]')
+    months = days.astype('datetime64[M]')
+    return months.astype(int) % 12 + 1, (days - months).astype(int) + 1
+
+
+def get_day_of_year_mean(values, day_of_year):
+    """
+    NaN-aware all-time mean for every day of year
+    :param values: array (date x site)
+    :param day_of_year: array, date row -> 0..364
+    :return: array (365 x site)
+    """
+    valid = ~np.isnan(values)
+    sums = np.zeros((DAYS_IN_YEAR, values.shape[1]))
+    np.add.at(sums, day_of_year, np.where(valid, values, 0.))
+    counts = np.zeros((DAYS_IN_YEAR, values.shape[1]))
+    np.add.at(counts, day_of_year, valid)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts
+
+
+class DateIndex:
+    """
+    Date and site indexes shared by the stores:
+        site_index: dict, site name -> column
+        row_of_ordinal: array, date.toordinal() - first ordinal -> row,
+            29.02 resolves to 28.02 like in hypothesis.py, -1 for gaps
+        day_of_year: array, row -> 0..364
+        doy_rows / doy_offsets: rows grouped by day of year
+    """
+
+    def _build_index(self, dates, sites):
+        """
+        :param dates: list of datetime.date, sorted, without 29.02
+        :param sites: list of str, column names
+        """
+        self.dates = list(dates)
+        self.sites = list(sites)
+        self.site_index = {site: idx for idx, site in enumerate(self.sites)}
+
+        self.ordinals = np.array([date.toordinal() for date in self.dates], dtype=int)
+        self.first_ordinal = int(self.ordinals[0])
+        self.row_of_ordinal = np.full(self.ordinals[-1] - self.first_ordinal + 1, -1, dtype=int)
+        self.row_of_ordinal[self.ordinals - self.first_ordinal] = np.arange(len(self.dates))
+        for row, date in enumerate(self.dates):
+            if date.month == 2 and date.day == 28:
+                leap = self.ordinals[row] + 1 - self.first_ordinal
+                if leap < len(self.row_of_ordinal) and self.row_of_ordinal[leap] == -1:
+                    self.row_of_ordinal[leap] = row  # Skip 29.02
+
+        self.day_of_year = np.array([get_day_of_year(date) for date in self.dates], dtype=int)
+        self.doy_rows = np.argsort(self.day_of_year, kind='mergesort')
+        self.doy_offsets = np.concatenate(
+            ([0], np.cumsum(np.bincount(self.day_of_year, minlength=DAYS_IN_YEAR))))
+
+    def columns(self, sites):
+        return [self.site_index[site] for site in sites]
+
+    def rows(self, dates):
+        """
+        :param dates: array of date ordinals or list of datetime.date
+        :return: array of rows, 29.02 resolved to 28.02
+        """
+        if isinstance(dates, np.ndarray):
+            ordinals = dates.astype(int)
+        else:
+            ordinals = np.array([date.toordinal() if isinstance(date, datetime.date) else date
+                                 for date in dates], dtype=int)
+        offsets = ordinals - self.first_ordinal
+        if np.any(offsets < 0) or np.any(offsets >= len(self.row_of_ordinal)):
+            raise KeyError('dates out of the store')
+        rows = self.row_of_ordinal[offsets]
+        if np.any(rows < 0):
+            raise KeyError('dates out of the store: %s' % ordinals[rows < 0])
+        return rows
+
+    def row_range(self, start=None, end=None):
+        """
+        :return: (int, int), half-open range of rows from start to end inclusive
+        """
+        first = 0 if start is None else int(np.searchsorted(self.ordinals, start.toordinal()))
+        last = len(self.dates) if end is None else \
+            int(np.searchsorted(self.ordinals, end.toordinal(), side='right'))
+        return first, last
+
+
+class DailyStore(DateIndex):
+    """
+    Daily values of many sites in one (date x site) float array.
+    Columns are contiguous, so a per-site series is a view without a copy.
+
+    Besides DateIndex, computed once:
+        mean: array (365 x site), all-time mean for that day of year
+            (only over the years a site has data for, unlike ah.get_ah_mean)
+        dev: array (date x site), AH' as in ah.get_ah_deviation
+    """
+
+    def __init__(self, dates, sites, values):
+        """
+        :param dates: list of datetime.date, sorted, without 29.02
+        :param sites: list of str, column names
+        :param values: array-like (len(dates) x len(sites)), NaN for gaps
+        """
+        self._build_index(dates, sites)
+        self.values = np.asfortranarray(values, dtype=float)
+        self.mean = np.asfortranarray(get_day_of_year_mean(self.values, self.day_of_year))
+        self.dev = np.asfortranarray(self.values - self.mean[self.day_of_year])
+        self._cumsums = dict()  # anomaly: (sums, counts)
+
+    @classmethod
+    def from_ah(cls, ah):
+        """
+        :param ah: dict, data['dd.mm.year']['Site Name'] = absolute humidity
+        """
+        sites = OrderedDict()
+        for info in ah.values():
+            for site in info.keys():
+                sites[site] = None
+        sites = list(sites)
+        site_index = {site: idx for idx, site in enumerate(sites)}
+
+        by_date = sorted((parse_date(date_str), info) for date_str, info in ah.items())
+        values = np.full((len(by_date), len(sites)), np.nan)
+        for row, (_, info) in enumerate(by_date):
+            for site, humidity in info.items():
+                values[row, site_index[site]] = float(humidity)
+        return cls([date for date, _ in by_date], sites, values)
+
+    @classmethod
+    def from_series(cls, series):
+        """
+        :param series: dict, dict['Site']['dd.mm.year'] = value,
+            e.g. russia.get_daily_morbidity or get_morbidity_excess output
+        """
+        transposed = dict()
+        for site, info in series.items():
+            for date_str, value in info.items():
+                if date_str.startswith('29.02'):
+                    continue  # omit leap year
+                transposed.setdefault(date_str, OrderedDict())[site] = value
+        return cls.from_ah(transposed)
+
+    def _data(self, anomaly):
+        return self.dev if anomaly else self.values
+
+    def _get_cumsums(self, anomaly):
+        """Cumulative sums and counts of valid values over rows, built once"""
+        if anomaly not in self._cumsums:
+            data = self._data(anomaly)
+            valid = ~np.isnan(data)
+            zeros = np.zeros((1, len(self.sites)))
+            self._cumsums[anomaly] = (
+                np.concatenate((zeros, np.cumsum(np.where(valid, data, 0.), axis=0))),
+                np.concatenate((zeros, np.cumsum(valid, axis=0))))
+        return self._cumsums[anomaly]
+
+    def window_means(self, first_rows, columns, length, anomaly=True):
+        """
+        Mean over `length` consecutive rows (days without 29.02), O(1) each
+        :param first_rows: array of rows where windows start
+        :param columns: array of columns, broadcast with first_rows
+        :return: array of window means, shaped as first_rows and columns
+        """
+        sums, counts = self._get_cumsums(anomaly)
+        last_rows = first_rows + length
+        if np.any(first_rows < 0) or np.any(last_rows > len(self.dates)):
+            raise KeyError('windows out of the store')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (sums[last_rows, columns] - sums[first_rows, columns]) / \
+                (counts[last_rows, columns] - counts[first_rows, columns])
+
+    def site(self, site, anomaly=False):
+        """
+        :return: array, whole series of one site, a view into the store
+        """
+        return self._data(anomaly)[:, self.site_index[site]]
+
+    def profile(self, sites, day_of_year=None):
+        """
+        Day-of-year climatology, what ah.get_ah_mean_for_site returns
+        :param sites: list of str
+        :param day_of_year: slice or array of 0..364, None for the whole year
+        :return: array (day x site)
+        """
+        profile = self.mean[:, self.columns(sites)]
+        return profile if day_of_year is None else profile[day_of_year]
+
+    def day_of_year_values(self, day_of_year, sites, anomaly=False):
+        """
+        :return: (dates, array (year x site)) of one day of year in every year
+        """
+        rows = self.doy_rows[self.doy_offsets[day_of_year]:self.doy_offsets[day_of_year + 1]]
+        return [self.dates[row] for row in rows], \
+            self._data(anomaly)[np.ix_(rows, self.columns(sites))]
+
+    def slice(self, start=None, end=None, sites=None, anomaly=False):
+        """
+        :param start: datetime.date, inclusive
+        :param end: datetime.date, inclusive
+        :param sites: list of str, None for all (then the result is a view)
+        :return: (dates, array (date x site))
+        """
+        first, last = self.row_range(start, end)
+        data = self._data(anomaly)[first:last]
+        if sites is not None:
+            data = data[:, self.columns(sites)]
+        return self.dates[first:last], data
+
+    def aggregate(self, sites, start=None, end=None, how=('mean', 'min', 'max'),
+                  anomaly=False):
+        """
+        Reduce a group of sites for every date of the range
+        :return: (dates, OrderedDict, dict['mean'] = array over dates)
+        """
+        dates, data = self.slice(start, end, sites, anomaly)
+        return dates, OrderedDict((name, AGGREGATES[name](data, axis=1)) for name in how)
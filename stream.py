@@ -0,0 +1,239 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Onset detection on a live feed: the rule of russia.get_onsets_by_morbidity
+    and usa.get_onsets (two weeks above the threshold, in winter, one onset
+    per season) applied row by row as data arrives.
+
+    Per site the state is the current day and week, the last two weekly
+    values and the last onset per threshold. Replaying a history gives
+    exactly the batch onsets, given the same all-time morbidity mean.
+
+    Rows come from a tailed flu_dbase file (follow_site_file) or from
+    'site yyyymmdd incidence' lines sent to a local socket (read_socket).
+"""
+import datetime
+import os
+import socket
+import time
+
+from onset import Winter
+
+
+class OnsetDetector:
+    """
+    Onset at a week if the two previous weeks are above the threshold
+    """
+
+    def __init__(self, thresholds, winter=Winter(), after=None, before=None):
+        """
+        :param after: datetime.date, no onsets up to this date inclusive
+        :param before: datetime.date, no onsets from this date on
+        """
+        self.thresholds = list(thresholds)
+        self.winter = winter
+        self.after = after
+        self.before = before
+        self._cutoff = datetime.timedelta(days=winter.days_count)
+        self._weeks = dict()  # site -> [prev2, prev1], weekly values
+        self._last_onsets = dict()  # site -> [last onset date of a threshold]
+
+    def start_week(self, site, date):
+        """
+        A new week of a site begins, its own value is not needed yet
+        :return: list of dict, such as {'site': 'spb', 'threshold': 30,
+            'date': datetime.date(2009, 11, 2)}
+        """
+        weeks = self._weeks.get(site)
+        if weeks is None:
+            self._weeks[site] = [None, None]
+            self._last_onsets[site] = [None] * len(self.thresholds)
+            return []
+        prev2, prev1 = weeks
+        if prev2 is None or prev1 is None:
+            return []
+
+        if self.after is not None and date <= self.after or \
+                self.before is not None and date >= self.before:
+            return []
+        if not self.winter.is_winter(date):
+            return []
+
+        events = []
+        last_onsets = self._last_onsets[site]
+        for idx, threshold in enumerate(self.thresholds):
+            if prev2 >= threshold and prev1 >= threshold:
+                # Cutoff second epidemic in the same winter-time
+                if last_onsets[idx] is not None and date - last_onsets[idx] < self._cutoff:
+                    continue
+                last_onsets[idx] = date
+                events.append({'site': site, 'threshold': threshold, 'date': date})
+        return events
+
+    def close_week(self, site, value):
+        """
+        The week started last is complete with this weekly value
+        """
+        weeks = self._weeks[site]
+        weeks[0], weeks[1] = weeks[1], value
+
+    def push_week(self, site, date, value):
+        """
+        One weekly value, e.g. a line of usa.MORTALITY_EXCESS_FILE
+        :return: list of onset events, see start_week
+        """
+        events = self.start_week(site, date)
+        self.close_week(site, value)
+        return events
+
+    def onsets(self, events, sites=()):
+        """
+        :param events: list of onset events
+        :return: dict, dict[threshold][site] = list of dates, as the batch detectors
+        """
+        onsets = {threshold: {site: [] for site in sites} for threshold in self.thresholds}
+        for event in events:
+            onsets[event['threshold']].setdefault(event['site'], []).append(event['date'])
+        return onsets
+
+
+def get_morbidity_detector(thresholds, winter=Winter()):
+    """Date bounds of russia.get_onsets_by_morbidity"""
+    return OnsetDetector(thresholds, winter,
+                         after=datetime.date(1986, winter.END.month, winter.END.day - 1),
+                         before=datetime.date(2015, winter.START.month, winter.START.day))
+
+
+def get_mortality_detector(thresholds, winter=Winter()):
+    """Date bounds of usa.get_onsets"""
+    return OnsetDetector(thresholds, winter,
+                         after=datetime.date(1972, winter.END.month, winter.END.day),
+                         before=datetime.date(2002, winter.START.month, winter.START.day))
+
+
+class MorbidityStream:
+    """
+    Daily morbidity rows -> weekly relative excess -> onset events, what
+    russia.get_relative_weekly_morbidity_excess feeds to the batch detector.
+    Rows of a site must come in date order, rows of the same date are summed.
+    As in the batch code a week is worth the excess of its last day.
+    """
+
+    def __init__(self, detector, morbidity_mean, population):
+        """
+        :param detector: OnsetDetector, e.g. get_morbidity_detector(thresholds)
+        :param morbidity_mean: dict, dict['City Code']['dd.mm'] = all-time
+            mean morbidity, see russia.get_morbidity_mean
+        :param population: dict, dict['City Code'][year] = population
+        """
+        self.detector = detector
+        self.population = population
+        self._mean = {site: {(int(day_month[3:5]), int(day_month[0:2])): value
+                             for day_month, value in info.items()}
+                      for site, info in morbidity_mean.items()}
+        self._days = dict()  # site -> [date, monday, morbidity of the date]
+
+    def _get_excess(self, site, date, morbidity):
+        excess = float(morbidity) - self._mean[site][date.month, date.day]
+        return excess * (100000 / self.population[site][date.year])
+
+    def push(self, site, date, morbidity):
+        """
+        :param date: datetime.date
+        :param morbidity: int, absolute morbidity of the day
+        :return: list of onset events, see OnsetDetector.start_week
+        """
+        day = self._days.get(site)
+        if day is not None and day[0] == date:
+            day[2] += morbidity
+            return []
+
+        events = []
+        monday = date - datetime.timedelta(days=date.weekday())
+        if day is None:
+            events = self.detector.start_week(site, monday)
+            self._days[site] = [date, monday, morbidity]
+            return events
+
+        if monday != day[1]:
+            self.detector.close_week(site, self._get_excess(site, day[0], day[2]))
+            events = self.detector.start_week(site, monday)
+        day[0], day[1], day[2] = date, monday, morbidity
+        return events
+
+
+def parse_row(fields, date_column=0, morbidity_column=3):
+    """
+    :param fields: list of str, a flu_dbase line split by spaces
+    :return: (datetime.date, int morbidity)
+    """
+    date = fields[date_column]
+    return datetime.date(int(date[0:4]), int(date[4:6]), int(date[6:8])), \
+        int(fields[morbidity_column])
+
+
+def follow_site_file(site, filename, follow=True, poll_interval=1.):
+    """
+    Rows of a flu_dbase file, then rows appended to it, as `tail -f`
+    :param follow: bool, wait for new lines after the end of file
+    :return: generator of (site, datetime.date, int morbidity)
+    """
+    with open(filename, 'r') as f:
+        header = f.readline().split()
+        date_column, morbidity_column = header.index('Date'), header.index('Incidence')
+        partial = ''
+        while True:
+            line = f.readline()
+            if not line:
+                if not follow:
+                    line, partial = partial, ''
+                    if not line:
+                        break
+                else:
+                    time.sleep(poll_interval)
+                    continue
+            elif not line.endswith('\n') and follow:  # Still being written
+                partial += line
+                continue
+            line, partial = partial + line, ''
+            fields = line.split()
+            if len(fields) > max(date_column, morbidity_column):
+                yield (site, ) + parse_row(fields, date_column, morbidity_column)
+
+
+def read_socket(address):
+    """
+    Rows sent as 'site yyyymmdd incidence' lines by any number of
+    consecutive clients
+    :param address: str, a Unix socket path, or (host, port)
+    :return: generator of (site, datetime.date, int morbidity)
+    """
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    if family == socket.AF_UNIX:
+        os.makedirs(os.path.dirname('./' + address), exist_ok=True)
+        if os.path.exists(address):
+            os.remove(address)
+
+    with socket.socket(family, socket.SOCK_STREAM) as server:
+        server.bind(address)
+        server.listen(1)
+        while True:
+            connection, _ = server.accept()
+            with connection, connection.makefile('r') as lines:
+                for line in lines:
+                    fields = line.split()
+                    if len(fields) == 3:
+                        yield (fields[0], ) + parse_row(fields, 1, 2)
+
+
+def detect(stream, rows):
+    """
+    :param stream: MorbidityStream
+    :param rows: iterable of (site, datetime.date, int morbidity), such as
+        follow_site_file or read_socket
+    :return: generator of onset events, as soon as they happen
+    """
+    for site, date, morbidity in rows:
+        for event in stream.push(site, date, morbidity):
+            yield event
@@ -16,33 +16,47 @@
     Cheers,
     Jeff"
 """
+from collections import OrderedDict
 import csv
 import datetime
 import json
+import os
 import time
 
 from scipy import stats
 
 from ah import get_ah_mean_for_site, get_ah_mean, get_ah_deviation, draw_ah_mean, plot_average_ah_dev
-from hypothesis import generate_control_sample, generate_experimental_sample
-from onset import Winter, draw_onset_distribution_by_week, get_average_ah_vs_onsets
+from dag import Stage, run
+from hypothesis import CONTROL_SAMPLE_SIZE, ControlPool, ControlPopulation, generate_control_sample, \
+    generate_experimental_sample, get_onset_prior_ah_dev, get_ttest_table
+from ingest import get_store_from_wide_csv
+from metrics import MetricsExporter
+from onset import Winter, draw_onset_distribution_by_week, get_average_ah_vs_onsets, \
+    get_average_ah_dev_tensor, rank_sites_by_ah_dip
+from regions import RegionEngine, load_regions
+from render import ah_dev_spec, onset_distribution_spec, render_figures
+from seasonality import OnsetCube
 
 AH_CSV_FILE = 'data/stateAHmsk_oldFL.csv'
 STATE_CODES_FILE = 'data/NCHS_State_codes.txt'
 MORTALITY_EXCESS_FILE = 'data/WeeklyExcessNew.txt'
 
+REGIONS_FILE = 'data/regions/usa.json'  # Loaded by the drivers, see load_regions
+
 # Pass Entire US, Alaska, and Hawaii
 CONTIGUOUS_STATES = [1] + list(range(3, 12)) + list(range(13, 52))
 # TOP_24_BY_AH_DIP = [1, 3, 4, 8, 9, 10, 11, 14, 15, 18, 19, 21, 25, 26, 31, 33, 34, 36, 37, 39, 43, 44, 47, 49]
 # CONTIGUOUS_STATES = list(set(CONTIGUOUS_STATES) - set(TOP_24_BY_AH_DIP))  # exclude top 24 AH' lowest
-SW_STATES = [3, 6, 29, 32, 45]  # south-west
-NE_STATES = [7, 8, 9, 20, 21, 22, 30, 31, 33, 39, 40, 46, 49]  # north-east
-GULF_STATES = [1, 4, 10, 11, 18, 19, 34, 41, 43, 47]  # bottom, Gulf region
-REST_STATES = [5, 13, 14, 15, 16, 17, 23, 24, 25, 26, 27, 28,
-               35, 36, 37, 38, 42, 44, 48, 50, 51]  # the rest
 DATE_SHIFT_RANGE = range(-6 * 7, 4 * 7 + 1)
 THRESHOLDS = [0.005, 0.01, 0.015, 0.02]
 THRESHOLD_COLORS = {0.005: 'b', 0.01: 'g', 0.015: 'r', 0.02: 'c'}
+WINTER_RANGES = ((12, 2),
+                 (12, 3), (11, 2),
+                 (11, 3),
+                 (11, 4), (10, 3),
+                 (10, 4),
+                 (10, 5), (9, 4),
+                 (9, 5),)
 
 
 def get_ah(ah_csv_file):
@@ -65,6 +79,25 @@ def get_ah(ah_csv_file):
     return data
 
 
+def get_ah_store(ah_csv_file, workers=None):
+    """
+    get_ah parsed in parallel byte-range chunks into a columnar store
+    :return: store.DailyStore, columns are 'State Name'
+    """
+    return get_store_from_wide_csv(ah_csv_file, delimiter=';', workers=workers)
+
+
+def generate_store_experimental_sample(store, onsets, threshold, sites, state_resolver, filename):
+    """
+    generate_experimental_sample from the AH' of a store, as the control
+    samples of an enumerated hypothesis.ControlPopulation
+    """
+    sample, _ = get_onset_prior_ah_dev(store, onsets, threshold, sites, state_resolver)
+    os.makedirs(os.path.dirname('./' + filename), exist_ok=True)
+    with open(filename, 'w') as f:
+        f.write(json.dumps(sample.tolist()))
+
+
 def get_state_resolver(state_codes_file):
     """
     :return: dict, such as
@@ -91,15 +124,20 @@ def get_date_from_week_index(week: int):
     return base_date + datetime.timedelta(weeks=week - 1)
 
 
-def get_mortality_excess(mortality_excess_file):
+def get_mortality_excess(mortality_excess_file, states=None):
+    """
+    :param states: list of state codes to parse, all by default; the
+        other states are kept with no weeks, as get_onsets expects them
+    """
     data = dict()
     for idx in range(52):
         data[idx] = list()
+    wanted = None if states is None else set(states)
 
     with open(mortality_excess_file, 'r') as file:
         for line in file:
             values = line.split()
-            if not values:
+            if not values or wanted is not None and int(values[0]) not in wanted:
                 continue
 
             state_code, population, date, mortality_excess = \
@@ -145,6 +183,23 @@ def get_onsets(excess_data, thresholds, winter=Winter()):
     return onsets
 
 
+def get_winter(start_month, end_month):
+    """
+    :return: Winter, from the 1st day of start_month
+        to the last day of end_month
+    """
+    winter = Winter()
+    winter.START = datetime.date(winter.START.year, start_month, 1)
+    if end_month in [10, 12, 1, 3, 5]:
+        last_day = 31
+    elif end_month in [9, 11, 4]:
+        last_day = 30
+    else:  # 2 (February 1972)
+        last_day = 29
+    winter.END = datetime.date(winter.END.year, end_month, last_day)
+    return winter
+
+
 def main():
     winter = Winter()
     # if params[1] in [10, 12, 1, 3, 5]:
@@ -155,32 +210,22 @@ def main():
     winter.END = datetime.date(winter.END.year, 4, 30)
 
     state_resolver = get_state_resolver(STATE_CODES_FILE)
-    ah = get_ah(AH_CSV_FILE)
-    ah_mean = get_ah_mean(ah)
-    ah_dev = get_ah_deviation(ah, ah_mean)
+    store = get_ah_store(AH_CSV_FILE)
 
     excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
     onsets = get_onsets(excess_data, THRESHOLDS, winter)
 
-    regions = [
-        # ('all', 'Contiguous States', CONTIGUOUS_STATES),
-        ('sw', 'Southwest States', SW_STATES),
-        ('ne', 'Northeast States', NE_STATES),
-        ('gulf', 'Gulf States', GULF_STATES),
-        ('the_rest', 'The Remained States', REST_STATES)
-    ]
-
-    for region in regions:
-        name_suffix, title_suffix, SITES = region
-
-        average_ah_dev = get_average_ah_vs_onsets(
-            ah_dev, onsets, SITES, THRESHOLDS,
-            DATE_SHIFT_RANGE, state_resolver)
+    engine = RegionEngine(store, onsets, THRESHOLDS, CONTIGUOUS_STATES,
+                          state_resolver, DATE_SHIFT_RANGE)
+    all_regions = load_regions(REGIONS_FILE)
+    regions = OrderedDict((name, all_regions[name])
+                          for name in ['sw', 'ne', 'gulf', 'the_rest'])  # 'all'
 
+    for name_suffix, result in engine.aggregate(regions).items():
         plot_average_ah_dev(
-            average_ah_dev, THRESHOLD_COLORS, DATE_SHIFT_RANGE,
+            result['average_ah_dev'], THRESHOLD_COLORS, DATE_SHIFT_RANGE,
             limits=(-7e-4, 5e-4),
-            title='AH\' v. Onset Day: ' + title_suffix,
+            title='AH\' v. Onset Day: ' + regions[name_suffix]['title'],
             save_to_file='results/usa/usa_winter10-4_%s.pdf' % name_suffix)
 
 
@@ -210,6 +255,26 @@ def onset_distribution():
         save_to_file='results/onsets/usa_all_contiguous.png')
 
 
+def onset_distribution_regions(winter=None):
+    """
+    Onset distribution of every region, threshold and winter range,
+    all sliced from one seasonality cube
+    :param winter: onset.Winter of onset detection, October — April by default
+    """
+    excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
+    cube = OnsetCube.from_onsets(get_onsets(excess_data, THRESHOLDS, winter or get_winter(10, 4)),
+                                 THRESHOLDS, CONTIGUOUS_STATES)
+    return render_figures([
+        onset_distribution_spec(
+            cube.weekly([threshold], region['sites'], get_winter(*params)).tolist(),
+            title='Epidemic number distribution: %s, threshold %s' % (region['title'], threshold),
+            save_to_file='results/onsets/usa_%s_winter%d-%d_threshold%s.png' % (
+                name, params[0], params[1], threshold))
+        for name, region in load_regions(REGIONS_FILE).items()
+        for threshold in THRESHOLDS
+        for params in WINTER_RANGES])
+
+
 def winter_range_investigation():
     state_resolver = get_state_resolver(STATE_CODES_FILE)
     ah = get_ah(AH_CSV_FILE)
@@ -218,23 +283,9 @@ def winter_range_investigation():
 
     excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
 
-    for params in ((12, 2),
-                   (12, 3), (11, 2),
-                   (11, 3),
-                   (11, 4), (10, 3),
-                   (10, 4),
-                   (10, 5), (9, 4),
-                   (9, 5),):
-        winter = Winter()
-        winter.START = datetime.date(winter.START.year, params[0], 1)
-        if params[1] in [10, 12, 1, 3, 5]:
-            last_day = 31
-        elif params[1] in [9, 11, 4]:
-            last_day = 30
-        else:  # 2 (February 1972)
-            last_day = 29
-        winter.END = datetime.date(winter.END.year, params[1], last_day)
-
+    specs = []
+    for params in WINTER_RANGES:
+        winter = get_winter(*params)
         onsets = get_onsets(excess_data, THRESHOLDS, winter)
 
         average_ah_dev = get_average_ah_vs_onsets(
@@ -246,57 +297,89 @@ def winter_range_investigation():
         filename = 'results/winter_range_usa/usa_winter%d-%d.pdf' % (
             winter.START.month, winter.END.month
         )
-        plot_average_ah_dev(average_ah_dev, THRESHOLD_COLORS,
-                            DATE_SHIFT_RANGE, limits=(-3.3e-4, 2.2e-4),
-                            title=title, save_to_file=filename)
+        specs.append(ah_dev_spec(average_ah_dev, THRESHOLD_COLORS,
+                                 DATE_SHIFT_RANGE, limits=(-3.3e-4, 2.2e-4),
+                                 title=title, save_to_file=filename))
+    render_figures(specs)
 
 
-def distinct_states():
+def winter_range_distinct_states():
+    """Figure per contiguous state for every winter range"""
     state_resolver = get_state_resolver(STATE_CODES_FILE)
     ah = get_ah(AH_CSV_FILE)
     ah_mean = get_ah_mean(ah)
     ah_dev = get_ah_deviation(ah, ah_mean)
 
     excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
-    onsets = get_onsets(excess_data, THRESHOLDS)
 
-    deeps = dict()  # state_code: ah
-    deep_level = -0.0003
-    anomaly_peaks = range(-28, 0, 1)  # [-19, -18, -17, -11, -10, -9]
+    specs = []
+    for params in WINTER_RANGES:
+        winter = get_winter(*params)
+        onsets = get_onsets(excess_data, THRESHOLDS, winter)
 
-    for state in [1] + list(range(3, 12)) + list(range(13, 52)):
-        CONTIGUOUS_STATES = [state]
+        for state in CONTIGUOUS_STATES:
+            # No curve of a threshold without onsets, its average is a scalar NaN
+            thresholds = [threshold for threshold in THRESHOLDS if onsets[threshold][state]]
+            if not thresholds:
+                continue
+            average_ah_dev = get_average_ah_vs_onsets(
+                ah_dev, onsets, [state], thresholds,
+                DATE_SHIFT_RANGE, state_resolver)
 
-        average_ah_dev = get_average_ah_vs_onsets(
-            ah_dev, onsets, CONTIGUOUS_STATES, THRESHOLDS,
-            DATE_SHIFT_RANGE, state_resolver)
+            specs.append(ah_dev_spec(
+                average_ah_dev, THRESHOLD_COLORS, DATE_SHIFT_RANGE,
+                title=state_resolver[state]['name'],
+                save_to_file='results/winter_range_usa/distinct/'
+                             'usa_%s_winter%d-%d.pdf' % (
+                                state_resolver[state]['acronym'],
+                                winter.START.month, winter.END.month)))
+    render_figures(specs)
 
-        for threshold, average in average_ah_dev.items():
-            idxs = [day_x - DATE_SHIFT_RANGE[0]
-                    for day_x in anomaly_peaks]
-            deep = min(average[idx] for idx in idxs)
-            if deep < deep_level:
-                if state in deeps:
-                    deeps[state] = min(deep, deeps[state])
-                else:
-                    deeps[state] = deep
-        # plot_average_ah_dev(
-        #     average_ah_dev, THRESHOLD_COLORS, DATE_SHIFT_RANGE,
-        #     title=state_resolver[state]['name'],
-        #     save_to_file='results/usa_distinct/figure_state%s.png' %
-        #                  state_resolver[state]['acronym'])
-
-    for state, deep in sorted(deeps.items(), key=lambda x: x[1]):
-        print('Deep level %f in %s state (%d)' % (
-            deep, state_resolver[state]['acronym'], state)
-        )
 
-    top_dip = [state for state, deep in sorted(deeps.items(), key=lambda x: x[1])]
+def distinct_states(plot=False):
+    state_resolver = get_state_resolver(STATE_CODES_FILE)
+    store = get_ah_store(AH_CSV_FILE)
+
+    excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
+    onsets = get_onsets(excess_data, THRESHOLDS)
+
+    ranking = rank_sites_by_ah_dip(
+        store, onsets, THRESHOLDS, CONTIGUOUS_STATES,
+        DATE_SHIFT_RANGE, state_resolver,
+        anomaly_peaks=range(-28, 0, 1),  # [-19, -18, -17, -11, -10, -9]
+        deep_level=-0.0003,
+        filename='results/usa_distinct/ah_dip_ranking.json', winter=Winter())
+
+    if plot:
+        averages, _ = get_average_ah_dev_tensor(
+            store, onsets, THRESHOLDS, CONTIGUOUS_STATES,
+            DATE_SHIFT_RANGE, state_resolver)
+        render_figures([
+            ah_dev_spec(
+                OrderedDict(zip(THRESHOLDS, averages[:, idx])),
+                THRESHOLD_COLORS, DATE_SHIFT_RANGE,
+                title=state_resolver[state]['name'],
+                save_to_file='results/usa_distinct/figure_state%s.png' %
+                             state_resolver[state]['acronym'])
+            for idx, state in enumerate(CONTIGUOUS_STATES)])
+
+    top_dip = [x['site'] for x in ranking if x['deep']]
+    for x in ranking:
+        if x['deep']:
+            print('Deep level %f in %s state (%d), day %d' % (
+                x['depth'], state_resolver[x['site']]['acronym'], x['site'], x['day'])
+            )
+
     print(f'Top dip {len(top_dip)}: {top_dip}')
     return top_dip
 
 
-def stats_all_country():
+def stats_all_country(enumerated=False):
+    """
+    :param enumerated: bool, draw control samples from an enumerated
+        hypothesis.ControlPopulation instead of day-by-day lookups, both
+        samples are then AH' of the store
+    """
     # THRESHOLDS = [0.005]
     winter = Winter()
     # if params[1] in [10, 12, 1, 3, 5]:
@@ -307,20 +390,31 @@ def stats_all_country():
     winter.END = datetime.date(winter.END.year, 3, 31)
 
     state_resolver = get_state_resolver(STATE_CODES_FILE)
-    ah = get_ah(AH_CSV_FILE)
-    ah_mean = get_ah_mean(ah)
-    ah_dev = get_ah_deviation(ah, ah_mean)
+    if enumerated:  # Both samples from the store, get_ah is not parsed
+        store, ah_dev = get_ah_store(AH_CSV_FILE), None
+    else:
+        ah = get_ah(AH_CSV_FILE)
+        store, ah_dev = None, get_ah_deviation(ah, get_ah_mean(ah))
 
     excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
     onsets = get_onsets(excess_data, THRESHOLDS, winter)
     years = range(1972, 2002)
 
+    population = ControlPopulation(store, Winter(), CONTIGUOUS_STATES, state_resolver, years) \
+        if enumerated else None
+
     # Generate for all the country
     for threshold in THRESHOLDS:
         generate_control_sample(onsets, threshold, ah_dev, Winter(), CONTIGUOUS_STATES, state_resolver, years,
-                                filename=f'results/stats/usa/ah_sample.{threshold}.json')
-        generate_experimental_sample(onsets, threshold, ah_dev, Winter(), CONTIGUOUS_STATES, state_resolver,
-                                     filename=f'results/stats/usa/epidemic_sample.{threshold}.json')
+                                filename=f'results/stats/usa/ah_sample.{threshold}.json',
+                                population=population)
+        filename = f'results/stats/usa/epidemic_sample.{threshold}.json'
+        if enumerated:
+            generate_store_experimental_sample(store, onsets, threshold, CONTIGUOUS_STATES,
+                                               state_resolver, filename)
+        else:
+            generate_experimental_sample(onsets, threshold, ah_dev, Winter(), CONTIGUOUS_STATES,
+                                         state_resolver, filename=filename)
 
     for threshold in THRESHOLDS:
         print(f'threshold {threshold}:')
@@ -335,7 +429,12 @@ def stats_all_country():
         print(t, prob)
 
 
-def stats_distinct_states():
+def stats_distinct_states(enumerated=False):
+    """
+    :param enumerated: bool, draw control samples from an enumerated
+        hypothesis.ControlPopulation instead of day-by-day lookups, both
+        samples are then AH' of the store
+    """
     winter = Winter()
     # if params[1] in [10, 12, 1, 3, 5]:
     #     last_day = 31
@@ -345,9 +444,11 @@ def stats_distinct_states():
     winter.END = datetime.date(winter.END.year, 3, 31)
 
     state_resolver = get_state_resolver(STATE_CODES_FILE)
-    ah = get_ah(AH_CSV_FILE)
-    ah_mean = get_ah_mean(ah)
-    ah_dev = get_ah_deviation(ah, ah_mean)
+    if enumerated:  # Both samples from the store, get_ah is not parsed
+        store, ah_dev = get_ah_store(AH_CSV_FILE), None
+    else:
+        ah = get_ah(AH_CSV_FILE)
+        store, ah_dev = None, get_ah_deviation(ah, get_ah_mean(ah))
 
     excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
     onsets = get_onsets(excess_data, THRESHOLDS, winter)
@@ -356,15 +457,22 @@ def stats_distinct_states():
     # For distinct states
     threshold = THRESHOLDS[-1]  # The strongest 0.02
 
+    population = ControlPopulation(store, Winter(), CONTIGUOUS_STATES, state_resolver, years) \
+        if enumerated else None
+
     for site in CONTIGUOUS_STATES[1:]:
         generate_control_sample(onsets, threshold, ah_dev, Winter(), [site], state_resolver, years,
-                                filename=f'results/stats/usa/distinct/control.{site}.{threshold}.json')
-        generate_experimental_sample(onsets, threshold, ah_dev, Winter(), [site], state_resolver,
-                                     filename=f'results/stats/usa/distinct/experimental.{site}.{threshold}.json')
-
-    different = []
-    equal = []
+                                filename=f'results/stats/usa/distinct/control.{site}.{threshold}.json',
+                                population=population)
+        filename = f'results/stats/usa/distinct/experimental.{site}.{threshold}.json'
+        if enumerated:
+            generate_store_experimental_sample(store, onsets, threshold, [site], state_resolver,
+                                               filename)
+        else:
+            generate_experimental_sample(onsets, threshold, ah_dev, Winter(), [site], state_resolver,
+                                         filename=filename)
 
+    labels, control, experimental = [], [], []
     for site in CONTIGUOUS_STATES:
         try:
             with open(f'results/stats/usa/distinct/control.{site}.{threshold}.json', 'r') as f:
@@ -375,26 +483,29 @@ def stats_distinct_states():
                 epidemic_sample = json.load(f)
         except:
             continue
+        labels.append(state_resolver[site]['name'])
+        control.append(ah_sample)
+        experimental.append(epidemic_sample)
 
-        # print(state_resolver[site]['name'])
-        # print(f"AH' sample size = {len(ah_sample)}")
-        # print(f"Epidemic sample size = {len(epidemic_sample)}")
-        # t, prob = stats.ttest_ind(ah_sample, epidemic_sample)
-        # print(f"Equal variance (Student's t-test): P-value = {prob}")
-        t, prob = stats.ttest_ind(ah_sample, epidemic_sample, equal_var=False)
-        # print(f"Not equal variance (Welch’s t-test): P-value = {prob}")
-        # print()
+    different = []
+    equal = []
+
+    # Welch's t-test of every state at once
+    for row in get_ttest_table(labels, control, experimental, equal_var=False, correction='holm'):
+        prob = row['p']
         prob_str = "\\textbf{"+str(prob)[:7]+"}" if prob < 0.05 else str(prob)[:7]
-        print(f"{state_resolver[site]['name']} & {len(epidemic_sample)} & " + prob_str + " \\\\\n\\hline")
+        print(f"{row['label']} & {row['experimental_size']} & " + prob_str + " \\\\\n\\hline")
 
         if prob < 0.05:
-            different.append((state_resolver[site]['name'], prob,))
+            different.append((row['label'], prob, row['significant'],))
         else:
-            equal.append((state_resolver[site]['name'], prob,))
+            equal.append((row['label'], prob, row['significant'],))
 
     print(f"\n\n\nOverall {len(different) + len(equal)} states:")
     print(f'\t{len(different)} different avg: {[x[0] for x in different]}')
     print(f'\t{len(equal)} equal avg: {[x[0] for x in equal]}')
+    print(f'\t{sum(x[2] for x in different)} different after Holm correction: '
+          f'{[x[0] for x in different if x[2]]}')
     print()
     diff_prob, eq_prob = [x[1] for x in different], [x[1] for x in equal]
     if diff_prob:
@@ -466,7 +577,12 @@ def stats_joint():
         print()
 
 
-def stats_regions():
+def stats_regions(enumerated=False):
+    """
+    :param enumerated: bool, draw control samples from an enumerated
+        hypothesis.ControlPopulation instead of day-by-day lookups, both
+        samples are then AH' of the store
+    """
     winter = Winter()
     # if params[1] in [10, 12, 1, 3, 5]:
     #     last_day = 31
@@ -476,9 +592,11 @@ def stats_regions():
     winter.END = datetime.date(winter.END.year, 3, 31)
 
     state_resolver = get_state_resolver(STATE_CODES_FILE)
-    ah = get_ah(AH_CSV_FILE)
-    ah_mean = get_ah_mean(ah)
-    ah_dev = get_ah_deviation(ah, ah_mean)
+    if enumerated:  # Both samples from the store, get_ah is not parsed
+        store, ah_dev = get_ah_store(AH_CSV_FILE), None
+    else:
+        ah = get_ah(AH_CSV_FILE)
+        store, ah_dev = None, get_ah_deviation(ah, get_ah_mean(ah))
 
     excess_data = get_mortality_excess(MORTALITY_EXCESS_FILE)
     onsets = get_onsets(excess_data, THRESHOLDS, winter)
@@ -486,17 +604,32 @@ def stats_regions():
 
     # For regions
     threshold = THRESHOLDS[-1]  # The strongest 0.02
-    regions = {'sw': SW_STATES,
-               'ne': NE_STATES,
-               'gulf': GULF_STATES,
-               'the_rest': REST_STATES}
-
-    for region_name, region in regions.items():
-        generate_control_sample(onsets, threshold, ah_dev, winter, region, state_resolver, years,
-                                filename=f'results/stats/usa/regions/control.{region_name}.{threshold}.json')
-        generate_experimental_sample(onsets, threshold, ah_dev, winter, region, state_resolver,
-                                     filename=f'results/stats/usa/regions/experimental.{region_name}.{threshold}.json')
-
+    all_regions = load_regions(REGIONS_FILE)
+    regions = OrderedDict((name, all_regions[name]['sites'])
+                          for name in ['sw', 'ne', 'gulf', 'the_rest'])
+
+    population = None
+    if enumerated:
+        population = ControlPopulation(store, winter, CONTIGUOUS_STATES, state_resolver, years)
+        # Common random numbers for all the regions
+        population = ControlPool(population, max(
+            sum(len(onsets[threshold][site]) for site in region) for region in regions.values()))
+
+    with MetricsExporter('results/metrics/usa_regions.prom') as metrics:
+        for region_name, region in regions.items():
+            generate_control_sample(onsets, threshold, ah_dev, winter, region, state_resolver, years,
+                                    filename=f'results/stats/usa/regions/control.{region_name}.{threshold}.json',
+                                    progress=metrics.job(f'usa_control_{region_name}', CONTROL_SAMPLE_SIZE),
+                                    population=population)
+            filename = f'results/stats/usa/regions/experimental.{region_name}.{threshold}.json'
+            if enumerated:
+                generate_store_experimental_sample(store, onsets, threshold, region, state_resolver,
+                                                   filename)
+            else:
+                generate_experimental_sample(onsets, threshold, ah_dev, winter, region,
+                                             state_resolver, filename=filename)
+
+    labels, control, experimental = [], [], []
     for region_name, region in regions.items():
         try:
             with open(f'results/stats/usa/regions/control.{region_name}.{threshold}.json', 'r') as f:
@@ -505,23 +638,70 @@ def stats_regions():
                 epidemic_sample = json.load(f)
         except:
             continue
-
-        print(f'Region {region_name} ({len(region)} states)')
-        print(f"AH' sample size = {len(ah_sample)}")
-        print(f"Epidemic sample size = {len(epidemic_sample)}")
-        # t, prob = stats.ttest_ind(ah_sample, epidemic_sample)
-        # print(f"Equal variance (Student's t-test): P-value = {prob}")
-        t, prob = stats.ttest_ind(ah_sample, epidemic_sample, equal_var=False)
-        print(f"Not equal variance (Welch’s t-test): P-value = {prob}")
+        labels.append(region_name)
+        control.append(ah_sample)
+        experimental.append(epidemic_sample)
+
+    for row in get_ttest_table(labels, control, experimental, equal_var=False, correction='holm'):
+        print(f"Region {row['label']} ({len(regions[row['label']])} states)")
+        print(f"AH' sample size = {row['control_size']}")
+        print(f"Epidemic sample size = {row['experimental_size']}")
+        print(f"Not equal variance (Welch’s t-test): P-value = {row['p']}, "
+              f"Holm-adjusted {row['p_adjusted']}")
         print()
 
 
+def plot_regions(engine, regions, winter):
+    """
+    AH' v. onset day figure for every region
+    :param engine: regions.RegionEngine
+    :return: list of saved filenames
+    """
+    return render_figures([
+        ah_dev_spec(
+            result['average_ah_dev'], THRESHOLD_COLORS, DATE_SHIFT_RANGE,
+            limits=(-7e-4, 5e-4),
+            title='AH\' v. Onset Day: ' + regions[name]['title'],
+            save_to_file='results/usa/usa_winter%d-%d_%s.pdf' % (
+                winter.START.month, winter.END.month, name))
+        for name, result in engine.aggregate(regions).items()])
+
+
+def nightly(workers=None):
+    """
+    Region figures for every winter range and the AH' dip ranking as one
+    DAG: parsing, anomalies and onsets run once for all of them
+    """
+    state_resolver = Stage(get_state_resolver, STATE_CODES_FILE)
+    store = Stage(get_ah_store, AH_CSV_FILE)
+    excess_data = Stage(get_mortality_excess, MORTALITY_EXCESS_FILE)
+    regions = Stage(load_regions, REGIONS_FILE)
+
+    experiments = [Stage(
+        rank_sites_by_ah_dip, store, Stage(get_onsets, excess_data, THRESHOLDS),
+        THRESHOLDS, CONTIGUOUS_STATES, DATE_SHIFT_RANGE, state_resolver,
+        anomaly_peaks=range(-28, 0, 1), deep_level=-0.0003,
+        filename='results/usa_distinct/ah_dip_ranking.json', winter=Winter())]
+
+    for params in WINTER_RANGES:  # (10, 4) is the winter of main()
+        winter = get_winter(*params)
+        onsets = Stage(get_onsets, excess_data, THRESHOLDS, winter)
+        engine = Stage(RegionEngine, store, onsets, THRESHOLDS, CONTIGUOUS_STATES,
+                       state_resolver, DATE_SHIFT_RANGE)
+        experiments.append(Stage(plot_regions, engine, regions, winter))
+
+    with MetricsExporter('results/metrics/usa_nightly.prom') as metrics:
+        return run(experiments, workers, progress=metrics.job('usa_nightly', None))
+
+
 if __name__ == '__main__':
     t0 = time.time()
     # test_parser()
     # onset_distribution()
+    # onset_distribution_regions()
     # winter_range_investigation()
     # distinct_states()
+    # winter_range_distinct_states()
     # main()
     # stats_all_country()
     # stats_distinct_states()
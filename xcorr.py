@@ -0,0 +1,106 @@
+#!/usr/env/bin python3
+# -*- coding: utf8 -*-
+# Nikita Seleznev, 2017
+"""
+    Lagged cross-correlation between AH' and morbidity excess for every
+    (site, season) at once, through one batched real FFT. Unlike the
+    onset-aligned average it needs no threshold to define an onset.
+"""
+import datetime
+
+import numpy as np
+
+
+def get_season_segments(ah_store, excess_store, sites, site_resolver, winter, years):
+    """
+    Cut equal-length seasonal segments of both series
+    :param ah_store: store.DailyStore of absolute humidity by site name
+    :param excess_store: store.DailyStore of morbidity excess by site code,
+        e.g. DailyStore.from_series(russia.get_morbidity_excess(...))
+    :return: (array (pair x day) of AH', array (pair x day) of excess,
+        list of (site, year) pairs), seasons out of either store are skipped
+    """
+    length = winter.days_count
+    ah_columns = ah_store.columns([site_resolver[site]['name'] for site in sites])
+    excess_columns = excess_store.columns(sites)
+
+    ah_segments, excess_segments, pairs = [], [], []
+    for year in years:
+        start = datetime.date(year, winter.START.month, winter.START.day)
+        try:
+            ah_first = int(ah_store.rows([start])[0])
+            excess_first = int(excess_store.rows([start])[0])
+        except KeyError:
+            continue
+        if ah_first + length > len(ah_store.dates) or \
+                excess_first + length > len(excess_store.dates):
+            continue
+
+        for site, ah_column, excess_column in zip(sites, ah_columns, excess_columns):
+            ah_segments.append(ah_store.dev[ah_first:ah_first + length, ah_column])
+            excess_segments.append(excess_store.values[excess_first:excess_first + length,
+                                                       excess_column])
+            pairs.append((site, year))
+
+    shape = (len(pairs), length)
+    return np.array(ah_segments).reshape(shape), \
+        np.array(excess_segments).reshape(shape), pairs
+
+
+def _standardize(x):
+    x = x - np.nanmean(x, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = x / np.nanstd(x, axis=1, keepdims=True)
+    return np.nan_to_num(x)  # Gaps do not contribute
+
+
+def prewhiten(x, y):
+    """
+    Fit AR(1) to every row of x and apply the same filter to x and y
+    :return: (x, y) residuals, one day shorter
+    """
+    x = _standardize(x)
+    phi = (x[:, 1:] * x[:, :-1]).sum(axis=1) / (x * x).sum(axis=1)
+    phi = np.nan_to_num(phi)[:, None]
+    return x[:, 1:] - phi * x[:, :-1], y[:, 1:] - phi * y[:, :-1]
+
+
+def get_cross_correlation(x, y, max_lag, whiten=False):
+    """
+    corr(x[t], y[t + lag]) of every row for lags -max_lag..max_lag,
+    positive lags mean x leads y
+    :param x: array (pair x day)
+    :param y: array (pair x day)
+    :return: (array of lags, array (pair x lag) of correlations)
+    """
+    if whiten:
+        x, y = prewhiten(x, y)
+    x, y = _standardize(x), _standardize(y)
+
+    length = x.shape[1]
+    nfft = 1 << int(np.ceil(np.log2(length + max_lag)))  # No circular wrap up to max_lag
+    spectrum = np.conj(np.fft.rfft(x, nfft, axis=1)) * np.fft.rfft(y, nfft, axis=1)
+    full = np.fft.irfft(spectrum, nfft, axis=1) / length
+
+    lags = np.arange(-max_lag, max_lag + 1)
+    return lags, full[:, lags % nfft]
+
+
+def get_ah_excess_cross_correlation(ah_store, excess_store, sites, site_resolver,
+                                    winter, years, max_lag=60, whiten=False):
+    """
+    :return: dict, such as {
+            'lags': array, 'pairs': list of (site, year),
+            'correlation': array (pair x lag),
+            'mean': array over lags, average over pairs
+        }
+    """
+    x, y, pairs = get_season_segments(ah_store, excess_store, sites, site_resolver,
+                                      winter, years)
+    lags, correlation = get_cross_correlation(x, y, max_lag, whiten)
+    return {
+        'lags': lags,
+        'pairs': pairs,
+        'correlation': correlation,
+        'mean': correlation.mean(axis=0),
+    }